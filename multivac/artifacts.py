@@ -0,0 +1,182 @@
+""" Lookup of job artifacts stored in S3.
+
+    Artifacts of a job are stored in the bucket as
+    `<owner>/<repo>/artifacts/<run_id>/<job_id>.zip` (see
+    `backup.sh`). Instead of a HEAD request per job, `ArtifactIndex`
+    lists the `artifacts/<run_id>/` prefix once per workflow run. The
+    listings are made concurrently and cached on disk for a while.
+
+    `LocalBucket` serves the same lookups from a local directory: a
+    copy of the bucket (say, the directory `backup.sh` syncs to the
+    bucket) or a stand-in in tests.
+"""
+
+import json
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+S3_NS = {'s3': 'http://s3.amazonaws.com/doc/2006-03-01/'}
+
+
+class S3Bucket:
+    """ A public S3 bucket accessed over HTTP. """
+    def __init__(self, url, concurrency=8):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        self.session.mount(self.url, requests.adapters.HTTPAdapter(
+            pool_maxsize=concurrency))
+
+    def list(self, prefix):
+        """ Keys of objects with the given prefix. Raises
+            requests.HTTPError if the bucket can't be listed.
+        """
+        keys = []
+        params = {'list-type': 2, 'prefix': prefix}
+        while True:
+            r = self.session.get(self.url + '/', params=params)
+            r.raise_for_status()
+            root = ET.fromstring(r.content)
+            for key in root.findall('s3:Contents/s3:Key', S3_NS):
+                keys.append(key.text)
+            if root.findtext('s3:IsTruncated', '', S3_NS) != 'true':
+                return keys
+            params['continuation-token'] = root.findtext(
+                's3:NextContinuationToken', '', S3_NS)
+
+    def exists(self, key):
+        r = self.session.head('{}/{}'.format(self.url, key))
+        return r.status_code == 200
+
+    def close(self):
+        self.session.close()
+
+
+class LocalBucket:
+    """ A local directory with the same layout as the bucket. """
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def list(self, prefix):
+        directory, name_prefix = os.path.split(prefix)
+        try:
+            filenames = os.listdir(os.path.join(self.root_dir, directory))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(directory, filename) for filename in filenames
+                if filename.startswith(name_prefix)]
+
+    def exists(self, key):
+        return os.path.isfile(os.path.join(self.root_dir, key))
+
+    def close(self):
+        pass
+
+
+class ArtifactIndex:
+    """ Tells whether a job has an artifact in the bucket.
+
+        The `artifacts/<run_id>/` prefix is listed once per workflow
+        run in a pool of `concurrency` threads: call `prefetch()`
+        with workflow runs of interest to list them in background.
+        If the bucket does not allow listing, the lookup falls back
+        to a HEAD request per job.
+
+        Results are cached in `cache_dir` (if set) for `ttl`
+        seconds: an artifact may appear in the bucket later than the
+        job is fetched.
+    """
+    def __init__(self, bucket, repo_path, cache_dir=None, ttl=6 * 3600,
+                 concurrency=8):
+        self.bucket = bucket
+        self.repo_path = repo_path
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.lock = threading.Lock()
+        self.listings = {}
+        self.can_list = True
+
+    def key(self, run_id, job_id):
+        return '{}/artifacts/{}/{}.zip'.format(self.repo_path, run_id, job_id)
+
+    def cache_path(self, name):
+        return os.path.join(self.cache_dir, '{}.json'.format(name))
+
+    def load(self, name):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.cache_path(name), 'r') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if time.time() - entry['time'] > self.ttl:
+            return None
+        return entry['value']
+
+    def store(self, name, value):
+        if not self.cache_dir:
+            return
+        path = self.cache_path(name)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(),
+                                         threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump({'time': time.time(), 'value': value}, f)
+        os.replace(tmp_path, path)
+
+    def list_run(self, run_id):
+        """ Set of artifact keys of a workflow run or None if the
+            bucket can't be listed.
+        """
+        keys = self.load(run_id)
+        if keys is not None:
+            return set(keys)
+        if not self.can_list:
+            return None
+        prefix = '{}/artifacts/{}/'.format(self.repo_path, run_id)
+        try:
+            keys = self.bucket.list(prefix)
+        except requests.HTTPError as e:
+            if e.response.status_code not in (403, 405):
+                raise
+            self.can_list = False
+            return None
+        self.store(run_id, keys)
+        return set(keys)
+
+    def listing(self, run_id):
+        with self.lock:
+            future = self.listings.get(run_id)
+            if future is None:
+                future = self.executor.submit(self.list_run, run_id)
+                self.listings[run_id] = future
+            return future
+
+    def prefetch(self, run_ids):
+        """ Start listing artifacts of the workflow runs. """
+        for run_id in run_ids:
+            self.listing(run_id)
+
+    def has_artifact(self, run_id, job_id):
+        keys = self.listing(run_id).result()
+        key = self.key(run_id, job_id)
+        if keys is not None:
+            return key in keys
+
+        name = '{}.{}'.format(run_id, job_id)
+        exists = self.load(name)
+        if exists is None:
+            exists = self.bucket.exists(key)
+            self.store(name, exists)
+        return exists
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.bucket.close()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+""" A long-running multivac service.
+
+    Instead of starting `fetch.py` per branch and `gather_data.py`
+    from cron, the daemon keeps one process with warm state: the HTTP
+    session to GitHub, the cache of API responses, the job index, the
+    compiled failure matchers and the InfluxDB writer.
+
+    Each `--interval` seconds it fetches new workflow runs of the
+    given branches and, with `--gather`, writes data of the new jobs
+    to InfluxDB (like `gather_data.py --incremental`).
+
+    The daemon is controlled over a unix socket: a client sends a
+    command line and reads a JSON line in response. Commands:
+
+        status              The daemon state.
+        poll                Poll the branches now.
+        last-seen [html]    Generate the 'last seen' report of the
+                            branches (needs LOG_STORAGE_BUCKET_URL).
+        stop                Stop the daemon.
+
+    Say, `echo poll | nc -U .cache/multivac.sock`.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_DIR)
+from multivac.fetch import Fetcher, info, rate_limiter  # noqa: E402
+from multivac.gather_data import GatherData  # noqa: E402
+from multivac.last_seen import LastSeenReport, write_report  # noqa: E402
+
+DEFAULT_SOCKET = '.cache/multivac.sock'
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            command = line.decode('utf-8', errors='replace').split()
+            if not command:
+                continue
+            response = self.server.daemon.handle_command(command)
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class ControlServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, daemon):
+        self.daemon = daemon
+        super().__init__(socket_path, ControlHandler)
+
+
+class Daemon:
+    """ Polls the branches of a repository each `interval` seconds and
+        serves commands from the control socket.
+
+        Polls and reports are serialized: a command waits until a
+        poll in progress is finished.
+    """
+    def __init__(self, repo_path, branches, token, interval=7200,
+                 socket_path=DEFAULT_SOCKET, gather=False, bucket_url=None,
+                 concurrency=4):
+        self.repo_path = repo_path
+        self.branches = branches
+        self.interval = interval
+        self.socket_path = socket_path
+        self.gather = gather
+        self.bucket_url = bucket_url
+        self.fetcher = Fetcher(repo_path, token, concurrency=concurrency,
+                               incremental=True)
+        # The fetcher keeps the index up to date.
+        self.job_index = self.fetcher.job_index
+        self.job_index.update()
+        self.influx_writer = None
+        if gather:
+            self.influx_writer = self.new_influx_writer()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.server = None
+        self.polls = 0
+        self.last_poll = None
+        self.last_error = None
+
+    def poll(self):
+        """ Fetch new data of the branches and write it to InfluxDB. """
+        with self.lock:
+            started = time.time()
+            try:
+                # Runs of all the branches are listed at once.
+                self.fetcher.fetch(self.branches)
+                if self.stopping.is_set():
+                    return
+                if self.gather:
+                    self.gather_data()
+            except Exception:
+                self.last_error = traceback.format_exc()
+                raise
+            else:
+                self.last_error = None
+            finally:
+                self.polls += 1
+                self.last_poll = started
+            info('Poll is finished in {:.0f} seconds, GitHub API rate '
+                 'limit: {}', time.time() - started, rate_limiter.status())
+
+    @staticmethod
+    def new_influx_writer():
+        from multivac.influxdb import InfluxWriter
+
+        return InfluxWriter(os.environ['INFLUX_ORG'])
+
+    def gather_data(self):
+        gather_data = GatherData(
+            self.repo_path, output_format='influxdb', tests=True,
+            incremental=True, job_index=self.job_index,
+            influx_writer=self.influx_writer)
+        try:
+            gather_data.gather_data()
+            gather_data.write_result()
+        except Exception:
+            # The writer may hold an error of a failed write: start
+            # over with a new one, so the next poll may write again.
+            writer, self.influx_writer = \
+                self.influx_writer, self.new_influx_writer()
+            try:
+                writer.close()
+            except Exception:
+                pass
+            raise
+        finally:
+            gather_data.close()
+
+    def last_seen(self, result_format='csv'):
+        if not self.bucket_url:
+            raise RuntimeError('LOG_STORAGE_BUCKET_URL not set')
+        with self.lock:
+            cache_dir = os.path.join('.cache', 'last_seen', self.repo_path)
+            # Don't fork: the process has fetch, InfluxDB and control
+            # socket threads.
+            report = LastSeenReport(
+                self.repo_path, self.branches, self.bucket_url,
+                workers=os.cpu_count(), cache_dir=cache_dir,
+                job_index=self.job_index,
+                mp_context=multiprocessing.get_context('spawn'))
+            report.collect()
+            return write_report(report, result_format)
+
+    def status(self):
+        return {
+            'repo_path': self.repo_path,
+            'branches': self.branches,
+            'polls': self.polls,
+            'last_poll': self.last_poll,
+            'last_error': self.last_error,
+            'polling': self.lock.locked(),
+            'job_index_generation': self.job_index.generation,
+            'rate_limit': rate_limiter.status(),
+        }
+
+    def handle_command(self, command):
+        """ Execute a control command (a list of words). Returns a
+            JSON-serializable response.
+        """
+        name, params = command[0], command[1:]
+        try:
+            if name == 'status':
+                return {'ok': True, 'status': self.status()}
+            if name == 'poll':
+                self.wakeup.set()
+                return {'ok': True}
+            if name == 'last-seen':
+                result_format = params[0] if params else 'csv'
+                return {'ok': True, 'path': self.last_seen(result_format)}
+            if name == 'stop':
+                self.stop()
+                return {'ok': True}
+            return {'ok': False, 'error': 'Unknown command: {}'.format(name)}
+        except Exception as e:
+            return {'ok': False, 'error': str(e)}
+
+    def serve(self):
+        """ Start serving the control socket in a background thread. """
+        directory = os.path.dirname(self.socket_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = ControlServer(self.socket_path, self)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='control-socket', daemon=True)
+        thread.start()
+
+    def run(self):
+        """ Poll till `stop()`. A failed poll is reported and retried
+            on the next tick.
+        """
+        while not self.stopping.is_set():
+            try:
+                self.poll()
+            except Exception:
+                print(self.last_error, file=sys.stderr)
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            os.remove(self.socket_path)
+        if self.influx_writer:
+            self.influx_writer.close()
+        self.fetcher.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Poll GitHub Actions data in a long-running process')
+    parser.add_argument('--branch', type=str, action='append', required=True,
+                        help='branch (may be passed several times)')
+    parser.add_argument('--interval', type=int, default=7200,
+                        help='seconds between polls (default: 7200)')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET,
+                        help='control socket path (default: {})'.format(
+                            DEFAULT_SOCKET))
+    parser.add_argument('--gather', action='store_true',
+                        help='write data of new jobs to InfluxDB after each '
+                             'poll')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='how many workflow runs and how many logs are '
+                             'downloaded simultaneously')
+    parser.add_argument('repo_path', type=str,
+                        help='owner/repository')
+    args = parser.parse_args(argv)
+
+    token = os.getenv('MULTIVAC_GITHUB_TOKEN')
+    assert token, 'MULTIVAC_GITHUB_TOKEN is not set in environ variables'
+    bucket_url = os.getenv('LOG_STORAGE_BUCKET_URL', '').strip("'") or None
+
+    daemon = Daemon(args.repo_path, args.branch, token,
+                    interval=args.interval, socket_path=args.socket,
+                    gather=args.gather, bucket_url=bucket_url,
+                    concurrency=args.concurrency)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: daemon.stop())
+    daemon.serve()
+    try:
+        daemon.run()
+    finally:
+        daemon.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,12 @@
 
 import glob
 import os
+import sys
 
-from sensors.failures import specific_failures, generic_failures
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_DIR)
+from multivac.sensors.failures import specific_failures  # noqa: E402
+from multivac.sensors.failures import generic_failures  # noqa: E402
 
 log_examples_path = 'docs/gather_job_data/'
 
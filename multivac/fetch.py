@@ -4,55 +4,319 @@ import os
 import re
 import sys
 import argparse
+import atexit
 import time
-import requests
 import json
 import datetime
+import email.utils
+import hashlib
+import random
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_DIR)
+from multivac import log_steps, metas, storage  # noqa: E402
+from multivac.job_index import JobIndex  # noqa: E402
+from multivac.sensor_store import LOG_CHECKSUM  # noqa: E402
+from multivac.sensor_store import SensorStore, fingerprint  # noqa: E402
+
+# Debug log of HTTP requests, opened on the first message.
+debug_log_path = 'debug.log'
+# Logs are downloaded and written by chunks of this size.
+LOG_CHUNK_SIZE = 256 * 1024
+# How long after creation a workflow run is re-checked for re-runs
+# by `fetch.py --incremental`.
+DEFAULT_RERUN_WINDOW = datetime.timedelta(days=3)
+# GitHub lists at most this number of workflow runs of a filtered query.
+FILTERED_LIST_LIMIT = 1000
+debug_log_fh = None
+debug_log_lock = threading.Lock()
+
+
+class RateLimiter:
+    """ Paces GitHub API requests according to the rate limit.
+
+        Tracks the X-RateLimit-Limit, X-RateLimit-Remaining and
+        X-RateLimit-Reset response headers. While the remaining
+        budget is large, requests are not delayed. When it drops
+        below `pace_below` of the limit, requests are spread evenly
+        over the time left till the reset, so several crawlers
+        sharing one token don't exhaust it at once. When the budget
+        is exhausted, requests wait for the reset.
+
+        Thread safe: concurrent requests reserve consecutive time
+        slots.
+    """
+    def __init__(self, pace_below=0.2):
+        self.pace_below = pace_below
+        self.lock = threading.Lock()
+        self.limit = None
+        self.remaining = None
+        self.used = None
+        self.reset = None
+        # Unix time the next request may be sent at.
+        self.not_before = 0.0
+
+    def interval(self, now):
+        """ Delay between requests to spread the remaining budget
+            over the time left till the reset.
+        """
+        if self.remaining is None or self.reset is None:
+            return 0.0
+        left = self.reset - now
+        if left <= 0:
+            return 0.0
+        if self.remaining <= 0:
+            return left + 1
+        if self.remaining >= self.limit * self.pace_below:
+            return 0.0
+        return left / self.remaining
+
+    def wait(self):
+        """ Block until a next request is allowed. """
+        with self.lock:
+            now = time.time()
+            start = max(now, self.not_before)
+            self.not_before = start + self.interval(start)
+            if self.remaining is not None:
+                self.remaining -= 1
+        if start > now:
+            time.sleep(start - now)
+
+    def update(self, response):
+        """ Track the rate limit headers of a response. """
+        headers = response.headers
+        if 'X-RateLimit-Remaining' not in headers:
+            return
+        with self.lock:
+            self.limit = int(headers['X-RateLimit-Limit'])
+            self.remaining = int(headers['X-RateLimit-Remaining'])
+            self.used = int(headers.get('X-RateLimit-Used', 0))
+            self.reset = int(headers['X-RateLimit-Reset'])
+            if self.remaining <= 0:
+                self.not_before = max(self.not_before, self.reset + 1)
+
+    def retry_delay(self, response, attempt=0):
+        """ How long to wait before retrying a request rejected due
+            to a rate limit. None if the response is not about a rate
+            limit. `attempt` is the number of rate limit waits before
+            for a backoff if the response doesn't say how long to
+            wait.
+
+            https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api
+        """
+        if response.status_code not in (403, 429):
+            return None
+        # Secondary rate limit.
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            delay = parse_retry_after(retry_after)
+            if delay is None:
+                return backoff_delay(attempt)
+            return delay
+        # Primary rate limit: wait for the reset.
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            reset = int(response.headers['X-RateLimit-Reset'])
+            return max(reset - time.time(), 0) + 1
+        # Secondary rate limit without Retry-After: GitHub asks to
+        # wait at least a minute.
+        if 'secondary rate limit' in response.text:
+            return 60
+        return None
+
+    def status(self):
+        if self.reset is None:
+            return 'unknown'
+        reset = datetime.datetime.fromtimestamp(self.reset,
+                                                datetime.timezone.utc)
+        return '{} of {} requests remaining, reset at {}'.format(
+            self.remaining, self.limit, reset.isoformat())
+
+
+rate_limiter = RateLimiter()
+
+
+def parse_retry_after(value):
+    """ Seconds to wait by the Retry-After header: a number of seconds
+        or an HTTP date. None if it can't be parsed.
+    """
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+# Entries of the cache of API responses not used for this time are
+# removed.
+HTTP_CACHE_MAX_AGE = datetime.timedelta(days=7)
+
+
+class HTTPCache:
+    """ On-disk cache of JSON API responses.
+
+        A response is stored with its validators (the ETag and
+        Last-Modified headers). The next request to the same URL
+        sends them in If-None-Match and If-Modified-Since headers
+        and, if the resource is not changed, GitHub responds with
+        304 Not Modified without a body. Such responses are not
+        counted against the primary rate limit. The body is
+        restored from the cache then.
+
+        Only responses, which are requested again and again, are
+        worth caching: the workflow run lists (see `http_get()`).
+        Entries not used for `max_age` are removed by `prune()`.
+
+        https://docs.github.com/en/rest/using-the-rest-api/best-practices-for-using-the-rest-api#use-conditional-requests-if-appropriate
+    """
+    # Response headers to restore on 304.
+    headers_to_keep = ('Content-Type', 'ETag', 'Last-Modified', 'Link')
+
+    def __init__(self, cache_dir, max_age=HTTP_CACHE_MAX_AGE):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, url, params):
+        key = json.dumps([url, params], sort_keys=True)
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, '{}.json'.format(digest))
+
+    def load(self, url, params):
+        path = self.path(url, params)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+            # The entry is used: keep it from pruning.
+            os.utime(path)
+            return entry
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def prune(self):
+        """ Remove entries (and leftover temporary files) not used
+            for `max_age`.
+        """
+        deadline = time.time() - self.max_age.total_seconds()
+        for entry in os.scandir(self.cache_dir):
+            try:
+                if entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def store(self, url, params, response):
+        headers = {name: response.headers[name]
+                   for name in self.headers_to_keep
+                   if name in response.headers}
+        if 'ETag' not in headers and 'Last-Modified' not in headers:
+            return
+        entry = {
+            'url': url,
+            'headers': headers,
+            'body': response.text,
+        }
+        path = self.path(url, params)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(),
+                                         threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def validators(entry):
+        """ Request headers for a conditional request. """
+        headers = {}
+        if 'ETag' in entry['headers']:
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if 'Last-Modified' in entry['headers']:
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        return headers
+
+    @staticmethod
+    def restore(response, entry):
+        """ Turn a 304 response into the cached 200 one. """
+        response.status_code = 200
+        response._content = entry['body'].encode()
+        response.encoding = 'utf-8'
+        response.headers.update(entry['headers'])
+
+
+class FetchCursors:
+    """ Per-branch cursors of the incremental traversal (see
+        `Fetcher.fetch()`): creation time of workflow runs all the
+        earlier ones are fetched by. A JSON file per branch, so
+        processes fetching different branches don't interfere.
+    """
+    def __init__(self, cursor_dir):
+        self.cursor_dir = cursor_dir
+
+    def path(self, branch):
+        # `*` can't be in a branch name: it means all the branches.
+        return os.path.join(self.cursor_dir, '{}.json'.format(
+            urllib.parse.quote(branch or '*', safe='')))
+
+    def load(self, branch):
+        try:
+            with open(self.path(branch), 'r') as f:
+                return parse_time(json.load(f)['created'])
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def store(self, branch, created):
+        path = self.path(branch)
+        if not os.path.isdir(self.cursor_dir):
+            os.makedirs(self.cursor_dir)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'created': format_time(created)}, f)
+        os.replace(tmp_path, path)
 
-parser = argparse.ArgumentParser(description='Download GitHub Actions logs')
-parser.add_argument('--branch', type=str,
-                    help='branch (all if omitted)')
-parser.add_argument('--nologs', action='store_true',
-                    help="Don't download logs")
-parser.add_argument('--nostop', action='store_true',
-                    help="Continue till end or rate limit")
-parser.add_argument('--since', type=int, default=1,
-                    help="A workflow run list page to start from it")
-parser.add_argument('repo_path', type=str,
-                    help='owner/repository')
-args = parser.parse_args()
-if '/' not in args.repo_path:
-    raise ValueError('repo_path must be in the form owner/repository')
-args.owner, args.repo = args.repo_path.split('/', 1)
-
-token = os.getenv('MULTIVAC_GITHUB_TOKEN')
-assert token, 'MULTIVAC_GITHUB_TOKEN is not set in environ variables'
-
-pid = os.getpid()
-startup_time = datetime.datetime.now(datetime.timezone.utc)
-session = requests.Session()
-session.headers.update({
-    'Accept': 'application/vnd.github.v3+json',
-    'Authorization': 'token ' + token,
-})
-debug_log_fh = open('debug.log', 'a')
-workflow_runs_dir = f'{args.repo_path}/workflow_runs'
-workflow_run_jobs_dir = f'{args.repo_path}/workflow_run_jobs'
+
+def backoff_delay(attempt, base=0.5, cap=60):
+    """ Exponential backoff with full jitter. """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
 
 
 def retry(http_get_function):
+    """ Retry on 5xx errors with an exponential backoff and wait
+        for the rate limit (see `RateLimiter.retry_delay()`).
+        Waits for the rate limit don't count as attempts.
+    """
     def wrapper(*args, **kwargs):
+        import requests
+
         attempts = 10
+        rate_limit_waits = 0
         while attempts:
             try:
                 return http_get_function(*args, **kwargs)
             except requests.exceptions.HTTPError as HTTPError:
-                if HTTPError.response.status_code // 100 == 4:
+                response = HTTPError.response
+                delay = rate_limiter.retry_delay(response, rate_limit_waits)
+                if delay is not None:
+                    rate_limit_waits += 1
+                    info('Rate limit exceeded ({}), wait for {:.0f} seconds',
+                         rate_limiter.status(), delay)
+                    time.sleep(delay)
+                    continue
+                if response.status_code // 100 == 4:
                     raise
                 attempts -= 1
-                time.sleep(0.5)
-                debug(f'Got {HTTPError.response.status_code} error. '
-                      f'{attempts}th attempt to retry...')
+                delay = backoff_delay(10 - attempts)
+                debug(f'Got {response.status_code} error. '
+                      f'{attempts} attempts to retry left, '
+                      f'wait for {delay:.1f} seconds...')
+                time.sleep(delay)
         raise StopIteration(
             "All 10 retry operation attempts exhausted.")
 
@@ -64,52 +328,35 @@ def timestamp():
     return datetime.datetime.now(datetime.timezone.utc).isoformat()
 
 
-def debug(fmt, *args):
-    print('[{}] {} {}'.format(pid, timestamp(), fmt.format(*args)),
-          file=debug_log_fh)
+def parse_time(time_str):
+    """ Parse a time of the GitHub API: 2021-06-10T12:28:18Z. """
+    return datetime.datetime.fromisoformat(time_str.rstrip('Z') + '+00:00')
 
 
-def info(fmt, *args):
-    debug(fmt, *args)
-    print(fmt.format(*args), file=sys.stderr)
-
+def format_time(time):
+    return time.astimezone(datetime.timezone.utc).strftime(
+        '%Y-%m-%dT%H:%M:%SZ')
 
-@retry
-def http_get(url, params=None):
-    """ HTTP GET with logging to debug.log.
 
-        Raise on a bad HTTP status.
-    """
-    debug('HTTP GET: {}', url)
-
-    r = session.get(url, params=params)
-
-    debug('Response HTTP status: {}', r.status_code)
-    debug('Response headers:\n{}', json.dumps(dict(r.headers), indent=2))
-    content_type = r.headers.get('content-type')
-    if content_type:
-        if content_type.startswith('application/json'):
-            response_text = json.dumps(r.json(), indent=2)
-        elif content_type == 'application/zip' or content_type.startswith('text/plain'):
-            fmt = '[Don\'t log {} response.]'
-            response_text = fmt.format(content_type)
-        else:
-            fmt = '[Don\'t log response with unknown Content-Type: {}]'
-            response_text = fmt.format(content_type)
-        if r.status_code != 404:
-            r.raise_for_status()
-        else:
-            info(f"======================ERROR 404 FOR URL======================\n{url}")
-    else:
-        response_text = '[EMPTY LOG!]'
+def debug(fmt, *args):
+    global debug_log_fh
+    with debug_log_lock:
+        if debug_log_fh is None:
+            debug_log_fh = open(debug_log_path, 'a')
+            atexit.register(debug_log_fh.close)
+        print('[{}] {} {}'.format(os.getpid(), timestamp(),
+                                  fmt.format(*args)),
+              file=debug_log_fh)
 
-    debug('Response:\n{}', response_text)
 
-    return r
+def info(fmt, *args):
+    debug(fmt, *args)
+    print(fmt.format(*args), file=sys.stderr)
 
 
 class WorkflowRun:
-    def __init__(self, data=None, filepath=None):
+    def __init__(self, fetcher, data=None, filepath=None):
+        self.fetcher = fetcher
         if data:
             self._data = data
         elif filepath:
@@ -139,23 +386,43 @@ class WorkflowRun:
         """
         return self._data['conclusion']
 
+    @property
+    def head_branch(self):
+        return self._data['head_branch']
+
     @property
     def meta(self):
         return self._data
 
     @property
     def meta_path(self):
-        return os.path.join(workflow_runs_dir, self.id + '.json')
+        """ Path to the stored meta or None. """
+        try:
+            return metas.find_meta(self.fetcher.workflow_runs_dir, self.id)
+        except FileNotFoundError:
+            return None
 
     @property
     def created_at(self):
-        created_at_str = self._data['created_at'].rstrip('Z') + '+00:00'
-        return datetime.datetime.fromisoformat(created_at_str)
+        return parse_time(self._data['created_at'])
 
     @property
     def updated_at(self):
-        updated_at_str = self._data['updated_at'].rstrip('Z') + '+00:00'
-        return datetime.datetime.fromisoformat(updated_at_str)
+        return parse_time(self._data['updated_at'])
+
+    @property
+    def stored_updated_at(self):
+        """ `updated_at` of the stored meta or None if it is not
+            stored. The job index is asked first: it is cheaper than
+            reading the meta.
+        """
+        updated_at = self.fetcher.job_index.run_updated_at(self.id)
+        if updated_at is None:
+            path = self.meta_path
+            if path is None:
+                return None
+            updated_at = metas.load_meta(path)['updated_at']
+        return parse_time(updated_at)
 
     @property
     def is_stored(self):
@@ -164,23 +431,26 @@ class WorkflowRun:
             It does not check whether all jobs and logs are stored
             as well.
         """
-        return os.path.isfile(self.meta_path)
+        return self.meta_path is not None
 
     def store(self):
-        info('Write {}', self.meta_path)
-        with open(self.meta_path, 'w') as f:
-            json.dump(self._data, f, indent=2)
+        path = metas.write_meta(self.fetcher.workflow_runs_dir, self.id,
+                                self._data, metas.RUN_FIELDS,
+                                self.fetcher.raw_metas)
+        info('Written {}', path)
 
     def load(self, filepath):
         info('Read {}', filepath)
-        with open(filepath, 'r') as f:
-            self._data = json.load(f)
+        self._data = metas.load_meta(filepath)
 
 
 class WorkflowRunJob:
-    def __init__(self, data):
+    def __init__(self, fetcher, data):
+        self.fetcher = fetcher
         self._data = data
-        self.log = None
+        # (log fingerprint, {name: (version, value)}) of the downloaded
+        # log for the sensor store.
+        self.log_results = None
 
     @property
     def id(self):
@@ -208,41 +478,71 @@ class WorkflowRunJob:
         return self._data
 
     @property
-    def meta_path(self):
-        return os.path.join(workflow_run_jobs_dir, self.id + '.json')
+    def log_name(self):
+        """ Path to the stored log relative to the jobs directory or
+            None.
+        """
+        jobs_dir = self.fetcher.workflow_run_jobs_dir
+        try:
+            return os.path.relpath(storage.find_log(jobs_dir, self.id),
+                                   jobs_dir)
+        except FileNotFoundError:
+            return None
 
     @property
-    def log_path(self):
-        return os.path.join(workflow_run_jobs_dir, self.id + '.log')
+    def has_log(self):
+        return self.log_name is not None
 
     @property
     def log_url(self):
         url_fmt = 'https://api.github.com/repos/{}/{}/actions/jobs/{}/logs'
-        return url_fmt.format(args.owner, args.repo, self.id)
+        return url_fmt.format(self.fetcher.owner, self.fetcher.repo, self.id)
 
     @property
     def is_stored(self):
-        if not os.path.isfile(self.meta_path):
+        try:
+            metas.find_meta(self.fetcher.workflow_run_jobs_dir, self.id)
+        except FileNotFoundError:
             return False
-        if not args.nologs and not os.path.isfile(self.log_path):
+        if not self.fetcher.nologs and not self.has_log:
             return False
         return True
 
     def download_log(self):
+        """ Download the log straight to the disk (see
+            `storage.LogWriter`) and index its steps on the way. An
+            empty log is not stored.
+        """
         url = self.log_url
         info('Download {}', url)
-        r = http_get(url)
-        self.log = r.content
+        r = self.fetcher.http_get(url, stream=True)
+        writer = storage.LogWriter(self.fetcher.workflow_run_jobs_dir,
+                                   self.id, self.fetcher.log_compression)
+        index_builder = log_steps.IndexBuilder()
+        try:
+            for chunk in r.iter_content(LOG_CHUNK_SIZE):
+                writer.write(chunk)
+                index_builder.feed(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            r.close()
+        if not writer.size:
+            writer.abort()
+            return
+        log_path = writer.close()
+        info('Written {}', log_path)
+        self.log_results = (fingerprint(log_path), {
+            log_steps.SENSOR: (log_steps.version(), index_builder.finish()),
+            LOG_CHECKSUM: ('sha256', writer.sha256.hexdigest()),
+        })
 
     def store(self):
-        info('Write {}', self.meta_path)
-        with open(self.meta_path, 'w') as f:
-            json.dump(self._data, f, indent=2)
-
-        if self.log:
-            info('Write {}', self.log_path)
-            with open(self.log_path, 'wb') as f:
-                f.write(self.log)
+        path = metas.write_meta(self.fetcher.workflow_run_jobs_dir, self.id,
+                                self._data, metas.JOB_FIELDS,
+                                self.fetcher.raw_metas)
+        info('Written {}', path)
 
 
 def workflow_runs_download_info(pages, pages_all, obj_count, obj_total, url,
@@ -253,7 +553,7 @@ def workflow_runs_download_info(pages, pages_all, obj_count, obj_total, url,
     # GitHub does not allow to download workflow runs beyond first
     # 1000, when branch is passed. It seems, it is the limitation
     # for search requests.
-    if branch is not None:
+    if branch is not None or 'created' in params:
         if isinstance(pages_all, int):
             pages_all = min(pages_all, 1000 // per_page)
         if isinstance(obj_total, int):
@@ -273,46 +573,6 @@ def workflow_runs_page_info(response):
     info('Workflow run IDs on this page: {}', ids)
 
 
-def download_workflow_runs(branch=None, since=1):
-    """ Download and yield workflow runs metainformation from
-        fresh ones toward older ones.
-    """
-    params = {
-        # 100 is the maximum.
-        'per_page': 100,
-        'branch': branch,
-    }
-    url = 'https://api.github.com/repos/{}/{}/actions/runs?page={}'.format(
-        args.owner, args.repo, since)
-    workflow_runs_download_info(0, '??', 0, '??', url, params)
-    r = http_get(url, params=params)
-    workflow_runs_page_info(r)
-
-    run_count = 0
-    for data in r.json()['workflow_runs']:
-        run_count += 1
-        yield WorkflowRun(data=data)
-
-    pages_all = '??'
-    last_url = r.links['last']['url']
-    pages_all_match = re.search(r'[^_]page=(\d+)', last_url)
-    if pages_all_match:
-        pages_all = int(pages_all_match.group(1))
-
-    pages = since
-    while 'next' in r.links:
-        next_url = r.links['next']['url']
-        run_total = r.json()['total_count']
-        workflow_runs_download_info(pages, pages_all, run_count, run_total,
-                                    next_url, params)
-        r = http_get(next_url, params=params)
-        workflow_runs_page_info(r)
-        for data in r.json()['workflow_runs']:
-            run_count += 1
-            yield WorkflowRun(data=data)
-        pages += 1
-
-
 def workflow_run_jobs_page_info(response):
     """ Show information about workflow run jobs search response:
         the list of job IDs.
@@ -323,99 +583,591 @@ def workflow_run_jobs_page_info(response):
     info('Workflow run job IDs: {}', ids)
 
 
-def download_workflow_run_jobs(workflow_run_id):
-    """ Download and yield workflow run jobs metainformation for
-        given workflow run. An object for each (re)run.
+class WorkflowRunPipeline:
+    """ Processes workflow runs (see `Fetcher.process_workflow_run()`)
+        concurrently.
+
+        At most `concurrency` workflow runs are processed at once,
+        `submit()` blocks when the limit is reached. At most
+        `concurrency` logs are downloaded at once. The first error
+        is re-raised from `submit()` or `close()`.
     """
-    params = {
-        # 100 is the maximum.
-        'per_page': 100,
-        # Download all jobs, not only the latest one.
-        'filter': 'all',
-    }
-    url = 'https://api.github.com/repos/{}/{}/actions/runs/{}/jobs'.format(
-        args.owner, args.repo, workflow_run_id)
-    info('Download {}', url)
-    r = http_get(url, params=params)
-    workflow_run_jobs_page_info(r)
+    def __init__(self, fetcher, concurrency):
+        self.fetcher = fetcher
+        self.concurrency = concurrency
+        self.run_executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.log_executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.pending = {}
+
+    def reap(self, block):
+        if not self.pending:
+            return
+        done, _ = wait(self.pending.values(), timeout=None if block else 0,
+                       return_when=FIRST_COMPLETED)
+        for run_id, future in list(self.pending.items()):
+            if future in done:
+                del self.pending[run_id]
+                # Re-raise an error if any.
+                future.result()
+
+    def submit(self, run):
+        # The same workflow run may appear twice in the list: wait
+        # until the previous processing is finished.
+        if run.id in self.pending:
+            self.pending.pop(run.id).result()
+        self.reap(block=False)
+        while len(self.pending) >= self.concurrency:
+            self.reap(block=True)
+        self.pending[run.id] = self.run_executor.submit(
+            self.fetcher.process_workflow_run, run, self.log_executor)
+
+    def close(self):
+        try:
+            while self.pending:
+                self.reap(block=True)
+        finally:
+            self.run_executor.shutdown(cancel_futures=True)
+            self.log_executor.shutdown(cancel_futures=True)
+
+
+def new_session(token, concurrency=4):
+    """ HTTP session to the GitHub API. """
+    import requests
+
+    session = requests.Session()
+    # Allow a keep-alive connection per each concurrent request.
+    session.mount('https://', requests.adapters.HTTPAdapter(
+        pool_maxsize=concurrency * 2))
+    session.headers.update({
+        'Accept': 'application/vnd.github.v3+json',
+        'Authorization': 'token ' + token,
+    })
+    return session
+
+
+class Fetcher:
+    """ Downloads workflow runs, jobs and logs of a repository and
+        stores them in the `<owner>/<repo>/` directory.
+
+        The HTTP session, the cache of API responses and the job
+        index are kept open, so a fetcher may be reused for several
+        `fetch()` calls. Call `close()` at the end.
+
+        Fetchers of several repositories may share one HTTP session
+        (see `session`): it is not closed by `close()` then.
+    """
+    def __init__(self, repo_path, token, branches=None, nologs=False,
+                 nostop=False, since=1, concurrency=4, http_cache=True,
+                 log_compression=storage.DEFAULT_COMPRESSION,
+                 log_bodies=False, raw_metas=False, incremental=False,
+                 rerun_window=DEFAULT_RERUN_WINDOW, session=None):
+        if '/' not in repo_path:
+            raise ValueError('repo_path must be in the form owner/repository')
+        if concurrency < 1:
+            raise ValueError('--concurrency must be positive')
+
+        self.repo_path = repo_path
+        self.owner, self.repo = repo_path.split('/', 1)
+        self.branches = branches
+        self.nologs = nologs
+        self.nostop = nostop
+        self.since = since
+        self.concurrency = concurrency
+        self.log_compression = log_compression
+        self.log_bodies = log_bodies
+        self.raw_metas = raw_metas
+        self.incremental = incremental
+        self.rerun_window = rerun_window
+        self.cursors = FetchCursors(os.path.join('.cache', 'fetch',
+                                                 repo_path))
+        self.own_session = session is None
+        self.session = session or new_session(token, concurrency)
+        self.http_cache = HTTPCache('.cache/http') if http_cache else None
+        self.workflow_runs_dir = f'{repo_path}/workflow_runs'
+        self.workflow_run_jobs_dir = f'{repo_path}/workflow_run_jobs'
+        self.job_index = JobIndex(repo_path)
+        self.sensor_store = SensorStore(repo_path)
+
+    @retry
+    def http_get(self, url, params=None, cache=False, stream=False):
+        """ HTTP GET with logging to debug.log. Response bodies are
+            logged only if `log_bodies` is set.
+
+            JSON responses are cached if `cache` is set, see
+            `HTTPCache`. If `stream` is set, the body of other
+            responses is not read, see
+            `requests.Response.iter_content()`.
+
+            Raise on a bad HTTP status.
+        """
+        http_cache = self.http_cache if cache else None
+        entry = None
+        if http_cache:
+            entry = http_cache.load(url, params)
+        headers = HTTPCache.validators(entry) if entry else None
+
+        rate_limiter.wait()
+        debug('HTTP GET: {}', url)
+
+        r = self.session.get(url, params=params, headers=headers,
+                             stream=stream)
+        rate_limiter.update(r)
+
+        debug('Response HTTP status: {}', r.status_code)
+        if r.status_code == 304 and entry:
+            HTTPCache.restore(r, entry)
+            debug('Not modified, use the cached response')
+        elif r.status_code == 200 and http_cache and r.headers.get(
+                'content-type', '').startswith('application/json'):
+            http_cache.store(url, params, r)
+        debug('Response headers:\n{}', json.dumps(dict(r.headers), indent=2))
+        content_type = r.headers.get('content-type')
+        if content_type:
+            if not self.log_bodies:
+                fmt = '[Don\'t log {} response, see --log-bodies.]'
+                response_text = fmt.format(content_type)
+            elif content_type.startswith('application/json'):
+                response_text = r.text
+            elif content_type == 'application/zip' or content_type.startswith('text/plain'):
+                fmt = '[Don\'t log {} response.]'
+                response_text = fmt.format(content_type)
+            else:
+                fmt = '[Don\'t log response with unknown Content-Type: {}]'
+                response_text = fmt.format(content_type)
+            if r.status_code != 404:
+                r.raise_for_status()
+            else:
+                info(f"======================ERROR 404 FOR URL======================\n{url}")
+        else:
+            response_text = '[EMPTY LOG!]'
 
-    # Assume that nobody will rerun a workflow run more than 100
-    # times. So we can download only the first page.
+        debug('Response:\n{}', response_text)
 
-    for data in r.json()['jobs']:
-        yield WorkflowRunJob(data)
+        return r
 
+    def download_workflow_runs(self, branch=None, since=1, created=None):
+        """ Download and yield workflow runs metainformation from
+            fresh ones toward older ones. Only runs created at
+            `created` or later are listed if it is set.
 
-if __name__ == '__main__':
-    if not os.path.isdir(workflow_runs_dir):
-        os.makedirs(workflow_runs_dir)
-    if not os.path.isdir(workflow_run_jobs_dir):
-        os.makedirs(workflow_run_jobs_dir)
-
-    ignore_in_stop_condition = set()
-
-    for run in download_workflow_runs(args.branch, args.since):
-        # Stop condition.
-        #
-        # If there are no stored runs, continue till the end (how much
-        # GitHub allows to download, it is 1000 runs).
-        #
-        # However we don't stop on a first known workflow run.
-        # A restarted workflow run keeps its position in the list
-        # (see [1]). So we re-check known runs and stop only when
-        # reach two weeks old runs (unlikely somebody will restart
-        # them).
-        #
-        # Actually this is not the optimal traverse algorithm, but
-        # it is simple to implement.
-        #
-        # [1]: https://github.community/t/135654
-        is_ignored = run.id in ignore_in_stop_condition
-        run_is_old = startup_time - run.created_at > datetime.timedelta(weeks=2)
-        if not args.nostop and run.is_stored and run_is_old and not is_ignored:
-            info('Found stored workflow run {} older than 2 weeks, '
-                 'stopping...', run.id)
-            break
-
-        # Skip incomplete runs. We'll look at them next time.
-        if run.status != 'completed':
-            reason = 'incomplete'
-            info('Skip workflow run {}: {}', run.id, reason)
-            continue
-
-        # Skip already processed runs if there were no restarts.
-        if run.is_stored:
-            run_past_info = WorkflowRun(filepath=run.meta_path)
-            if run.updated_at == run_past_info.updated_at:
-                info(("Workflow run {} was not changed ({}), don't download " +
-                      "jobs again"), run.id, run.updated_at)
-                continue
-            info('Workflow run {} was updated ({} vs {}), downloading jobs...',
-                 run.id, run_past_info.updated_at, run.updated_at)
+            GitHub lists at most 1000 runs of a filtered query. If
+            more runs are created since `created`, the older ones are
+            listed by next queries with a narrower creation range, so
+            a run on the boundary may be yielded twice.
+        """
+        created_till = None
+        while True:
+            params = {
+                # 100 is the maximum.
+                'per_page': 100,
+                'branch': branch,
+            }
+            if created:
+                params['created'] = '>=' + format_time(created)
+            if created and created_till:
+                params['created'] = '{}..{}'.format(format_time(created),
+                                                    format_time(created_till))
+            run_count = 0
+            run_total = None
+            oldest = None
+            for run, run_total in self.download_workflow_runs_pages(
+                    params, since):
+                run_count += 1
+                oldest = min(oldest or run.created_at, run.created_at)
+                yield run
+            if not created or run_total is None or run_count >= run_total or \
+                    oldest == created_till:
+                break
+            info('Listed {} of {} workflow runs, list ones created till {}',
+                 run_count, run_total, format_time(oldest))
+            created_till = oldest
+            since = 1
+
+    def download_workflow_runs_pages(self, params, since=1):
+        """ Yield (workflow run, total count of runs) of the workflow
+            run list pages for the given query parameters.
+        """
+        url_fmt = 'https://api.github.com/repos/{}/{}/actions/runs?page={}'
+        url = url_fmt.format(self.owner, self.repo, since)
+        workflow_runs_download_info(0, '??', 0, '??', url, params)
+        r = self.http_get(url, params=params, cache=True)
+        workflow_runs_page_info(r)
+
+        run_count = 0
+        run_total = r.json()['total_count']
+        for data in r.json()['workflow_runs']:
+            run_count += 1
+            yield WorkflowRun(self, data=data), run_total
+
+        pages_all = '??'
+        # There is no link to the last page if there is one page.
+        last_url = r.links.get('last', {}).get('url', '')
+        pages_all_match = re.search(r'[^_]page=(\d+)', last_url)
+        if pages_all_match:
+            pages_all = int(pages_all_match.group(1))
+
+        pages = since
+        while 'next' in r.links:
+            next_url = r.links['next']['url']
+            run_total = r.json()['total_count']
+            workflow_runs_download_info(pages, pages_all, run_count,
+                                        run_total, next_url, params)
+            r = self.http_get(next_url, params=params, cache=True)
+            workflow_runs_page_info(r)
+            for data in r.json()['workflow_runs']:
+                run_count += 1
+                yield WorkflowRun(self, data=data), run_total
+            pages += 1
+
+    def download_workflow_run_jobs(self, workflow_run_id):
+        """ Download and yield workflow run jobs metainformation for
+            given workflow run. An object for each (re)run.
+        """
+        params = {
+            # 100 is the maximum.
+            'per_page': 100,
+            # Download all jobs, not only the latest one.
+            'filter': 'all',
+        }
+        url_fmt = 'https://api.github.com/repos/{}/{}/actions/runs/{}/jobs'
+        url = url_fmt.format(self.owner, self.repo, workflow_run_id)
+        info('Download {}', url)
+        r = self.http_get(url, params=params)
+        workflow_run_jobs_page_info(r)
 
+        # Assume that nobody will rerun a workflow run more than 100
+        # times. So we can download only the first page.
+
+        for data in r.json()['jobs']:
+            yield WorkflowRunJob(self, data)
+
+    def store_workflow_run_job(self, job):
+        """ Download and store a log of a workflow run job (if needed)
+            and store the job meta.
+        """
+        if not self.nologs:
+            job.download_log()
+        job.store()
+
+    def process_workflow_run(self, run, log_executor=None):
+        """ Download and store jobs and logs of a workflow run, then
+            store the workflow run meta.
+
+            The workflow run meta is stored only after all its jobs are
+            stored, so an interrupted script never leaves a stored run
+            without its jobs.
+
+            Logs are downloaded using `log_executor` if it is provided.
+        """
         # Download jobs meta.
-        jobs = list(download_workflow_run_jobs(run.id))
+        jobs = list(self.download_workflow_run_jobs(run.id))
 
         # Skip if there are incomplete jobs.
         incomplete_jobs = [job for job in jobs if job.status != 'completed']
         if incomplete_jobs:
             reason = 'incomplete jobs'
             info('Skip workflow run {}: {}', run.id, reason)
-            continue
+            return
+
+        # Download and store logs, store job meta.
+        jobs_to_store = [job for job in jobs if not job.is_stored]
+        if log_executor:
+            # Consume the iterator to re-raise a download error if any.
+            list(log_executor.map(self.store_workflow_run_job, jobs_to_store))
+        else:
+            for job in jobs_to_store:
+                self.store_workflow_run_job(job)
 
-        # Download logs, store job meta and logs.
-        for job in jobs:
-            if not job.is_stored:
-                if not args.nologs:
-                    job.download_log()
-                job.store()
+        # Store step indexes and checksums of logs at once.
+        self.sensor_store.put_many([
+            (int(job.id), job.log_results[0], job.log_results[1],
+             job.meta.get('started_at'))
+            for job in jobs_to_store if job.log_results])
 
         # Store workflow run meta (or update it).
         run.store()
-        # A new workflow run may be created while the script works.
-        # So the same workflow run may appear twice: on page N and
-        # on page N+1. If we'll not ignore it in the stop condition,
-        # the first script invocation may stop prematurely.
-        ignore_in_stop_condition.add(run.id)
+        self.job_index.add_run(run.meta,
+                               [(job.meta, job.log_name) for job in jobs])
+
+    def fetch(self, branches=None):
+        """ Download new and updated workflow runs, their jobs and
+            logs of the branches (the ones passed to the constructor
+            by default, all the branches if there are no ones).
+
+            With `incremental` set, only workflow runs created since
+            the branch cursor (see `FetchCursors`) minus `rerun_window`
+            are listed: the window catches re-runs of recent runs. The
+            cursor moves to the creation time of the oldest run that
+            is not fetched yet (incomplete) or to the start of this
+            fetch. The first fetch of a branch traverses pages as
+            without `incremental`.
+
+            Workflow runs of several branches are listed once, without
+            the branch filter, and picked by the head branch, whether
+            the branches have cursors or not. The listing stops when
+            each branch is done: its runs are listed till its cursor
+            or, for a branch without a cursor, till the stop condition
+            below or FILTERED_LIST_LIMIT runs of the branch, as the
+            filtered listing of the branch would give. The listing is
+            filtered by the creation time only if all the branches have
+            cursors. A workflow run is processed once per fetch even if
+            it is listed twice.
+        """
+        branches = branches or self.branches
+        startup_time = datetime.datetime.now(datetime.timezone.utc)
+        if not os.path.isdir(self.workflow_runs_dir):
+            os.makedirs(self.workflow_runs_dir)
+        if not os.path.isdir(self.workflow_run_jobs_dir):
+            os.makedirs(self.workflow_run_jobs_dir)
+
+        # Cursors of the branches, the None branch means all ones.
+        cursors = {}
+        for branch in branches or [None]:
+            cursors[branch] = None
+            if self.incremental:
+                cursors[branch] = self.cursors.load(branch)
+
+        list_branch = None
+        if len(cursors) == 1:
+            list_branch, = cursors
+        created = None
+        since = self.since
+        if all(cursors.values()):
+            created = min(cursors.values()) - self.rerun_window
+            since = 1
+            info('Fetch workflow runs created since {}', format_time(created))
+        runs = self.download_workflow_runs(list_branch, since, created)
+        # GitHub bounds a filtered listing (see FILTERED_LIST_LIMIT),
+        # the unfiltered listing of several branches is bounded per
+        # branch here.
+        limit_branches = len(cursors) > 1 and created is None
+        # Branches which runs are all listed and the number of listed
+        # runs per branch.
+        done = set()
+        listed = dict.fromkeys(cursors, 0)
+
+        ignore_in_stop_condition = set()
+        # Runs that may be not stored by this fetch.
+        pending = {}
+        # {run ID: updated at} of runs processed by this fetch.
+        processed = {}
+        pipeline = None
+        if self.concurrency > 1:
+            pipeline = WorkflowRunPipeline(self, self.concurrency)
+
+        for run in runs:
+            # Runs are listed from fresh ones toward older ones, so a
+            # branch with a cursor is done on a run created before the
+            # cursor minus the re-run window.
+            done.update(branch for branch, cursor in cursors.items()
+                        if cursor and
+                        run.created_at < cursor - self.rerun_window)
+            if len(done) == len(cursors):
+                break
+            branch = run.head_branch if branches else None
+            if branch not in cursors or branch in done:
+                continue
+            if processed.get(run.id) == run.updated_at:
+                continue
+            stored_updated_at = run.stored_updated_at
+
+            # Stop condition of the page traversal for a branch
+            # without a cursor.
+            #
+            # If there are no stored runs, continue till the end (how
+            # much GitHub allows to download for the branch, it is 1000
+            # runs).
+            #
+            # However we don't stop on a first known workflow run.
+            # A restarted workflow run keeps its position in the list
+            # (see [1]). So we re-check known runs and stop only when
+            # reach two weeks old runs (unlikely somebody will restart
+            # them).
+            #
+            # Actually this is not the optimal traverse algorithm, but
+            # it is simple to implement. See `incremental` regarding
+            # a better one.
+            #
+            # [1]: https://github.community/t/135654
+            is_ignored = run.id in ignore_in_stop_condition
+            run_age = startup_time - run.created_at
+            run_is_old = run_age > datetime.timedelta(weeks=2)
+            if cursors[branch] is None:
+                if not self.nostop and stored_updated_at is not None and \
+                        run_is_old and not is_ignored:
+                    info('Found stored workflow run {} older than 2 weeks, '
+                         'stop listing {}', run.id,
+                         branch or 'workflow runs')
+                    done.add(branch)
+                elif limit_branches and \
+                        listed[branch] >= FILTERED_LIST_LIMIT:
+                    info('Listed {} workflow runs of {}, stop listing it',
+                         listed[branch], branch)
+                    done.add(branch)
+            if branch in done:
+                if len(done) == len(cursors):
+                    break
+                continue
+            listed[branch] += 1
+
+            # Skip incomplete runs. We'll look at them next time.
+            if run.status != 'completed':
+                reason = 'incomplete'
+                info('Skip workflow run {}: {}', run.id, reason)
+                pending[run.id] = run
+                continue
+
+            # Skip already processed runs if there were no restarts.
+            if stored_updated_at is not None:
+                if run.updated_at == stored_updated_at:
+                    info(("Workflow run {} was not changed ({}), " +
+                          "don't download jobs again"),
+                         run.id, run.updated_at)
+                    continue
+                info('Workflow run {} was updated ({} vs {}), '
+                     'downloading jobs...', run.id, stored_updated_at,
+                     run.updated_at)
+
+            # Download and store jobs, logs and the workflow run meta.
+            if pipeline:
+                pipeline.submit(run)
+            else:
+                self.process_workflow_run(run)
+            processed[run.id] = run.updated_at
+            # The run is not stored if it has incomplete jobs.
+            pending[run.id] = run
+            # A new workflow run may be created while the script
+            # works. So the same workflow run may appear twice: on
+            # page N and on page N+1. If we'll not ignore it in the
+            # stop condition, the first script invocation may stop
+            # prematurely.
+            #
+            # The run is added before it is actually stored: it may
+            # be still in progress in the pipeline.
+            ignore_in_stop_condition.add(run.id)
+
+        # Wait for workflow runs in progress. If the loop above fails,
+        # the runs in progress are finished on the interpreter exit
+        # anyway.
+        if pipeline:
+            pipeline.close()
+
+        if self.incremental:
+            for branch in cursors:
+                not_fetched = [run.created_at for run in pending.values()
+                               if branch in (None, run.head_branch) and
+                               (run.status != 'completed' or
+                                run.stored_updated_at != run.updated_at)]
+                cursor = min(not_fetched + [startup_time])
+                self.cursors.store(branch, cursor)
+                info('Workflow runs of {} created before {} are fetched',
+                     branch or 'all the branches', format_time(cursor))
+
+    def write_rate_limit_metric(self):
+        """ Write the remaining rate limit budget to InfluxDB when the
+            INFLUX_RATE_LIMIT_BUCKET environment variable is set.
+        """
+        bucket = os.getenv('INFLUX_RATE_LIMIT_BUCKET')
+        if not bucket or rate_limiter.reset is None:
+            return
+        # influxdb_client is needed only for this metric.
+        from multivac.influxdb import influx_connector
+
+        data = {
+            'measurement': 'github_rate_limit',
+            'tags': {
+                'repository': self.repo_path,
+                'branch': ','.join(self.branches or []) or 'all',
+            },
+            'fields': {
+                'limit': rate_limiter.limit,
+                'remaining': rate_limiter.remaining,
+                'used': rate_limiter.used,
+                'reset': rate_limiter.reset,
+            },
+            'time': int(time.time() * 1e9),
+        }
+        influx_connector().write(bucket, os.environ['INFLUX_ORG'], [data])
+
+    def close(self):
+        if self.http_cache:
+            self.http_cache.prune()
+        self.job_index.close()
+        self.sensor_store.close()
+        if self.own_session:
+            self.session.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Download GitHub Actions logs')
+    parser.add_argument('--branch', type=str, action='append',
+                        help='branch (all if omitted, may be passed several '
+                             'times)')
+    parser.add_argument('--nologs', action='store_true',
+                        help="Don't download logs")
+    parser.add_argument('--nostop', action='store_true',
+                        help="Continue till end or rate limit")
+    parser.add_argument('--since', type=int, default=1,
+                        help="A workflow run list page to start from it")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="How many workflow runs and how many logs are "
+                             "downloaded simultaneously")
+    parser.add_argument('--no-http-cache', action='store_true',
+                        help="Don't use the cache of API responses")
+    parser.add_argument('--log-compression', choices=['zst', 'gz', 'none'],
+                        default=storage.DEFAULT_COMPRESSION,
+                        help="How to compress stored logs "
+                             "(default: {})".format(
+                                 storage.DEFAULT_COMPRESSION))
+    parser.add_argument('--log-bodies', action='store_true',
+                        help="Log bodies of API responses to debug.log")
+    parser.add_argument('--raw-metas', action='store_true',
+                        help="Archive full workflow run and job metas to "
+                             "<owner>/<repo>/raw")
+    parser.add_argument('--incremental', action='store_true',
+                        help="List only workflow runs created since the "
+                             "last fetch of the branch (and re-runs of "
+                             "recent ones)")
+    parser.add_argument('--rerun-window', type=float,
+                        default=DEFAULT_RERUN_WINDOW.days, metavar='DAYS',
+                        help="How long a workflow run is re-checked for "
+                             "re-runs with --incremental (default: "
+                             "{})".format(DEFAULT_RERUN_WINDOW.days))
+    parser.add_argument('repo_path', type=str, nargs='+',
+                        help='owner/repository (may be several)')
+    args = parser.parse_args(argv)
+
+    token = os.getenv('MULTIVAC_GITHUB_TOKEN')
+    assert token, 'MULTIVAC_GITHUB_TOKEN is not set in environ variables'
+
+    # Repositories are fetched one by one using the same connections.
+    session = new_session(token, args.concurrency)
+    fetchers = []
+    try:
+        for repo_path in args.repo_path:
+            fetcher = Fetcher(
+                repo_path, token, branches=args.branch, nologs=args.nologs,
+                nostop=args.nostop, since=args.since,
+                concurrency=args.concurrency,
+                http_cache=not args.no_http_cache,
+                log_compression=args.log_compression,
+                log_bodies=args.log_bodies, raw_metas=args.raw_metas,
+                incremental=args.incremental,
+                rerun_window=datetime.timedelta(days=args.rerun_window),
+                session=session)
+            fetchers.append(fetcher)
+            try:
+                fetcher.fetch()
+            finally:
+                fetcher.close()
+    finally:
+        session.close()
+
+    info('GitHub API rate limit: {}', rate_limiter.status())
+    for fetcher in fetchers:
+        fetcher.write_rate_limit_metric()
 
-debug_log_fh.close()
+
+if __name__ == '__main__':
+    main()
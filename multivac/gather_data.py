@@ -1,27 +1,27 @@
 #!/usr/bin/env python
 import argparse
 import csv
-import glob
+import functools
 import json
 import os
 import re
 import sys
 
-import requests
-
-from sensors.test_status import test_status_iter
-from sensors.failures import specific_failures, generic_failures, \
-    compile_failure_specs
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from influxdb import influx_connector
 
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(PROJECT_DIR)
-
-COLOR_RE = re.compile('\033' + r'\[\d(?:;\d\d)?m')
-COMPILER_RE = re.compile(r'C compiler identification is '
-                         r'(\S* \d*.\d*.\d*)')
-DATETIME_RE = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}')
+from multivac.sensors.failures import specific_failures, \
+    generic_failures, FailureMatcher  # noqa: E402
+from multivac.log_scanner import LogScanner, QueuedTimeExtractor, \
+    TestStatusExtractor, DebugTargetExtractor, RunnerVersionExtractor, \
+    CompilerVersionExtractor, FailureExtractor  # noqa: E402
+from multivac.storage import TAIL_WINDOW, find_log, log_name, map_log, \
+    reverse_windows  # noqa: E402
+from multivac.job_index import JobIndex  # noqa: E402
+from multivac.metas import meta_name  # noqa: E402
+from multivac.sensor_store import SensorStore  # noqa: E402
 
 # According to distrowatch.com and repology.org/project/glibc/versions
 LIBC_VERSIONS = {
@@ -49,58 +49,31 @@ LIBC_VERSIONS = {
 }
 
 
-def decolor(data):
-    return COLOR_RE.sub('', data)
-
-
 # As far as the failure occurs at the end of the log, let's
 # start to parse the file from the end to speed up the process
-def reverse_readline(filename, buf_size=8192):
-    """An iterator that returns the lines of a file in reverse order"""
-    with open(filename, encoding='utf8') as fh:
-        segment = None
-        offset = 0
-        fh.seek(0, os.SEEK_END)
-        file_size = remaining_size = fh.tell()
-        while remaining_size > 0:
-            offset = min(file_size, offset + buf_size)
-            fh.seek(file_size - offset)
-            try:
-                buffer = fh.read(min(remaining_size, buf_size))
-            except UnicodeDecodeError:
-                print(f'ERROR when reading {filename}: UnicodeDecodeError')
-                yield ''
-            else:
-                remaining_size -= buf_size
-                lines = buffer.split('\n')
-                # The first line of the buffer is probably not a complete line so
-                # we'll save it and append it to the last line of the next buffer
-                # we read
-                if segment is not None:
-                    # If the previous chunk starts right from the beginning of line
-                    # do not concat the segment to the last line of new chunk.
-                    # Instead, yield the segment first
-                    if buffer[-1] != '\n':
-                        lines[-1] += segment
-                    else:
-                        yield segment
-                segment = lines[0]
-                for index in range(len(lines) - 1, 0, -1):
-                    if lines[index]:
-                        yield lines[index]
-                # Don't yield None if the file was empty
-                if segment is not None:
-                    yield segment
-
-
-def detect_error(logs: str, failure_specs: list) -> (str, str):
-    for number, line in enumerate(reverse_readline(logs)):
-        # check if the line matches one of regular expressions:
-        for failure_type in failure_specs:
-            for regexp in failure_type['re_compiled']:
-                if regexp.match(line):
-                    return failure_type['type'], line
-    return 'unknown_failure', None
+def reverse_readline(filename, buf_size=TAIL_WINDOW, max_depth=None):
+    """An iterator that returns non-empty lines of a file in reverse order.
+    The file is read in growing windows of whole lines starting from
+    `buf_size` bytes, only the last `max_depth` bytes if it is set (see
+    `multivac.storage.reverse_windows()`)."""
+    with map_log(filename, max_depth) as data:
+        for start, end in reverse_windows(data, buf_size, max_depth):
+            text = data[start:end].decode('utf-8', errors='replace')
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+            for line in reversed(text.split('\n')):
+                if line:
+                    yield line
+
+
+def detect_error(logs: str, failure_specs: list, generic_specs=(),
+                 max_depth=None) -> (str, str):
+    """Find the failure type of a log and the line it is detected by. The
+    last line matching `failure_specs` wins, otherwise the last line matching
+    `generic_specs` wins. The log is searched from the end in one pass."""
+    matcher = FailureMatcher(failure_specs, generic_specs)
+    with map_log(logs, max_depth) as data:
+        return matcher.last_match(data, max_depth) or \
+            ('unknown_failure', None)
 
 
 def github_time_to_unix(time: str) -> float:
@@ -112,14 +85,6 @@ def github_time_to_unix(time: str) -> float:
     return time_to_unix
 
 
-def get_log_datetime(log_line: str) -> str:
-    # Get ISO format date and time from the log line
-    datetime_match = DATETIME_RE.search(log_line)
-    if datetime_match:
-        return f'{datetime_match.group(0)}Z'
-    return ''
-
-
 # https://github.com/tarantool/tarantool/tree/master/.github/workflows
 OS_MATCHER = re.compile(r"[a-z]+_[0-9]+(_[0-9]+)?")
 FREEBSD_MATCHER = re.compile(r"freebsd-[0-9]{2}")
@@ -128,25 +93,103 @@ DEFAULT_RUNNERS_MATCHER = re.compile(
     r"(release|debug|static|conver|cover|"
     r"default_gcc|memtx|integration|out_of_source).*")
 DEFAULT_RUNNER_OS = 'ubuntu_20_04'
-NUM_MATCHER = re.compile(r".*/(\d*)\.json")
+# S3 bucket the fetched data is synced to, see backup.sh
+S3_HOST = 'multivac.hb.vkcs.cloud'
+# How many jobs are passed to a worker process at once
+WORKER_CHUNK_SIZE = 8
+
+# GatherData object of a worker process, see `init_worker()`
+worker_gather_data = None
+
+
+@functools.lru_cache(maxsize=None)
+def default_failure_matcher():
+    """Failure matcher with compiled regexes shared by all `GatherData`
+    objects of the process."""
+    return FailureMatcher(specific_failures, generic_failures)
+
+
+def init_worker(gather_data):
+    global worker_gather_data
+    worker_gather_data = gather_data
+
+
+def worker_gather_job_data(job):
+    return worker_gather_data.gather_job_data(job)
 
 
 class GatherData:
-    def __init__(self, cli_args):
-        self.repo_path = cli_args.repo_path
+    """Gather data about jobs of a repository from job metas and logs.
+    Parameters match the command line options, see `main()`.
+
+    The InfluxDB client and the artifacts lookup (`requests`) are imported
+    only when `output_format` is 'influxdb'.
+
+    A long-running process may pass its own `job_index` (kept up to date by
+    the caller) and `influx_writer` (flushed, but not closed here)."""
+    def __init__(self, repo_path='tarantool/tarantool', output_format=None,
+                 latest=None, failure_stats=False, watch_failure=None,
+                 since=None, tests=False, jobs=1, no_cache=False,
+                 local_artifacts=None, incremental=False, job_index=None,
+                 influx_writer=None, failure_depth=None):
+        self.repo_path = repo_path
         self.workflow_run_jobs_dir = f'{self.repo_path}/workflow_run_jobs'
         self.workflow_runs_dir = f'{self.repo_path}/workflow_runs'
         self.output_dir = 'output'
+        self.output_format = output_format
         self.gathered_data = dict()
-        self.latest_n: int = cli_args.latest
-        self.watch_failure = args.watch_failure
-        self.tests_flag = cli_args.tests
+        self.latest_n: int = latest
+        self.failure_stats = failure_stats
+        self.watch_failure = watch_failure
+        self.tests_flag = tests
+        self.workers = jobs
+        self.results = {failure_type['type']: 0
+                        for failure_type in generic_failures}
+        self.results.update(
+            {failure_type['type']: 0 for failure_type in specific_failures})
+        self.results.update({'unknown_failure': 0})
+        self.results.update({'total': 0})
         self.since_seconds = None
+        self.incremental = incremental
+        # Checkpoint to store after a successful write, see
+        # `job_metas()`.
+        self.checkpoint = None
+        self.failure_matcher = default_failure_matcher()
+        # Bytes at the end of a log to search for the failure in, all
+        # the log if None.
+        self.failure_depth = failure_depth
+        self.job_index = job_index
+        self.sensor_store = None
+        if not no_cache:
+            self.sensor_store = SensorStore(self.repo_path)
+
+        self.influx_writer = influx_writer
+        self.own_influx_writer = False
+        if output_format == 'influxdb':
+            from multivac.influxdb import InfluxWriter
+
+            self.influx_job_bucket = os.environ['INFLUX_JOB_BUCKET']
+            if self.tests_flag:
+                self.influx_test_bucket = os.environ['INFLUX_TEST_BUCKET']
+                self.influx_table_bucket = os.environ['INFLUX_TABLE_BUCKET']
+            if not self.influx_writer:
+                self.influx_writer = InfluxWriter(os.environ['INFLUX_ORG'])
+                self.own_influx_writer = True
+        self.artifacts = None
+        if output_format == 'influxdb' and self.tests_flag:
+            from multivac.artifacts import ArtifactIndex, S3Bucket, \
+                LocalBucket
+
+            if local_artifacts:
+                bucket = LocalBucket(local_artifacts)
+            else:
+                bucket = S3Bucket(f'http://{S3_HOST}')
+            cache_dir = None
+            if not no_cache:
+                cache_dir = os.path.join('.cache', 'artifacts', self.repo_path)
+            self.artifacts = ArtifactIndex(bucket, self.repo_path, cache_dir)
 
-        if args.format == 'influxdb':
-            self.influx_org = os.environ['INFLUX_ORG']
-
-        since: str = cli_args.since
+        since: str = since
         if since and len(since) > 1:
             wrong_usage_message = 'Wrong \'--since\' option: got wrong {}. ' \
                                   'Usage: NN[d|h], example: 42d.'
@@ -163,22 +206,27 @@ class GatherData:
             else:
                 print(wrong_usage_message.format('unit'))
 
+    def __getstate__(self):
+        # Worker processes don't write to InfluxDB: the writer stays in
+        # the main process.
+        state = self.__dict__.copy()
+        state['influx_writer'] = None
+        state['artifacts'] = None
+        state['job_index'] = None
+        return state
+
     @staticmethod
-    def get_test_data(log_file) -> list:
-        """To use this function, you should open log file first and put lines
-        to a variable as a list. This function will call the `test_status`
-        sensor to collect data about failed tests: test name and configuration.
+    def get_test_data(test_statuses) -> list:
+        """Collect data about failed tests from (test, conf, status) tuples
+        reported by the `test_status` sensor: test name and configuration.
         All attempts numbered for unicalization in InfluxDB.
-        Returns a list of dictionaries. Works only if option `-t` set."""
-
-        if not args.tests:
-            return []
+        Returns a list of dictionaries."""
 
         test_attempt = 1
         tests_data = []
 
         for test_name, conf, status in filter(lambda x: x[2] == "fail",
-                                              test_status_iter(log_file)):
+                                              test_statuses):
             #  Check if the test retried to set correct attempt number
             for test in tests_data[::-1]:
                 if test['name'] == test_name and test['conf'] == conf:
@@ -208,14 +256,6 @@ class GatherData:
 
         return tests_data
 
-    @staticmethod
-    def get_release_or_debug(log_file):
-        for line in log_file:
-            if '| Target:' in line and \
-                    line.endswith('Debug\n'):
-                return 'True'
-        return 'False'
-
     @staticmethod
     def detect_os_version(job_name):
 
@@ -230,33 +270,6 @@ class GatherData:
             return DEFAULT_RUNNER_OS
         return 'unknown'
 
-    @staticmethod
-    def get_runner_version(log_file):
-        version_matcher = re.compile(r"Current runner version: "
-                                     r"'(\d*.\d*.\d*)'")
-        freebsd_version_matcher = re.compile(r"Runner Version: "
-                                             r"(\d*.\d*.\S*)")
-        for line in log_file:
-            match = version_matcher.search(line)
-            if match:
-                runner_version = match.group(1)
-                return runner_version
-            else:
-                freebsd_match = freebsd_version_matcher.search(line)
-                if freebsd_match:
-                    runner_version = freebsd_match.group(1)
-                    return runner_version
-        return "unknown_runner_version"
-
-    @staticmethod
-    def get_compiler_version(log_file):
-        compiler = 'undefined_compiler'
-        for line in log_file:
-            compiler_match = COMPILER_RE.search(line)
-            if compiler_match:
-                compiler = compiler_match.group(1)
-        return compiler
-
     @staticmethod
     def calc_time_diff(time_started: str, time_ended: str) -> float:
         unix_time_started = github_time_to_unix(time_started)
@@ -264,25 +277,65 @@ class GatherData:
         time_diff = unix_time_ended - unix_time_started
         return time_diff
 
-    def gather_data(self):
-        # workflow_run_jobs/*[0-9].json
-        workflow_files = glob.glob(
-            os.path.join(self.workflow_run_jobs_dir, '*[0-9].json'))
-
-        def sorter(filename):
-            return int(NUM_MATCHER.search(filename).group(1))
-
-        job_json_files = sorted(workflow_files, reverse=True, key=sorter)
-        if self.latest_n:
-            job_json_files = job_json_files[:self.latest_n]
+    def checkpoint_path(self):
+        suffix = '-tests' if self.tests_flag else ''
+        return os.path.join('.cache', 'gather_data',
+                            f'{self.repo_path}.checkpoint{suffix}.json')
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path(), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def store_checkpoint(self):
+        """Remember the job index generation processed by this run. Call it
+        only after the data is written."""
+        path = self.checkpoint_path()
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # Replace the checkpoint atomically: a failed write leaves the
+        # previous one.
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.checkpoint, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        print(f'Checkpoint: job index generation '
+              f'{self.checkpoint["generation"]}')
+
+    def job_metas(self):
+        """Yield metas of jobs to process from the newest to the oldest one.
+        Skipped and cancelled jobs are omitted. Stops on the first job older
+        than `--since`. With `--incremental` only jobs added to the job index
+        (or changed there) since the checkpoint are yielded."""
+        job_index = self.job_index
+        if not job_index:
+            job_index = JobIndex(self.repo_path)
+            job_index.update()
+        generations = None
+        if self.incremental:
+            # The checkpoint is meaningless if the index is rebuilt.
+            checkpoint = self.load_checkpoint()
+            after = 0
+            if checkpoint and checkpoint['epoch'] == job_index.epoch:
+                after = checkpoint['generation']
+            self.checkpoint = {'epoch': job_index.epoch,
+                               'generation': job_index.generation}
+            generations = (after, self.checkpoint['generation'])
+            print(f'Process jobs of job index generations '
+                  f'({generations[0]}, {generations[1]}]')
+        jobs = job_index.jobs(limit=self.latest_n, generations=generations)
+        if not self.job_index:
+            job_index.close()
 
         curr_time = datetime.timestamp(datetime.now())
-        for job_json in job_json_files:
-
-            # Load info about jobs from job API JSON file
-            with open(job_json, 'r') as f:
-                job = json.load(f)
-
+        for job in jobs:
             # Don't process skipped and canceled job logs
             if job['conclusion'] in ['skipped', 'cancelled']:
                 continue
@@ -299,262 +352,287 @@ class GatherData:
                           f'(started at {job["started_at"]}), break...')
                     break
 
-            if 'aarch64' in job['name']:
-                platform = 'aarch64'
+            yield job
+
+    def gather_job_data(self, job):
+        """Gather data about a job from its meta and log. Returns the job data
+        and the log line the job failure was detected by (or None).
+        Doesn't modify the object, so it is safe to call it in a worker
+        process."""
+        job_id = job['id']
+        failure_line = None
+
+        if 'aarch64' in job['name']:
+            platform = 'aarch64'
+        else:
+            platform = 'amd64'
+
+        if 'gc64' in job['name'] or platform == 'aarch64':
+            gc64 = 'True'
+        else:
+            gc64 = 'False'
+
+        time_queued = job.get('created_at', job['started_at'])
+        test_data = []
+        debug = 'unknown'
+        runner_version = 'unknown'
+        compiler = 'unknown'
+        job_failure_type = 'unknown'
+
+        extractors = [
+            QueuedTimeExtractor(),
+            DebugTargetExtractor(),
+            RunnerVersionExtractor(),
+            CompilerVersionExtractor(),
+        ]
+        if self.tests_flag:
+            extractors.append(TestStatusExtractor())
+        if job['conclusion'] == 'failure':
+            extractors.append(FailureExtractor(
+                specific_failures, generic_failures,
+                matcher=self.failure_matcher,
+                max_depth=self.failure_depth))
+
+        try:
+            # Load info about jobs and tests from the log, if there is
+            # a log
+            logs = find_log(self.workflow_run_jobs_dir, job_id)
+            if self.sensor_store:
+                log_data = self.sensor_store.scan(job_id, logs, extractors,
+                                                  job['started_at'])
             else:
-                platform = 'amd64'
-
-            job_id = job['id']
+                log_data = LogScanner(extractors).scan(logs)
+        except FileNotFoundError:
+            print(f'No logs for job {job_id}, {job["html_url"]}')
+        else:
+            # To get exact time the job was queued, we need to get the time
+            # in the first line of the log file
+            time_queued = log_data['queued_at'] or time_queued
+            test_data = self.get_test_data(
+                log_data.get('test_statuses', []))
+            debug = log_data['debug']
+            runner_version = log_data['runner_version']
+            compiler = log_data['compiler_version']
+
+            if job['conclusion'] == 'failure':
+                # Detect failure type
+                job_failure_type, failure_line = log_data['failure']
+
+        # Get OS name and version
+        os_version = self.detect_os_version(job['name'])
+
+        # Save data to dict
+        gathered_job_data = {
+            'job_id': job_id,
+            'workflow_run_id': job['run_id'],
+            'job_name': job['name'],
+            'os_version': os_version,
+            'branch': job['head_branch'],
+            'commit_sha': job['head_sha'],
+            'conclusion': job['conclusion'],
+            'queued_at': time_queued,
+            'started_at': job['started_at'],
+            'time_in_queue': self.calc_time_diff(time_queued,
+                                                 job['started_at']),
+            'completed_at': job['completed_at'],
+            'job_duration': self.calc_time_diff(job['started_at'],
+                                                job['completed_at']),
+            'platform': platform,
+            'runner_label': ' '.join(job['labels']),
+            'gc64': gc64,
+            'debug': debug,
+            'html_url': job['html_url'],
+            'runner_name': job['runner_name'],
+            'runner_version': runner_version,
+            'failure_type': job_failure_type,
+            'compiler_version': compiler,
+            'libc_version': LIBC_VERSIONS.get(os_version, 'unknown'),
+        }
+        if test_data:
+            gathered_job_data.update(
+                {'failed_tests': test_data}
+            )
+        return gathered_job_data, failure_line
+
+    def add_job_data(self, gathered_job_data, failure_line):
+        """Store gathered data about a job, collect total failures of certain
+        type."""
+        job_id = gathered_job_data['job_id']
+        job_failure_type = gathered_job_data['failure_type']
+        if gathered_job_data['conclusion'] == 'failure' and \
+                job_failure_type != 'unknown':
+            if job_failure_type == self.watch_failure:
+                print(
+                    f'{job_id}  {gathered_job_data["job_name"]}\t'
+                    f' https://github.com/tarantool/tarantool/runs/'
+                    f'{job_id}?check_suite_focus=true\n'
+                    f'\t\t\t{failure_line}')
+            self.results[job_failure_type] += 1
+            self.results['total'] += 1
+        print(f'gathered job {job_id} started at '
+              f'{gathered_job_data["started_at"]}')
+        self.gathered_data[job_id] = gathered_job_data
+        if self.influx_writer:
+            self.put_job_data_to_db(gathered_job_data)
 
-            if 'gc64' in job['name'] or platform == 'aarch64':
-                gc64 = 'True'
-            else:
-                gc64 = 'False'
-
-            # Load info about jobs and tests from .log, if there are logs
-            logs = f'{self.workflow_run_jobs_dir}/{job_id}.log'
-
-            time_queued = job.get('created_at', job['started_at'])
-            test_data = []
-            debug = 'unknown'
-            runner_version = 'unknown'
-            compiler = 'unknown'
-            job_failure_type = 'unknown'
-
-            try:
-                with open(logs, 'r') as log_file:
-                    log_file_as_list = list(map(decolor, log_file))
-            except FileNotFoundError:
-                print(f'No logs for job {job_id}, {job["html_url"]}')
-            else:
-                # To get exact time the job was queued, we need to get the time
-                # in the first line of the log file
-                time_queued = get_log_datetime(log_file_as_list[0]) \
-                    or time_queued
-                test_data = self.get_test_data(log_file_as_list)
-                debug = self.get_release_or_debug(log_file_as_list)
-                runner_version = self.get_runner_version(log_file_as_list)
-                compiler = self.get_compiler_version(log_file_as_list)
-
-                if job['conclusion'] == 'failure':
-                    # Detect failure type, collect total failures of certain type
-                    job_failure_type, failure_line = detect_error(logs,
-                                                                  specific_failures)
-                    if job_failure_type == 'unknown_failure':
-                        job_failure_type, failure_line = detect_error(logs,
-                                                                      generic_failures)
-                    if job_failure_type == self.watch_failure:
-                        print(
-                            f'{job_id}  {job["name"]}\t'
-                            f' https://github.com/tarantool/tarantool/runs/'
-                            f'{job_id}?check_suite_focus=true\n'
-                            f'\t\t\t{failure_line}')
-                    results[job_failure_type] += 1
-                    results['total'] += 1
-
-            # Get OS name and version
-            os_version = self.detect_os_version(job['name'])
-
-            # Save data to dict
-            gathered_job_data = {
+    def gather_data(self):
+        jobs = self.job_metas()
+        if self.artifacts:
+            jobs = list(jobs)
+            # Look for artifacts of failed jobs while logs are analyzed.
+            self.artifacts.prefetch(
+                {job['run_id'] for job in jobs
+                 if job['conclusion'] == 'failure'})
+        if self.workers > 1:
+            # Jobs are analyzed in worker processes, but results are
+            # merged here in the order of `jobs`, so the result does not
+            # depend on the order the jobs are finished.
+            with ProcessPoolExecutor(max_workers=self.workers,
+                                     initializer=init_worker,
+                                     initargs=(self,)) as executor:
+                for res in executor.map(worker_gather_job_data, jobs,
+                                        chunksize=WORKER_CHUNK_SIZE):
+                    self.add_job_data(*res)
+        else:
+            for job in jobs:
+                self.add_job_data(*self.gather_job_data(job))
+
+    def job_points(self, job_data):
+        """InfluxDB points of a job: the job itself."""
+        measurement = job_data.get('failure_type') or job_data['conclusion']
+
+        time_job_queued = github_time_to_unix(job_data['queued_at'])
+
+        tags = {
+            'job_id': job_data['job_id'],
+            'job_name': job_data['job_name'].replace(",", ""),
+            'workflow_run_id': job_data['workflow_run_id'],
+            'branch': job_data['branch'],
+            'commit_sha': job_data['commit_sha'],
+            'platform': job_data['platform'],
+            'runner_label': job_data['runner_label'],
+            'conclusion': job_data['conclusion'],
+            'gc64': job_data['gc64'],
+            'runner_version': job_data['runner_version'],
+            'runner_name': job_data['runner_name'],
+            'repository': self.repo_path,
+        }
+
+        fields = {
+            'value': 1,
+            'time_in_queue': int(job_data['time_in_queue']),
+            'job_duration': int(job_data['job_duration']),
+        }
+
+        data = {
+            'measurement': measurement,
+            'tags': tags,
+            'fields': fields,
+            # We have `time_job_queued` in seconds, but InfluxDB precision
+            # is nanoseconds, convert
+            'time': int(time_job_queued * 1e9)
+        }
+        return [data]
+
+    def test_points(self, job_data):
+        """InfluxDB points of a job: failed tests."""
+        data_list = []
+        job_id = job_data['job_id']
+        for test in job_data.get('failed_tests', []):
+            tags = {
+                'configuration': test['conf'],
+                'test_type': test['test_type'],
+                'test_subtype': test['test_subtype'],
+                'debug': job_data['debug'],
                 'job_id': job_id,
-                'workflow_run_id': job['run_id'],
-                'job_name': job['name'],
-                'os_version': os_version,
-                'branch': job['head_branch'],
-                'commit_sha': job['head_sha'],
-                'conclusion': job['conclusion'],
-                'queued_at': time_queued,
-                'started_at': job['started_at'],
-                'time_in_queue': self.calc_time_diff(time_queued,
-                                                     job['started_at']),
-                'completed_at': job['completed_at'],
-                'job_duration': self.calc_time_diff(job['started_at'],
-                                                    job['completed_at']),
-                'platform': platform,
-                'runner_label': ' '.join(job['labels']),
-                'gc64': gc64,
-                'debug': debug,
-                'html_url': job['html_url'],
-                'runner_name': job['runner_name'],
-                'runner_version': runner_version,
-                'failure_type': job_failure_type,
-                'compiler_version': compiler,
-                'libc_version': LIBC_VERSIONS.get(os_version, 'unknown'),
+                'job_name': job_data['job_name'].replace(",", ""),
+                'commit_sha': job_data['commit_sha'],
+                'test_attempt': test['test_attempt'],
+                'branch': job_data['branch'],
+                'architecture': job_data['platform'],
+                'gc64': job_data['gc64'],
+                'os_version': job_data['os_version'],
+                'compiler_version': job_data['compiler_version'],
+                'libc_version': job_data['libc_version'],
+                'repository': self.repo_path,
             }
-            print(f'gathered job {job_id} started at {job["started_at"]}')
-
-            if test_data:
-                gathered_job_data.update(
-                    {'failed_tests': test_data}
-                )
-            self.gathered_data[job_id] = gathered_job_data
-
-    def put_to_db_job(self):
-        influx_job_bucket = os.environ['INFLUX_JOB_BUCKET']
-        influx_org = os.environ['INFLUX_ORG']
-        data_list = list()
-
-        print('Writing job data to InfluxDB...')
-        for job in list(self.gathered_data.keys()):
-            curr_job = self.gathered_data[job]
-
-            measurement = curr_job.get('failure_type') or curr_job['conclusion']
+            time = github_time_to_unix(job_data['started_at'])
+            data = {
+                'measurement': test['name'],
+                'tags': tags,
+                'fields': {
+                    'value': 1
+                },
+                'time': int(time * 1e9)
 
-            time_job_queued = github_time_to_unix(curr_job['queued_at'])
+            }
+            data_list.append(data)
+        return data_list
 
+    def table_points(self, job_data):
+        """InfluxDB points of a job for the tests table: failed tests with
+        links to the job data."""
+        data_list = []
+        job_id = job_data['job_id']
+        base_url = f'github.com/{self.repo_path}'
+        s3_url = f'{S3_HOST}/{self.repo_path}'
+        job_log = log_name(self.workflow_run_jobs_dir, job_id)
+        job_json = meta_name(self.workflow_run_jobs_dir, job_id)
+        run_id = job_data['workflow_run_id']
+        run_json = meta_name(self.workflow_runs_dir, run_id)
+        # Store link to the artifact if artifact saved to S3
+        artifact_url = 'None'
+        if job_data.get('failed_tests') and \
+                self.artifacts.has_artifact(run_id, job_id):
+            artifact_url = f"{s3_url}/artifacts/{run_id}/{job_id}.zip"
+        for test in job_data.get('failed_tests', []):
             tags = {
-                'job_id': curr_job['job_id'],
-                'job_name': curr_job['job_name'].replace(",", ""),
-                'workflow_run_id': curr_job['workflow_run_id'],
-                'branch': curr_job['branch'],
-                'commit_sha': curr_job['commit_sha'],
-                'platform': curr_job['platform'],
-                'runner_label': curr_job['runner_label'],
-                'conclusion': curr_job['conclusion'],
-                'gc64': curr_job['gc64'],
-                'runner_version': curr_job['runner_version'],
-                'runner_name': curr_job['runner_name'],
+                'configuration': test['conf'],
+                'test_type': test['test_type'],
+                'test_subtype': test['test_subtype'],
+                'debug': job_data['debug'],
+                'job_id': job_id,
+                'job_name': job_data['job_name'].replace(",", ""),
+                'commit_sha': job_data['commit_sha'],
+                'test_attempt': test['test_attempt'],
+                'branch': job_data['branch'],
+                'architecture': job_data['platform'],
+                'gc64': job_data['gc64'],
+                'os_version': job_data['os_version'],
+                'compiler_version': job_data['compiler_version'],
+                'libc_version': job_data['libc_version'],
                 'repository': self.repo_path,
+                'job_link': job_data['html_url'].lstrip('https://'),
+                'commit_link': f"{base_url}/commit/{job_data['commit_sha']}",
+                'job_json': f"{s3_url}/workflow_run_jobs/{job_json}",
+                'job_log': f"{s3_url}/workflow_run_jobs/{job_log}",
+                'workflow_run_json': f"{s3_url}/workflow_runs/{run_json}",
+                'artifact_url': artifact_url,
             }
 
-            fields = {
-                'value': 1,
-                'time_in_queue': int(curr_job['time_in_queue']),
-                'job_duration': int(curr_job['job_duration']),
-            }
-
+            time = github_time_to_unix(job_data['started_at'])
             data = {
-                'measurement': measurement,
+                'measurement': test['name'],
                 'tags': tags,
-                'fields': fields,
-                # We have `time_job_queued` in seconds, but InfluxDB precision
-                # is nanoseconds, convert
-                'time': int(time_job_queued * 1e9)
+                'fields': {
+                    'value': 1
+                },
+                'time': int(time * 1e9)
+
             }
             data_list.append(data)
-            if len(data_list) == 1000:
-                write_api = influx_connector()
-                write_api.write(influx_job_bucket, influx_org, data_list)
-                print('Chunk of 1000 records put to InfluxDB')
-                data_list = []
-
-        write_api = influx_connector()
-        write_api.write(influx_job_bucket, influx_org, data_list)
-        print(f'Chunk of {len(data_list)} records put to InfluxDB')
-
-    def put_to_db_test(self):
-        influx_test_bucket = os.environ['INFLUX_TEST_BUCKET']
-        influx_org = os.environ['INFLUX_ORG']
-        data_list = []
-        print('Writing test data to InfluxDB...')
-        for job_id in filter(
-                lambda x: 'failed_tests' in list(self.gathered_data[x].keys()),
-                list(self.gathered_data.keys())):
-            job_info = self.gathered_data[job_id]
-            for test in job_info.get('failed_tests'):
-                tags = {
-                    'configuration': test['conf'],
-                    'test_type': test['test_type'],
-                    'test_subtype': test['test_subtype'],
-                    'debug': job_info['debug'],
-                    'job_id': job_id,
-                    'job_name': job_info['job_name'].replace(",", ""),
-                    'commit_sha': job_info['commit_sha'],
-                    'test_attempt': test['test_attempt'],
-                    'branch': job_info['branch'],
-                    'architecture': job_info['platform'],
-                    'gc64': job_info['gc64'],
-                    'os_version': job_info['os_version'],
-                    'compiler_version': job_info['compiler_version'],
-                    'libc_version': job_info['libc_version'],
-                    'repository': self.repo_path,
-                }
-                time = github_time_to_unix(
-                    self.gathered_data[job_id]['started_at'])
-                data = {
-                    'measurement': test['name'],
-                    'tags': tags,
-                    'fields': {
-                        'value': 1
-                    },
-                    'time': int(time * 1e9)
-
-                }
-                data_list.append(data)
-                if len(data_list) == 1000:
-                    write_api = influx_connector()
-                    write_api.write(influx_test_bucket, influx_org, data_list)
-                    print('Chunk of 1000 records put to InfluxDB')
-                    data_list = []
-
-        write_api = influx_connector()
-        write_api.write(influx_test_bucket, influx_org, data_list)
-        print(f'Chunk of {len(data_list)} records put to InfluxDB')
-
-    def put_data_for_table_to_db(self):
-        influx_test_bucket = os.environ['INFLUX_TABLE_BUCKET']
-        influx_org = os.environ['INFLUX_ORG']
-        data_list = []
-        base_url = f'github.com/{self.repo_path}'
-        s3_url = f'multivac.hb.vkcs.cloud/{self.repo_path}'
-        print('Writing data for tests table to InfluxDB...')
-        for job_id in filter(
-                lambda x: 'failed_tests' in list(self.gathered_data[x].keys()),
-                list(self.gathered_data.keys())):
-            job_info = self.gathered_data[job_id]
-            for test in job_info.get('failed_tests'):
-                tags = {
-                    'configuration': test['conf'],
-                    'test_type': test['test_type'],
-                    'test_subtype': test['test_subtype'],
-                    'debug': job_info['debug'],
-                    'job_id': job_id,
-                    'job_name': job_info['job_name'].replace(",", ""),
-                    'commit_sha': job_info['commit_sha'],
-                    'test_attempt': test['test_attempt'],
-                    'branch': job_info['branch'],
-                    'architecture': job_info['platform'],
-                    'gc64': job_info['gc64'],
-                    'os_version': job_info['os_version'],
-                    'compiler_version': job_info['compiler_version'],
-                    'libc_version': job_info['libc_version'],
-                    'repository': self.repo_path,
-                    'job_link': job_info['html_url'].lstrip('https://'),
-                    'commit_link': f"{base_url}/commit/{job_info['commit_sha']}",
-                    'job_json': f"{s3_url}/workflow_run_jobs/{job_id}.json",
-                    'job_log': f"{s3_url}/workflow_run_jobs/{job_id}.log",
-                    'workflow_run_json': f"{s3_url}/workflow_runs/"
-                                         f"{job_info['workflow_run_id']}.json",
-                    'artifact_url': 'None'
-                }
-
-                # Store link to the artifact if artifact saved to S3
-                artifact_url = f"{s3_url}/artifacts/{job_info['workflow_run_id']}/{job_id}.zip"
-                if requests.head(f"http://{artifact_url}").status_code == 200:
-                    tags['artifact_url'] = artifact_url
-
-                time = github_time_to_unix(
-                    self.gathered_data[job_id]['started_at'])
-                data = {
-                    'measurement': test['name'],
-                    'tags': tags,
-                    'fields': {
-                        'value': 1
-                    },
-                    'time': int(time * 1e9)
-
-                }
-                data_list.append(data)
-                if len(data_list) == 1000:
-                    write_api = influx_connector()
-                    write_api.write(influx_test_bucket, influx_org, data_list)
-                    print('Chunk of 1000 records put to InfluxDB')
-                    data_list = []
-
-        write_api = influx_connector()
-        write_api.write(influx_test_bucket, influx_org, data_list)
-        print(f'Chunk of {len(data_list)} records put to InfluxDB')
+        return data_list
+
+    def put_job_data_to_db(self, job_data):
+        """Queue InfluxDB points of a job for writing. They are written in
+        the background, while next jobs are analyzed."""
+        self.influx_writer.write(self.influx_job_bucket,
+                                 self.job_points(job_data))
+        if self.tests_flag:
+            self.influx_writer.write(self.influx_test_bucket,
+                                     self.test_points(job_data))
+            self.influx_writer.write(self.influx_table_bucket,
+                                     self.table_points(job_data))
 
     def write_json(self):
         if not os.path.isdir(self.output_dir):
@@ -589,16 +667,41 @@ class GatherData:
             for job_data in self.gathered_data.values():
                 writer.writerow(job_data)
 
+    def write_result(self):
+        """Write gathered data in the requested format. For InfluxDB, wait
+        until all the data is written and store the checkpoint."""
+        if self.output_format == 'json':
+            self.write_json()
+        if self.output_format == 'csv':
+            self.write_csv()
+        if self.output_format == 'influxdb':
+            # Data is written while jobs are gathered, wait for the rest.
+            # An error is raised here, so the checkpoint does not advance.
+            if self.own_influx_writer:
+                self.influx_writer.close()
+            else:
+                self.influx_writer.flush()
+            if self.checkpoint:
+                self.store_checkpoint()
+
+    def close(self):
+        if self.own_influx_writer:
+            self.influx_writer.close()
+        if self.artifacts:
+            self.artifacts.close()
+        if self.sensor_store:
+            self.sensor_store.close()
+
     def print_failure_stats(self):
-        if args.failure_stats:
+        if self.failure_stats:
             sorted_results = list(
-                sorted(results.items(), key=lambda x: x[1], reverse=True))
+                sorted(self.results.items(), key=lambda x: x[1], reverse=True))
             for (type, count) in sorted_results:
                 if count > 0:
                     print(type, count)
 
 
-if __name__ == '__main__':
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description='Gather data about GitHub workflows')
     parser.add_argument(
@@ -626,29 +729,45 @@ if __name__ == '__main__':
     parser.add_argument('--repo-path', type=str, default='tarantool/tarantool',
                         help='repository (without owner)')
     parser.add_argument('--tests', '-t', action='store_true')
-
-    args = parser.parse_args()
-
-    # compile regular expressions
-    compile_failure_specs(specific_failures)
-    compile_failure_specs(generic_failures)
-
-    results = {failure_type['type']: 0 for failure_type in generic_failures}
-    results.update(
-        {failure_type['type']: 0 for failure_type in specific_failures})
-    results.update({'unknown_failure': 0})
-    results.update({'total': 0})
-
-    result = GatherData(args)
-    result.gather_data()
-    if args.format == 'json':
-        result.write_json()
-    if args.format == 'csv':
-        result.write_csv()
-    if args.format == 'influxdb':
-        result.put_to_db_job()
-        if args.tests:
-            result.put_to_db_test()
-            result.put_data_for_table_to_db()
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help='Analyze logs in N worker processes')
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='Don\'t use the store of data extracted from logs and the '
+             'cache of artifact lookups')
+    parser.add_argument(
+        '--local-artifacts', type=str, metavar='DIR',
+        help='Look for artifacts in a local copy of the S3 bucket instead '
+             'of the bucket itself')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='Only process jobs fetched or changed since the last successful '
+             'write to InfluxDB')
+    parser.add_argument(
+        '--failure-depth', type=int, metavar='MIB',
+        help='Search for the failure type only in the last MIB megabytes of '
+             'a log (default: the whole log)')
+
+    args = parser.parse_args(argv)
+    if args.incremental and args.format != 'influxdb':
+        parser.error('--incremental requires --format influxdb')
+
+    result = GatherData(
+        repo_path=args.repo_path, output_format=args.format,
+        latest=args.latest, failure_stats=args.failure_stats,
+        watch_failure=args.watch_failure, since=args.since, tests=args.tests,
+        jobs=args.jobs, no_cache=args.no_cache,
+        local_artifacts=args.local_artifacts, incremental=args.incremental,
+        failure_depth=args.failure_depth and args.failure_depth * 2 ** 20)
+    try:
+        result.gather_data()
+        result.write_result()
+    finally:
+        result.close()
     if args.failure_stats:
         result.print_failure_stats()
+
+
+if __name__ == '__main__':
+    main()
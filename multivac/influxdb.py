@@ -1,12 +1,181 @@
+import atexit
+import queue
+import random
+import threading
+import time
 from os import getenv
 from influxdb_client import InfluxDBClient, WriteApi
 from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.rest import ApiException
+from urllib3.exceptions import HTTPError
+
+# The client shared by all the writers of the process, see
+# `influx_client()`.
+client = None
+client_lock = threading.Lock()
+
+
+def influx_client() -> InfluxDBClient:
+    """ The InfluxDB client of the process. It keeps a pool of
+        connections, so it is created once and closed on exit.
+    """
+    global client
+    with client_lock:
+        if client is None:
+            org = getenv('INFLUX_ORG')
+            token = getenv('INFLUX_TOKEN')
+            url = getenv('INFLUX_URL')
+
+            client = InfluxDBClient(url=url, token=token, org=org)
+            atexit.register(client.close)
+        return client
 
 
 def influx_connector() -> WriteApi:
-    org = getenv('INFLUX_ORG')
-    token = getenv('INFLUX_TOKEN')
-    url = getenv('INFLUX_URL')
+    return influx_client().write_api(write_options=SYNCHRONOUS)
+
+
+def is_transient_error(error):
+    """ Whether a write may succeed if retried. """
+    if isinstance(error, ApiException):
+        return error.status == 429 or (error.status or 0) >= 500
+    return isinstance(error, (HTTPError, OSError))
+
+
+# Queue markers.
+FLUSH = object()
+STOP = object()
+
+
+class InfluxWriter:
+    """ Writes points to InfluxDB in a background thread.
+
+        Points are grouped in batches of up to `batch_size` points
+        per bucket. A batch is written when it is full or after
+        `flush_interval` seconds since its first point. `write()`
+        blocks when there are `max_pending` points not written yet,
+        so a producer can't outrun the database. Transient errors
+        (see `is_transient_error()`) are retried up to `max_retries`
+        times with an exponential backoff.
+
+        If a write fails, the error is re-raised once from the next
+        `write()`, `flush()` or `close()` call and the points queued
+        till then are dropped. Points written after that are written
+        as usual, so the writer outlives an outage of the database.
+        `close()` is called on exit, but call it explicitly to get
+        the error.
+
+        `write_api` is the one of `influx_connector()` by default.
+    """
+    def __init__(self, org=None, batch_size=1000, flush_interval=1.0,
+                 max_pending=10000, max_retries=5, write_api=None):
+        self.org = org or getenv('INFLUX_ORG')
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.write_api = write_api or influx_connector()
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        # Guards `error`: it is set by the thread, cleared by callers.
+        self.error_lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run,
+                                       name='influx-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def check(self):
+        """ Raise the write error if any. It is raised once. """
+        with self.error_lock:
+            error, self.error = self.error, None
+        if error:
+            raise RuntimeError('InfluxDB write failed') from error
+
+    def check_open(self):
+        if self.closed:
+            raise RuntimeError('The InfluxDB writer is closed')
+
+    def write(self, bucket, points):
+        """ Queue points for writing to the bucket. """
+        self.check_open()
+        for point in points:
+            self.check()
+            self.queue.put((bucket, point))
+
+    def flush(self):
+        """ Wait until all the queued points are written. """
+        self.check_open()
+        done = threading.Event()
+        self.queue.put((FLUSH, done))
+        done.wait()
+        self.check()
+
+    def close(self):
+        """ Write all the queued points and stop the thread. """
+        if self.closed:
+            return
+        self.closed = True
+        # Don't keep closed writers till exit.
+        atexit.unregister(self.close)
+        self.queue.put((STOP, None))
+        self.thread.join()
+        self.check()
+
+    def write_batch(self, bucket, batch):
+        attempt = 0
+        while True:
+            try:
+                self.write_api.write(bucket, self.org, batch)
+                break
+            except Exception as e:
+                if attempt >= self.max_retries or not is_transient_error(e):
+                    raise
+                attempt += 1
+                delay = random.uniform(0, min(30, 0.5 * 2 ** attempt))
+                print(f'InfluxDB write failed: {e}, retry in {delay:.1f} '
+                      'seconds')
+                time.sleep(delay)
+        print(f'Chunk of {len(batch)} records put to InfluxDB')
+
+    def write_batches(self, batches):
+        for bucket, batch in batches.items():
+            # Don't try to write after a failure, just drop points.
+            if batch and not self.error:
+                try:
+                    self.write_batch(bucket, batch)
+                except Exception as e:
+                    with self.error_lock:
+                        self.error = e
+        batches.clear()
+
+    def run(self):
+        batches = {}
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            try:
+                bucket, point = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self.write_batches(batches)
+                deadline = None
+                continue
+
+            if bucket is FLUSH or bucket is STOP:
+                self.write_batches(batches)
+                deadline = None
+                if bucket is STOP:
+                    break
+                point.set()
+                continue
 
-    client = InfluxDBClient(url=url, token=token, org=org)
-    return client.write_api(write_options=SYNCHRONOUS)
+            batch = batches.setdefault(bucket, [])
+            batch.append(point)
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+            if len(batch) >= self.batch_size:
+                self.write_batches({bucket: batch})
+                del batches[bucket]
+                if not batches:
+                    deadline = None
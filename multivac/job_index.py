@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+
+""" Index of workflow runs and workflow run jobs.
+
+    `fetch.py` stores a JSON file per workflow run and per job. The
+    reports need just a few fields of them, but loading hundreds of
+    thousands of JSON files takes a long time. The index is a SQLite
+    database with these fields, so the reports may filter jobs by a
+    branch and a time without touching the filesystem per job.
+
+    The JSON files remain the source of truth. `fetch.py` updates the
+    index when it stores a workflow run; `JobIndex.update()` adds
+    files stored in another way (say, downloaded from S3): it lists
+    the directories and loads only files that are not indexed yet.
+
+    Run this module as a script to update or rebuild the index:
+
+        ./multivac/job_index.py [--rebuild] tarantool/tarantool
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import uuid
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_DIR)
+from multivac.metas import META_FILENAME_RE, load_meta  # noqa: E402
+from multivac.storage import LOG_EXTENSIONS, LOG_FILENAME_RE  # noqa: E402
+from multivac.storage import iter_files  # noqa: E402
+
+# Bump on a schema change: the index is rebuilt then.
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE runs (
+    id INTEGER PRIMARY KEY,
+    head_branch TEXT,
+    event TEXT,
+    status TEXT,
+    conclusion TEXT,
+    created_at TEXT,
+    updated_at TEXT
+);
+CREATE TABLE jobs (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL,
+    name TEXT,
+    head_branch TEXT,
+    head_sha TEXT,
+    status TEXT,
+    conclusion TEXT,
+    labels TEXT,
+    runner_name TEXT,
+    html_url TEXT,
+    created_at TEXT,
+    started_at TEXT,
+    completed_at TEXT,
+    -- Log path relative to the workflow run jobs directory or NULL.
+    log TEXT,
+    -- Generation of the index the job was added or changed in.
+    generation INTEGER NOT NULL
+);
+CREATE INDEX jobs_run_id ON jobs (run_id);
+CREATE INDEX jobs_generation ON jobs (generation);
+CREATE INDEX jobs_started_at ON jobs (started_at);
+CREATE INDEX runs_head_branch ON runs (head_branch);
+'''
+
+RUN_FIELDS = ('id', 'head_branch', 'event', 'status', 'conclusion',
+              'created_at', 'updated_at')
+JOB_FIELDS = ('id', 'run_id', 'name', 'head_branch', 'head_sha', 'status',
+              'conclusion', 'labels', 'runner_name', 'html_url', 'created_at',
+              'started_at', 'completed_at')
+
+
+def default_index_path(repo_path):
+    name = os.path.normpath(repo_path)
+    # The repository is the current directory (see `minutes.py`).
+    if name == os.curdir:
+        name = 'index'
+    return os.path.join('.cache', 'job_index', name + '.sqlite3')
+
+
+def list_files(base_dir):
+    """ (file name, relative path) of files of workflow runs or jobs
+        (see `storage.iter_files()`).
+    """
+    if not os.path.isdir(base_dir):
+        return []
+    return list(iter_files(base_dir))
+
+
+def pick_files(files, filename_re, extensions=None):
+    """ {ID: relative path} of files (see `list_files()`) with names
+        matching `filename_re`: (ID) or (ID, extension) groups.
+
+        If there are several files of an ID, the same file as
+        `storage.find_object()` returns is chosen: in a shard rather
+        than not and with the first extension in `extensions`.
+    """
+    found = {}
+    for filename, rel_path in files:
+        match = filename_re.match(filename)
+        if not match:
+            continue
+        obj_id = int(match.group(1))
+        rank = (rel_path == filename,
+                extensions.index(match.group(2)) if extensions else 0)
+        if obj_id not in found or rank < found[obj_id][0]:
+            found[obj_id] = (rank, rel_path)
+    return {obj_id: rel_path for obj_id, (_, rel_path) in found.items()}
+
+
+class JobIndex:
+    """ SQLite index of workflow runs and jobs of a repository.
+
+        Each change of the index (see `insert()` and `update()`)
+        increments the index generation, and jobs added or changed
+        by it are marked with it. So a consumer may remember the
+        generation it has processed and list only jobs added or
+        changed after it (see `jobs()`), including ones fetched late.
+        Generations are comparable only within the same `epoch`: the
+        epoch changes when the index is rebuilt.
+
+        Thread safe: the connection is shared between threads under
+        a lock.
+    """
+    def __init__(self, repo_path, index_path=None):
+        self.workflow_runs_dir = os.path.join(repo_path, 'workflow_runs')
+        self.workflow_run_jobs_dir = os.path.join(repo_path,
+                                                  'workflow_run_jobs')
+        self.index_path = index_path or default_index_path(repo_path)
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.index_path,
+                                    check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.create_schema()
+
+    def create_schema(self):
+        with self.lock, self.conn:
+            self.conn.execute('DROP TABLE IF EXISTS meta')
+            self.conn.execute('DROP TABLE IF EXISTS runs')
+            self.conn.execute('DROP TABLE IF EXISTS jobs')
+            self.conn.executescript(SCHEMA)
+            self.conn.executemany('INSERT INTO meta VALUES (?, ?)', [
+                ('epoch', uuid.uuid4().hex),
+                ('generation', 0),
+            ])
+            self.conn.execute('PRAGMA user_version = {}'.format(
+                SCHEMA_VERSION))
+
+    def get_meta(self, key):
+        with self.lock:
+            return self.conn.execute('SELECT value FROM meta WHERE key = ?',
+                                     (key,)).fetchone()[0]
+
+    @property
+    def epoch(self):
+        return self.get_meta('epoch')
+
+    @property
+    def generation(self):
+        """ The last generation of the index. """
+        return self.get_meta('generation')
+
+    def next_generation(self):
+        """ Increment the generation. Call it in a transaction under
+            the lock.
+        """
+        self.conn.execute("UPDATE meta SET value = value + 1 "
+                          "WHERE key = 'generation'")
+        return self.conn.execute("SELECT value FROM meta "
+                                 "WHERE key = 'generation'").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def run_row(run):
+        return tuple(run.get(field) for field in RUN_FIELDS)
+
+    @staticmethod
+    def job_row(job, log, generation):
+        row = [job.get(field) for field in JOB_FIELDS]
+        row[JOB_FIELDS.index('labels')] = json.dumps(job.get('labels', []))
+        return tuple(row) + (log, generation)
+
+    def insert(self, runs=(), jobs=()):
+        """ Add or replace workflow runs (metas) and jobs ((meta, log
+            file name) pairs).
+        """
+        if not runs and not jobs:
+            return
+        with self.lock, self.conn:
+            generation = self.next_generation()
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO runs VALUES ({})'.format(
+                    ', '.join('?' * len(RUN_FIELDS))),
+                [self.run_row(run) for run in runs])
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO jobs VALUES ({})'.format(
+                    ', '.join('?' * (len(JOB_FIELDS) + 2))),
+                [self.job_row(job, log, generation) for job, log in jobs])
+
+    def add_run(self, run, jobs):
+        """ Add a workflow run meta along with its jobs ((meta, log
+            file name) pairs).
+        """
+        self.insert(runs=[run], jobs=jobs)
+
+    def run_updated_at(self, run_id):
+        """ `updated_at` of an indexed workflow run or None. """
+        with self.lock:
+            row = self.conn.execute('SELECT updated_at FROM runs WHERE id = ?',
+                                    (run_id,)).fetchone()
+        return row[0] if row else None
+
+    def indexed_ids(self, table):
+        with self.lock:
+            return {row[0] for row in self.conn.execute(
+                'SELECT id FROM {}'.format(table))}
+
+    def update(self):
+        """ Index workflow runs and jobs stored on disk, but not
+            indexed yet, and track logs stored, compressed, moved to
+            a shard or removed since the last update.
+
+            Returns counts of added workflow runs, added jobs and
+            updated logs.
+        """
+        run_metas = pick_files(list_files(self.workflow_runs_dir),
+                               META_FILENAME_RE)
+        job_files = list_files(self.workflow_run_jobs_dir)
+        job_metas = pick_files(job_files, META_FILENAME_RE)
+        logs = pick_files(job_files, LOG_FILENAME_RE, LOG_EXTENSIONS)
+
+        runs = []
+        for run_id in sorted(run_metas.keys() - self.indexed_ids('runs')):
+            runs.append(load_meta(os.path.join(self.workflow_runs_dir,
+                                               run_metas[run_id])))
+
+        jobs = []
+        for job_id in sorted(job_metas.keys() - self.indexed_ids('jobs')):
+            meta = load_meta(os.path.join(self.workflow_run_jobs_dir,
+                                          job_metas[job_id]))
+            jobs.append((meta, logs.get(job_id)))
+        self.insert(runs, jobs)
+
+        with self.lock, self.conn:
+            indexed_logs = dict(self.conn.execute(
+                'SELECT id, log FROM jobs'))
+            changed = [(logs.get(job_id), job_id)
+                       for job_id, log in indexed_logs.items()
+                       if logs.get(job_id) != log]
+            if changed:
+                generation = self.next_generation()
+                self.conn.executemany(
+                    'UPDATE jobs SET log = ?, generation = {} '
+                    'WHERE id = ?'.format(generation), changed)
+        return len(runs), len(jobs), len(changed)
+
+    def jobs(self, branches=None, with_log=False, order='DESC', limit=None,
+             generations=None):
+        """ List of job metas ordered by the job ID.
+
+            Only jobs of workflow runs of the given branches are
+            listed if `branches` is set. Only jobs with a stored log
+            are listed if `with_log` is set. Only jobs added or
+            changed in generations (after, till] are listed if
+            `generations` is set to such a pair.
+
+            A job meta is a dictionary with the same keys as the job
+            JSON file has (only the indexed ones) plus `log` (the log
+            path relative to the jobs directory or None), `generation`
+            and `run_head_branch` (the branch of the workflow run, None
+            if the workflow run is not stored).
+        """
+        if order not in ('ASC', 'DESC'):
+            raise ValueError('Unknown order: {}'.format(order))
+        conditions = []
+        params = []
+        if branches is not None:
+            conditions.append('runs.head_branch IN ({})'.format(
+                ', '.join('?' * len(branches))))
+            params.extend(branches)
+        if with_log:
+            conditions.append('jobs.log IS NOT NULL')
+        if generations is not None:
+            conditions.append('jobs.generation > ? AND jobs.generation <= ?')
+            params.extend(generations)
+        query = 'SELECT jobs.*, runs.head_branch AS run_head_branch ' \
+                'FROM jobs LEFT JOIN runs ON jobs.run_id = runs.id'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY jobs.id ' + order
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            job['labels'] = json.loads(job['labels'])
+            # Old job metas have no `created_at`.
+            if job['created_at'] is None:
+                del job['created_at']
+            jobs.append(job)
+        return jobs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Update the index of workflow runs and jobs')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Rebuild the index from scratch')
+    parser.add_argument('repo_path', type=str,
+                        help='owner/repository')
+    args = parser.parse_args()
+
+    index = JobIndex(args.repo_path)
+    if args.rebuild:
+        index.create_schema()
+    runs, jobs, logs = index.update()
+    index.close()
+    print('Indexed {} workflow runs, {} jobs, {} logs in {}'.format(
+        runs, jobs, logs, index.index_path), file=sys.stderr)
@@ -0,0 +1,249 @@
+""" Mergeable aggregation of test fails for the 'last seen' report.
+
+    A fail is keyed by (test, conf, status, runs_on) and aggregated
+    into an entry [started_at, branch, count, job_id, run_id, log]:
+    the job where the fail was seen last and how many times it was
+    seen. Entries are merged by summing counts and keeping the latest
+    job (the greatest job ID wins on equal times), so the result does
+    not depend on the order logs are processed in.
+
+    Logs are reduced into partials per branch and day (by the job
+    start time, UTC). Partials are computed in parallel and persisted
+    in a cache directory, so regenerating the report costs only days
+    with new (or changed) jobs. Test statuses of jobs of these days
+    are read from the sensor store (see `multivac/sensor_store.py`)
+    at once, only logs without stored statuses are parsed.
+"""
+
+import hashlib
+import json
+import os
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+
+from multivac.sensor_store import fingerprint
+from multivac.sensors import test_status
+from multivac.storage import map_log
+
+# Bump on a change of the partial format or logic.
+REVISION = 1
+
+FAIL_STATUSES = ('fail', 'transient fail', 'hang')
+
+# The sensor name in the sensor store.
+SENSOR = 'test_status'
+
+
+def version():
+    """ Identifies the reducer and the sensor logic: partials of
+        another version are not used.
+    """
+    data = json.dumps([REVISION, [regexp.pattern for regexp in (
+        test_status.TEST_STATUS_LINE_RE, test_status.LATE_STATUS,
+        test_status.TEST_HANG_RE, test_status.HANG_RESULT_RE)]])
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def log_test_statuses(log):
+    """ (test, conf, status) lists of a log, see
+        `multivac/sensors/test_status.py`.
+    """
+    with map_log(log) as data:
+        return [list(res) for res in test_status.test_status_iter(data)]
+
+
+def fails(test_statuses):
+    for test, conf, status in test_status.squash_test_statuses(
+            test_statuses):
+        if status in FAIL_STATUSES:
+            yield test, conf, status
+
+
+def merge_entry(a, b):
+    latest = max(a, b, key=lambda entry: (entry[0], entry[3]))
+    return [latest[0], latest[1], a[2] + b[2]] + latest[3:]
+
+
+def merge(acc, partial):
+    """ Merge a partial ({key: entry}) into `acc`. """
+    for key, entry in partial.items():
+        if key in acc:
+            acc[key] = merge_entry(acc[key], entry)
+        else:
+            acc[key] = entry
+    return acc
+
+
+def shorten(partial):
+    """ Coalesce 'runs-on' labels by a first word: say, merge
+        'ubuntu-18.04' and 'ubuntu-20.04' into 'ubuntu'.
+    """
+    res = {}
+    for (test, conf, status, runs_on), entry in partial.items():
+        labels = [label.split('-', 1)[0] for label in runs_on.split(',')]
+        merge(res, {(test, conf, status, ','.join(labels)): entry})
+    return res
+
+
+def job_partial(job, test_statuses):
+    """ Partial of a job log. `job` is a job meta from the job
+        index.
+    """
+    res = {}
+    runs_on = ','.join(job['labels'])
+    for test, conf, status in fails(test_statuses):
+        entry = [job['started_at'], job['run_head_branch'], 1, job['id'],
+                 job['run_id'], job['log']]
+        merge(res, {(test, conf, status, runs_on): entry})
+    return res
+
+
+def jobs_partial(jobs_dir, jobs, stored=None):
+    """ Partial of the given jobs. Logs of jobs missing in `stored`
+        ({job ID: test statuses}) are parsed.
+
+        Returns the partial and {job ID: (log fingerprint, test
+        statuses)} of the parsed logs.
+    """
+    stored = stored or {}
+    res = {}
+    parsed = {}
+    for job in jobs:
+        test_statuses = stored.get(job['id'])
+        if test_statuses is None:
+            log = os.path.join(jobs_dir, job['log'])
+            test_statuses = log_test_statuses(log)
+            parsed[job['id']] = (fingerprint(log), test_statuses)
+        merge(res, job_partial(job, test_statuses))
+    return res, parsed
+
+
+class PartialStore:
+    """ Persisted partials: a JSON file per branch and day.
+
+        A partial is valid while the set of the day jobs and their
+        job index generations (see `multivac/job_index.py`) and the
+        reducer version are the same.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, branch, day):
+        return os.path.join(self.cache_dir,
+                            urllib.parse.quote(branch, safe=''),
+                            '{}.json'.format(day))
+
+    def load(self, branch, day, signature):
+        try:
+            with open(self.path(branch, day), 'r') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if data['signature'] != signature:
+            return None
+        return {tuple(item[:4]): item[4:] for item in data['entries']}
+
+    def store(self, branch, day, signature, partial):
+        path = self.path(branch, day)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        data = {
+            'signature': signature,
+            'entries': [list(key) + entry for key, entry in partial.items()],
+        }
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+
+def signature(jobs):
+    data = json.dumps([version(), sorted(
+        [job['id'], job['generation']] for job in jobs)])
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def stored_test_statuses(sensor_store, jobs):
+    """ {job ID: test statuses} of the given jobs found in the
+        sensor store.
+    """
+    if not jobs:
+        return {}
+    started = [job['started_at'] for job in jobs]
+    found = sensor_store.results(SENSOR, test_status.version(),
+                                 min(started), max(started))
+    res = {}
+    for job in jobs:
+        log, test_statuses = found.get(job['id'], (None, None))
+        # The store keeps the log file name (see `fingerprint()`), so
+        # results survive moving the log to a shard.
+        if log == os.path.basename(job['log']):
+            res[job['id']] = test_statuses
+    return res
+
+
+def collect(jobs, jobs_dir, cache_dir=None, workers=1, sensor_store=None,
+            mp_context=None):
+    """ Aggregate fails of the given jobs (job metas from the job
+        index with logs). Worker processes are started using
+        `mp_context` if it is passed (see `ProcessPoolExecutor`).
+
+        Parsed test statuses are written to `sensor_store` if it is
+        passed.
+
+        Returns the merged partial and {branch: (first job start
+        time, last job start time)}.
+    """
+    groups = {}
+    intervals = {}
+    for job in jobs:
+        branch = job['run_head_branch']
+        day = job['started_at'][:10]
+        groups.setdefault((branch, day), []).append(job)
+        first, last = intervals.get(branch, (job['started_at'],) * 2)
+        intervals[branch] = (min(first, job['started_at']),
+                             max(last, job['started_at']))
+
+    store = PartialStore(cache_dir) if cache_dir else None
+    res = {}
+    missing = []
+    for (branch, day), group in sorted(groups.items()):
+        group_signature = signature(group)
+        partial = store.load(branch, day, group_signature) if store else None
+        if partial is None:
+            missing.append((branch, day, group_signature, group))
+        else:
+            merge(res, partial)
+
+    groups_jobs = [group for _, _, _, group in missing]
+    stored = {}
+    if sensor_store:
+        stored = stored_test_statuses(
+            sensor_store, [job for group in groups_jobs for job in group])
+    groups_stored = [{job['id']: stored[job['id']] for job in group
+                      if job['id'] in stored} for group in groups_jobs]
+
+    def computed(results):
+        for (branch, day, group_signature, group), (partial, parsed) in \
+                zip(missing, results):
+            if sensor_store and parsed:
+                started_at = {job['id']: job['started_at'] for job in group}
+                sensor_store.put_many([
+                    (job_id, log_fingerprint,
+                     {SENSOR: (test_status.version(), test_statuses)},
+                     started_at[job_id])
+                    for job_id, (log_fingerprint, test_statuses)
+                    in parsed.items()])
+            if store:
+                store.store(branch, day, group_signature, partial)
+            merge(res, partial)
+
+    if workers > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=mp_context) as executor:
+            computed(executor.map(jobs_partial, [jobs_dir] * len(missing),
+                                  groups_jobs, groups_stored))
+    else:
+        computed(jobs_partial(jobs_dir, group, group_stored)
+                 for group, group_stored in zip(groups_jobs, groups_stored))
+    return res, intervals
@@ -0,0 +1,369 @@
+""" Single-pass log scanner.
+
+    Each piece of data gathered from a job log is collected by an
+    extractor. An extractor declares substrings (needles) a line
+    should contain to be interesting for it, and the scanner feeds
+    every extractor from one streaming read of the log file. Lines
+    are not accumulated, so memory consumption does not depend on
+    the log size.
+
+    Extractor results may be stored with `SensorStore.scan()` (see
+    `multivac/sensor_store.py`).
+"""
+
+import hashlib
+import json
+import re
+
+from multivac import log_steps
+from multivac.storage import map_log, open_log
+from multivac.sensors import test_status
+from multivac.sensors.test_status import TestStatusParser
+from multivac.sensors.failures import FailureMatcher
+
+COLOR_RE = re.compile('\033' + r'\[\d(?:;\d\d)?m')
+COMPILER_RE = re.compile(r'C compiler identification is '
+                         r'(\S* \d*.\d*.\d*)')
+DATETIME_RE = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}')
+RUNNER_VERSION_RE = re.compile(r"Current runner version: "
+                               r"'(\d*.\d*.\d*)'")
+FREEBSD_RUNNER_VERSION_RE = re.compile(r"Runner Version: "
+                                       r"(\d*.\d*.\S*)")
+# A line with the universal newline, as in text mode.
+TEXT_LINE_RE = re.compile(r'[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+')
+
+
+def decolor(data):
+    return COLOR_RE.sub('', data)
+
+
+def iter_lines(data, start, end):
+    """ Yield lines of log bytes (say, a memory-mapped log) in
+        [start, end), decoded as a file in text mode does it. Only a
+        line is copied at once, not the range.
+    """
+    pos = start
+    while pos < end:
+        line_end = data.find(b'\n', pos, end)
+        line_end = end if line_end == -1 else line_end + 1
+        line = data[pos:line_end].decode('utf-8')
+        pos = line_end
+        if '\r' in line:
+            for text_line in TEXT_LINE_RE.findall(line):
+                yield text_line.replace('\r\n', '\n').replace('\r', '\n')
+        else:
+            yield line
+
+
+def get_log_datetime(log_line: str) -> str:
+    # Get ISO format date and time from the log line
+    datetime_match = DATETIME_RE.search(log_line)
+    if datetime_match:
+        return f'{datetime_match.group(0)}Z'
+    return ''
+
+
+class Extractor:
+    """ Base class for log extractors.
+
+        `name` is a key of the extractor result in the scan
+        result. `needles` is a tuple of substrings: only lines
+        containing at least one of them are fed to the extractor
+        (`None` means 'every line'). A decolored line is fed unless
+        `raw` is set. An extractor sets `done` when it doesn't need
+        more lines.
+
+        An extractor with `tail` set searches a log from the end:
+        `LogScanner.scan()` doesn't feed it, but calls `scan_tail()`
+        with the log bytes (see `multivac.storage.map_log()`). If
+        `max_depth` is set, it needs only the last `max_depth` bytes
+        of a log.
+
+        `steps` is a tuple of kinds of log steps (see
+        `multivac/log_steps.py`) the extractor needs lines of
+        (`None` means 'all steps').
+
+        `version` identifies the extractor logic: it is a hash of
+        `revision` and `spec()`. The latter should return all the
+        patterns the extractor uses, so a pattern change invalidates
+        cached results of this extractor only. Bump `revision` on
+        other changes in the extractor code.
+    """
+    name = None
+    needles = None
+    raw = False
+    tail = False
+    max_depth = None
+    steps = None
+    revision = 1
+
+    def __init__(self):
+        self.done = False
+
+    def spec(self):
+        return self.needles
+
+    @property
+    def version(self):
+        data = [type(self).__name__, self.revision, self.spec()]
+        if self.steps is not None:
+            data.append(list(self.steps))
+        return hashlib.sha1(json.dumps(data).encode()).hexdigest()
+
+    def feed(self, line):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+    def scan_tail(self, data):
+        raise NotImplementedError
+
+
+class QueuedTimeExtractor(Extractor):
+    """ Time of the first log line: the exact time the job was
+        queued.
+    """
+    name = 'queued_at'
+
+    def __init__(self):
+        super().__init__()
+        self.queued_at = ''
+
+    def spec(self):
+        return DATETIME_RE.pattern
+
+    def feed(self, line):
+        self.queued_at = get_log_datetime(line)
+        self.done = True
+
+    def result(self):
+        return self.queued_at
+
+
+class TestStatusExtractor(Extractor):
+    """ (test, conf, status) tuples of all the tests in the log,
+        see `multivac/sensors/test_status.py`.
+    """
+    name = 'test_statuses'
+    steps = (log_steps.RUN,)
+
+    def __init__(self):
+        super().__init__()
+        self.parser = TestStatusParser()
+        self.statuses = []
+
+    def spec(self):
+        return [regexp.pattern for regexp in (test_status.TEST_STATUS_LINE_RE,
+                                              test_status.LATE_STATUS,
+                                              test_status.TEST_HANG_RE,
+                                              test_status.HANG_RESULT_RE)]
+
+    def feed(self, line):
+        self.statuses.extend(self.parser.feed(line))
+
+    def result(self):
+        return self.statuses + self.parser.finish()
+
+
+class DebugTargetExtractor(Extractor):
+    """ Whether the job builds a Debug target: 'True' or 'False'. """
+    name = 'debug'
+    needles = ('| Target:',)
+    steps = (log_steps.RUN,)
+
+    def __init__(self):
+        super().__init__()
+        self.debug = 'False'
+
+    def feed(self, line):
+        if line.endswith('Debug\n'):
+            self.debug = 'True'
+            self.done = True
+
+    def result(self):
+        return self.debug
+
+
+class RunnerVersionExtractor(Extractor):
+    """ Version of the GitHub Actions runner. """
+    name = 'runner_version'
+    needles = ('Current runner version: ', 'Runner Version: ')
+
+    def __init__(self):
+        super().__init__()
+        self.runner_version = 'unknown_runner_version'
+
+    def spec(self):
+        return [self.needles, RUNNER_VERSION_RE.pattern,
+                FREEBSD_RUNNER_VERSION_RE.pattern]
+
+    def feed(self, line):
+        match = RUNNER_VERSION_RE.search(line) or \
+            FREEBSD_RUNNER_VERSION_RE.search(line)
+        if match:
+            self.runner_version = match.group(1)
+            self.done = True
+
+    def result(self):
+        return self.runner_version
+
+
+class CompilerVersionExtractor(Extractor):
+    """ C compiler identification. The last one in the log wins. """
+    name = 'compiler_version'
+    needles = ('C compiler identification is',)
+    steps = (log_steps.RUN,)
+
+    def __init__(self):
+        super().__init__()
+        self.compiler = 'undefined_compiler'
+
+    def spec(self):
+        return [self.needles, COMPILER_RE.pattern]
+
+    def feed(self, line):
+        compiler_match = COMPILER_RE.search(line)
+        if compiler_match:
+            self.compiler = compiler_match.group(1)
+
+    def result(self):
+        return self.compiler
+
+
+class FailureExtractor(Extractor):
+    """ Type of the job failure and the line it was detected by.
+
+        The last line matching one of `specific_specs` wins. If
+        there is no such line, the last line matching one of
+        `generic_specs` wins. Within a line the first matching
+        spec wins.
+
+        A log is searched from the end in one pass over the both
+        spec lists, which stops on a specific match (see
+        `FailureMatcher.last_match()`). Only the last `max_depth`
+        bytes of the log are searched if it is set.
+
+        Returns ('unknown_failure', None) if nothing matches.
+    """
+    name = 'failure'
+    tail = True
+
+    def __init__(self, specific_specs, generic_specs, matcher=None,
+                 max_depth=None):
+        super().__init__()
+        self.matcher = matcher or FailureMatcher(specific_specs,
+                                                 generic_specs)
+        self.max_depth = max_depth
+
+    def spec(self):
+        if self.max_depth is None:
+            return self.matcher.version
+        return [self.matcher.version, self.max_depth]
+
+    def scan_tail(self, data):
+        return self.matcher.last_match(data, self.max_depth) or \
+            ('unknown_failure', None)
+
+
+class LogScanner:
+    """ Feeds all the given extractors from one pass over a log.
+
+        Lines are decolored once per line, only when at least one
+        interested extractor needs it.
+    """
+    def __init__(self, extractors):
+        self.extractors = list(extractors)
+        # The step index of the last scanned log, if it is used.
+        self.step_index = None
+
+    def feed_lines(self, lines):
+        """ Feed the lines to the extractors, which are not done. """
+        active = [e for e in self.extractors if not e.done]
+        if not active:
+            return
+        for line in lines:
+            clean = None
+            finished = False
+            for extractor in active:
+                if extractor.raw:
+                    data = line
+                else:
+                    if clean is None:
+                        clean = decolor(line) if '\033' in line else line
+                    data = clean
+                needles = extractor.needles
+                if needles is not None and \
+                        not any(needle in data for needle in needles):
+                    continue
+                extractor.feed(data)
+                finished = finished or extractor.done
+            if finished:
+                active = [e for e in active if not e.done]
+                if not active:
+                    break
+
+    def scan_lines(self, lines):
+        """ Feed the lines to the extractors and return a dict
+            {extractor name: extractor result}.
+        """
+        self.feed_lines(lines)
+        return {e.name: e.result() for e in self.extractors}
+
+    def scan_steps(self, data, step_index):
+        """ Feed lines of log bytes to the extractors step by step
+            (see `multivac/log_steps.py`): an extractor gets only
+            lines of steps it needs. A step nobody needs is not even
+            decoded. A log without steps (say, a fragment) is fed
+            entirely. Returns the same as `scan_lines()`.
+        """
+        for title, start, end in step_index:
+            kind = log_steps.step_kind(title)
+            extractors = [e for e in self.extractors
+                          if e.steps is None or kind in e.steps or
+                          len(step_index) == 1]
+            if not any(not e.done for e in extractors):
+                continue
+            LogScanner(extractors).feed_lines(iter_lines(data, start, end))
+        return {e.name: e.result() for e in self.extractors}
+
+    def scan(self, log_filepath, step_index=None):
+        """ Scan a log file (maybe compressed, see
+            `multivac/storage.py`). Raises FileNotFoundError if there
+            is no such file.
+
+            Extractors with `tail` set are given the log bytes. The
+            rest are fed from one streaming read of the log or, if
+            there are tail extractors too, from the same log bytes: a
+            compressed log is decompressed once per scan. If some of
+            them need only certain steps, they are fed step by step.
+            The step index is built if it is not passed.
+
+            If only tail extractors with `max_depth` run, only the
+            log tail is kept (see `multivac.storage.map_log()`). A
+            compressed log is still read and decompressed whole then,
+            so `max_depth` bounds the search, memory and temporary
+            files, but not the log reading.
+        """
+        res = {}
+        tail = [e for e in self.extractors if e.tail]
+        forward = [e for e in self.extractors if not e.tail]
+        by_steps = any(e.steps is not None for e in forward)
+        if not tail and not by_steps:
+            with open_log(log_filepath) as log_fh:
+                return LogScanner(forward).scan_lines(log_fh)
+        max_depth = None
+        if not forward and all(e.max_depth is not None for e in tail):
+            max_depth = max(e.max_depth for e in tail)
+        with map_log(log_filepath, max_depth) as data:
+            for extractor in tail:
+                res[extractor.name] = extractor.scan_tail(data)
+            if by_steps:
+                if step_index is None:
+                    step_index = log_steps.build_index(data)
+                self.step_index = step_index
+                res.update(LogScanner(forward).scan_steps(data, step_index))
+            elif forward:
+                res.update(LogScanner(forward).scan_lines(
+                    iter_lines(data, 0, len(data))))
+        return res
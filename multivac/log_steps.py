@@ -0,0 +1,135 @@
+""" Steps of GitHub Actions job logs.
+
+    A job log consists of steps: a step starts with the
+    '##[group]Run <command or action>' line, lines before the first
+    step belong to the 'Set up job' step, and the 'Post job cleanup.'
+    line starts the final cleanup. The step index is a list of
+    [title, start, end] byte offsets of steps in the log (see
+    `multivac.storage.map_log()`).
+
+    `fetch.py` builds the index while it downloads a log (see
+    `IndexBuilder`) and puts it to the sensor store (see
+    `multivac/sensor_store.py`), the log scanner builds it for logs
+    stored before. An extractor may declare kinds
+    of steps it needs (see `Extractor.steps` in
+    `multivac/log_scanner.py`), so steps nobody needs are skipped.
+
+    Most of the data lives in the step that builds and tests the
+    project, so only steps of the job setup and cleanup and of
+    well-known actions (checkout, artifacts, caches) are skipped.
+"""
+
+import hashlib
+import json
+import re
+
+# The sensor name in the sensor store.
+SENSOR = 'steps'
+
+# Bump on a change of the index format or logic.
+REVISION = 1
+
+STEP_MARKERS = (b'##[group]Run ', b'Post job cleanup.')
+GROUP_PREFIX = b'##[group]'
+# A marker should follow a timestamp at the line start.
+LINE_PREFIX_RE = re.compile(rb'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d+Z )?')
+
+SETUP_TITLE = 'Set up job'
+CLEANUP_TITLE = 'Post job cleanup.'
+# Actions, which don't build or test anything.
+KNOWN_ACTIONS_RE = re.compile(r'Run actions/(checkout|upload-artifact|'
+                              r'download-artifact|cache)@')
+
+# Step kinds.
+SETUP = 'setup'
+CLEANUP = 'cleanup'
+ACTION = 'action'
+RUN = 'run'
+
+
+def version():
+    """ Identifies the index logic: an index of another version is
+        not used.
+    """
+    data = json.dumps([REVISION, [marker.decode() for marker in STEP_MARKERS],
+                       LINE_PREFIX_RE.pattern.decode(),
+                       KNOWN_ACTIONS_RE.pattern])
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def step_kind(title):
+    if title == SETUP_TITLE:
+        return SETUP
+    if title == CLEANUP_TITLE:
+        return CLEANUP
+    if KNOWN_ACTIONS_RE.match(title):
+        return ACTION
+    return RUN
+
+
+def step_starts(data):
+    """ Yield (line start, title) of steps in log bytes in the order of
+        markers (see STEP_MARKERS), not of offsets.
+    """
+    for marker in STEP_MARKERS:
+        pos = data.find(marker)
+        while pos != -1:
+            line_start = data.rfind(b'\n', 0, pos) + 1
+            line_end = data.find(b'\n', pos)
+            if line_end == -1:
+                line_end = len(data)
+            if LINE_PREFIX_RE.fullmatch(data, line_start, pos):
+                title = data[pos:line_end]
+                if title.startswith(GROUP_PREFIX):
+                    title = title[len(GROUP_PREFIX):]
+                yield line_start, title.decode(
+                    'utf-8', errors='replace').rstrip('\r')
+            pos = data.find(marker, line_end)
+
+
+def make_index(starts, size):
+    index = []
+    title, start = SETUP_TITLE, 0
+    for line_start, next_title in sorted(starts):
+        index.append([title, start, line_start])
+        title, start = next_title, line_start
+    index.append([title, start, size])
+    return index
+
+
+def build_index(data):
+    """ Index of steps of log bytes: a list of [title, start, end].
+        The first step is 'Set up job' (it is empty if the log starts
+        with a step), the steps cover the whole log.
+    """
+    return make_index(step_starts(data), len(data))
+
+
+class IndexBuilder:
+    """ Builds the step index of a log fed by chunks, say, while it is
+        downloaded. Only the last incomplete line is kept in memory.
+
+        The result is the same as `build_index()` of the whole log.
+    """
+    def __init__(self):
+        self.starts = []
+        # Offset of the incomplete line.
+        self.offset = 0
+        self.tail = b''
+
+    def feed(self, chunk):
+        data = self.tail + chunk
+        end = data.rfind(b'\n') + 1
+        self.add_starts(data[:end])
+        self.offset += end
+        self.tail = data[end:]
+
+    def add_starts(self, data):
+        self.starts.extend((self.offset + line_start, title)
+                           for line_start, title in step_starts(data))
+
+    def finish(self):
+        self.add_starts(self.tail)
+        size = self.offset + len(self.tail)
+        self.offset, self.tail = size, b''
+        return make_index(self.starts, size)
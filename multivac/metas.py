@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+""" Storage of workflow run and job metas.
+
+    `fetch.py` stores a meta of each workflow run and job (a GitHub
+    API object) as `<id>.json` in a shard of the workflow runs or the
+    workflow run jobs directory (see `multivac/storage.py`). Most of
+    the API object is URLs of related API objects, the repository,
+    the head commit and the actor, while the scripts use a dozen of
+    fields. So only fields listed in RUN_FIELDS and JOB_FIELDS are
+    stored, as compact JSON (see `write_meta()`). If the full object
+    is needed, it may be archived to
+    `<owner>/<repo>/raw/<directory>/<shard>/<id>.json.gz` (see
+    `fetch.py --raw-metas`).
+
+    Readers should not care: `find_meta()` locates a meta, `load_meta()`
+    reads both projected and full metas, the former several times
+    faster.
+
+    Run this module as a script to project already stored metas:
+
+        ./multivac/metas.py [--raw] tarantool/tarantool
+"""
+
+import argparse
+import gzip
+import json
+import os
+import re
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_DIR)
+from multivac import storage  # noqa: E402
+
+# Fields of a workflow run meta to store.
+RUN_FIELDS = ('id', 'name', 'workflow_id', 'run_number', 'run_attempt',
+              'event', 'status', 'conclusion', 'head_branch', 'head_sha',
+              'html_url', 'created_at', 'updated_at', 'run_started_at')
+# Fields of a job meta to store. Steps are not stored: they take
+# the most of a job meta, while the log has the same information
+# (see `multivac/log_steps.py`).
+JOB_FIELDS = ('id', 'run_id', 'run_attempt', 'workflow_name', 'name',
+              'head_branch', 'head_sha', 'status', 'conclusion', 'labels',
+              'runner_id', 'runner_name', 'runner_group_name', 'html_url',
+              'created_at', 'started_at', 'completed_at')
+
+META_FILENAME_RE = re.compile(r'^(\d+)\.json$')
+RAW_DIR = 'raw'
+
+
+def project(data, fields):
+    """ The meta with the given fields only. Missing fields are
+        omitted: old metas have no some of them.
+    """
+    return {field: data[field] for field in fields if field in data}
+
+
+def dumps(data):
+    return json.dumps(data, separators=(',', ':'))
+
+
+def meta_path(base_dir, obj_id):
+    """ Path to store a meta in the given directory (workflow runs or
+        workflow run jobs).
+    """
+    return storage.object_path(base_dir, obj_id, '.json')
+
+
+def find_meta(base_dir, obj_id):
+    """ Path to a stored meta. Raises FileNotFoundError if there is no
+        meta.
+    """
+    return storage.find_object(base_dir, obj_id, ('.json',))
+
+
+def meta_name(base_dir, obj_id):
+    """ Path to a meta relative to the given directory, where it
+        would be stored if there is no meta.
+    """
+    try:
+        path = find_meta(base_dir, obj_id)
+    except FileNotFoundError:
+        path = meta_path(base_dir, obj_id)
+    return os.path.relpath(path, base_dir)
+
+
+def raw_path(base_dir, obj_id):
+    """ Path to the raw archive of a meta:
+        `<repo>/<directory>/<shard>/<id>.json.gz` ->
+        `<repo>/raw/<directory>/<shard>/<id>.json.gz`.
+    """
+    repo_path, directory = os.path.split(os.path.normpath(base_dir))
+    return storage.object_path(os.path.join(repo_path, RAW_DIR, directory),
+                               obj_id, '.json.gz')
+
+
+def write_file(path, data):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def write_raw(base_dir, obj_id, data):
+    path = raw_path(base_dir, obj_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file(path, gzip.compress(dumps(data).encode()))
+
+
+def write_meta(base_dir, obj_id, data, fields, raw=False):
+    """ Store the given fields of a meta. The full meta is archived
+        too if `raw` is set. Returns a path to the stored meta.
+    """
+    if raw:
+        write_raw(base_dir, obj_id, data)
+    path = meta_path(base_dir, obj_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file(path, dumps(project(data, fields)).encode())
+    return path
+
+
+def load_meta(path):
+    """ Load a stored meta (projected or full). """
+    with open(path, 'rb') as f:
+        return json.loads(f.read())
+
+
+def migrate(repo_path, raw=False):
+    """ Project stored metas of a repository, archive full ones if
+        `raw` is set.
+    """
+    saved = 0
+    count = 0
+    for directory, fields in (('workflow_runs', RUN_FIELDS),
+                              ('workflow_run_jobs', JOB_FIELDS)):
+        base_dir = os.path.join(repo_path, directory)
+        if not os.path.isdir(base_dir):
+            continue
+        for filename, rel_path in sorted(storage.iter_files(base_dir)):
+            match = META_FILENAME_RE.match(filename)
+            if not match:
+                continue
+            path = os.path.join(base_dir, rel_path)
+            size = os.path.getsize(path)
+            data = load_meta(path)
+            projected = dumps(project(data, fields)).encode()
+            if len(projected) == size:
+                continue
+            # A meta projected with other fields is not archived over
+            # the full one.
+            obj_id = match.group(1)
+            if raw and not os.path.exists(raw_path(base_dir, obj_id)):
+                write_raw(base_dir, obj_id, data)
+            # The meta is rewritten in place: see `storage.reshard()`
+            # to move it to a shard.
+            write_file(path, projected)
+            count += 1
+            saved += size - os.path.getsize(path)
+    print('Projected {} metas, saved {:.1f} MiB'.format(
+        count, saved / 1024 / 1024), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Store only used fields of workflow run and job metas')
+    parser.add_argument('--raw', action='store_true',
+                        help='Archive full metas to <owner>/<repo>/raw')
+    parser.add_argument('repo_path', type=str,
+                        help='owner/repository')
+    args = parser.parse_args()
+
+    migrate(args.repo_path, args.raw)
@@ -2,21 +2,13 @@
 
 import math
 import os
-import glob
-import re
-import json
+import sys
 from datetime import datetime, timedelta
 import argparse
 
-
-parser = argparse.ArgumentParser(description='Machine time spent in jobs')
-parser.add_argument('--short', action='store_true',
-                    help="Coalesce 'runs-on' labels by a first word")
-args = parser.parse_args()
-
-
-workflow_runs_dir = 'workflow_runs'
-workflow_run_jobs_dir = 'workflow_run_jobs'
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_DIR)
+from multivac.job_index import JobIndex  # noqa: E402
 
 
 def timestamp(timestamp_from_github):
@@ -45,66 +37,81 @@ def print_minutes(header, acc, k2_list):
         print('{} {}'.format(k1, summary_str))
 
 
-JOB_META_PATH_RE = re.compile(r'^{}/[0-9]+.json$'.format(
-    workflow_run_jobs_dir))
-
-# Splitted by day / week / month, then by 'runs-on'.
-minutes_per_day = dict()
-minutes_per_week = dict()
-minutes_per_month = dict()
-
-known_runs_on = set()
-
-for job_meta_path in glob.glob(os.path.join(workflow_run_jobs_dir, '*.json')):
-    # Skip everything except workflow run job meta:
-    # say, *.log.test_status.cache.json files.
-    if not JOB_META_PATH_RE.match(job_meta_path):
-        continue
-
-    # Load job meta.
-    with open(job_meta_path, 'r') as f:
-        job = json.load(f)
-
-    # Load workflow run meta.
-    run_id = str(job['run_id'])
-    run_meta_path = os.path.join(workflow_runs_dir, run_id + '.json')
-    with open(run_meta_path, 'r') as f:
-        run = json.load(f)
-
-    if job['conclusion'] == 'skipped':
-        continue
-
-    started_at = timestamp(job['started_at'])
-    completed_at = timestamp(job['completed_at'])
-    # I hope GitHub does not count 1.5 minutes job as 2 minutes.
-    minutes = (completed_at - started_at) / timedelta(minutes=1)
-
-    day = started_at.strftime('%Y-%m-%d')
-    week = started_at.strftime('%Y-W%W')
-    month = started_at.strftime('%Y-%m-*')
-
-    # The idea of the --short option is that a user may not be
-    # interested in separate minutes for, say, ubuntu-18.04 and
-    # ubuntu-20.04. So we can just cut off everything after '-'.
-    labels = job['labels']
-    if args.short:
-        labels = [label.split('-', 1)[0] for label in labels]
-    runs_on = ','.join(labels)
-    known_runs_on.add(runs_on)
-
-    add_minutes(minutes_per_day, day, runs_on, minutes)
-    add_minutes(minutes_per_week, week, runs_on, minutes)
-    add_minutes(minutes_per_month, month, runs_on, minutes)
-
-known_runs_on = sorted(known_runs_on)
-
-print('Minutes per day:')
-print_minutes('YYYY-MM-DD', minutes_per_day, known_runs_on)
-print('')
-
-print('Minutes per week:')
-print_minutes('YYYY-.WW', minutes_per_week, known_runs_on)
-print('')
-
-print('Minutes per month:')
-print_minutes('YYYY-MM-*', minutes_per_month, known_runs_on)
+def collect_minutes(repo_path, short=False):
+    """ Minutes spent in jobs per day, week and month split by
+        'runs-on' labels.
+
+        Returns a dict with the 'day', 'week', 'month' and 'runs_on'
+        (a sorted list of seen labels) keys.
+    """
+    # Splitted by day / week / month, then by 'runs-on'.
+    minutes_per_day = dict()
+    minutes_per_week = dict()
+    minutes_per_month = dict()
+
+    known_runs_on = set()
+
+    job_index = JobIndex(repo_path)
+    job_index.update()
+    for job in job_index.jobs():
+        if job['conclusion'] == 'skipped':
+            continue
+
+        started_at = timestamp(job['started_at'])
+        completed_at = timestamp(job['completed_at'])
+        # I hope GitHub does not count 1.5 minutes job as 2 minutes.
+        minutes = (completed_at - started_at) / timedelta(minutes=1)
+
+        day = started_at.strftime('%Y-%m-%d')
+        week = started_at.strftime('%Y-W%W')
+        month = started_at.strftime('%Y-%m-*')
+
+        # The idea of the --short option is that a user may not be
+        # interested in separate minutes for, say, ubuntu-18.04 and
+        # ubuntu-20.04. So we can just cut off everything after '-'.
+        labels = job['labels']
+        if short:
+            labels = [label.split('-', 1)[0] for label in labels]
+        runs_on = ','.join(labels)
+        known_runs_on.add(runs_on)
+
+        add_minutes(minutes_per_day, day, runs_on, minutes)
+        add_minutes(minutes_per_week, week, runs_on, minutes)
+        add_minutes(minutes_per_month, month, runs_on, minutes)
+    job_index.close()
+
+    return {
+        'day': minutes_per_day,
+        'week': minutes_per_week,
+        'month': minutes_per_month,
+        'runs_on': sorted(known_runs_on),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Machine time spent in jobs')
+    parser.add_argument('--short', action='store_true',
+                        help="Coalesce 'runs-on' labels by a first word")
+    parser.add_argument('--repo-path', type=str, default='.',
+                        help='directory with stored workflow runs and jobs, '
+                             'owner/repository (default: the current '
+                             'directory)')
+    args = parser.parse_args(argv)
+
+    minutes = collect_minutes(args.repo_path, args.short)
+    known_runs_on = minutes['runs_on']
+
+    print('Minutes per day:')
+    print_minutes('YYYY-MM-DD', minutes['day'], known_runs_on)
+    print('')
+
+    print('Minutes per week:')
+    print_minutes('YYYY-.WW', minutes['week'], known_runs_on)
+    print('')
+
+    print('Minutes per month:')
+    print_minutes('YYYY-MM-*', minutes['month'], known_runs_on)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+""" Store of data extracted from job logs.
+
+    Results of sensors and log extractors (test statuses, the failure
+    type, runner and compiler versions, see `multivac/log_scanner.py`
+    and `multivac/sensors/`), step indexes (see `multivac/log_steps.py`)
+    and checksums of logs are kept in one SQLite database per
+    repository, keyed by the job ID and the sensor name, instead of a
+    cache file per log.
+
+    A result is valid while the sensor version is the same and the
+    log is the same: it is identified by the file name, the size and
+    the modification time. A log is never rewritten under the same
+    name (see `multivac/storage.py`), so bulk reads (see `results()`)
+    compare only the file name with the one in the job index and
+    don't touch the logs at all.
+
+    Run this module as a script to see how many results are stored:
+
+        ./multivac/sensor_store.py tarantool/tarantool
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_DIR)
+from multivac import log_steps  # noqa: E402
+from multivac.log_scanner import LogScanner  # noqa: E402
+
+# Bump on a schema change: the store is recreated then.
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE results (
+    job_id INTEGER NOT NULL,
+    sensor TEXT NOT NULL,
+    version TEXT NOT NULL,
+    -- The log the result is extracted from: the file name (without
+    -- the shard directory, see `multivac/storage.py`), the size and
+    -- the modification time.
+    log TEXT NOT NULL,
+    log_size INTEGER NOT NULL,
+    log_mtime_ns INTEGER NOT NULL,
+    -- The job start time, for reading results of a time range.
+    started_at TEXT,
+    -- JSON.
+    value TEXT NOT NULL,
+    PRIMARY KEY (job_id, sensor)
+);
+CREATE INDEX results_sensor_started_at ON results (sensor, started_at);
+'''
+
+# SHA-256 of a log stored by `fetch.py` when it downloads the log.
+LOG_CHECKSUM = 'log_sha256'
+
+# Several processes may write at once (see `gather_data.py --jobs`).
+BUSY_TIMEOUT = 60
+
+
+def default_store_path(repo_path):
+    return os.path.join('.cache', 'sensors', repo_path + '.sqlite3')
+
+
+def fingerprint(log_filepath):
+    """ (file name, size, modification time) of a log. Raises
+        FileNotFoundError if there is no such file.
+    """
+    st = os.stat(log_filepath)
+    return os.path.basename(log_filepath), st.st_size, st.st_mtime_ns
+
+
+class SensorStore:
+    """ SQLite store of sensor results of a repository.
+
+        The connection is opened on first use in each process, so
+        the store may be passed to worker processes. Thread safe: the
+        connection is shared between threads of a process under a
+        lock.
+    """
+    def __init__(self, repo_path, store_path=None):
+        self.store_path = store_path or default_store_path(repo_path)
+        self.conn = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'store_path': self.store_path}
+
+    def __setstate__(self, state):
+        self.__init__(None, state['store_path'])
+
+    def connect(self):
+        """ The connection of this process. Call under the lock. """
+        if self.conn and self.pid == os.getpid():
+            return self.conn
+        store_dir = os.path.dirname(self.store_path)
+        if store_dir and not os.path.isdir(store_dir):
+            os.makedirs(store_dir, exist_ok=True)
+        self.conn = sqlite3.connect(self.store_path, timeout=BUSY_TIMEOUT,
+                                    check_same_thread=False)
+        self.pid = os.getpid()
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            with self.conn:
+                self.conn.execute('DROP TABLE IF EXISTS results')
+                self.conn.executescript(SCHEMA)
+                self.conn.execute('PRAGMA user_version = {}'.format(
+                    SCHEMA_VERSION))
+        return self.conn
+
+    def close(self):
+        with self.lock:
+            if self.conn and self.pid == os.getpid():
+                self.conn.close()
+            self.conn = None
+
+    def get(self, job_id, log_fingerprint, versions):
+        """ Results of the given sensors ({name: version}) for a job
+            log with the given fingerprint. Missing and stale results
+            are omitted.
+        """
+        with self.lock:
+            rows = self.connect().execute(
+                'SELECT sensor, version, log, log_size, log_mtime_ns, value '
+                'FROM results WHERE job_id = ?', (job_id,)).fetchall()
+        res = {}
+        for sensor, version, *log, value in rows:
+            if versions.get(sensor) == version and \
+                    tuple(log) == tuple(log_fingerprint):
+                res[sensor] = json.loads(value)
+        return res
+
+    def put(self, job_id, log_fingerprint, results, started_at=None):
+        """ Store results of sensors ({name: (version, value)}) for a
+            job log with the given fingerprint.
+        """
+        self.put_many([(job_id, log_fingerprint, results, started_at)])
+
+    def put_many(self, items):
+        """ Same as `put()` for each of (job ID, log fingerprint,
+            results, started at) items, in one transaction.
+        """
+        rows = [(job_id, sensor, version) + tuple(log_fingerprint) +
+                (started_at, json.dumps(value))
+                for job_id, log_fingerprint, results, started_at in items
+                for sensor, (version, value) in results.items()]
+        if not rows:
+            return
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO results '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def results(self, sensor, version, since=None, till=None):
+        """ Results of a sensor for jobs started in [since, till]
+            (ISO 8601 times as in job metas, the both are optional):
+            {job ID: (log file name, value)}.
+        """
+        query = 'SELECT job_id, log, value FROM results ' \
+                'WHERE sensor = ? AND version = ?'
+        params = [sensor, version]
+        if since is not None:
+            query += ' AND started_at >= ?'
+            params.append(since)
+        if till is not None:
+            query += ' AND started_at <= ?'
+            params.append(till)
+        with self.lock:
+            rows = self.connect().execute(query, params).fetchall()
+        return {job_id: (log, json.loads(value))
+                for job_id, log, value in rows}
+
+    def scan(self, job_id, log_filepath, extractors, started_at=None):
+        """ Same as `LogScanner(extractors).scan(log_filepath)`, but
+            results of extractors are taken from the store when they
+            are valid. Only the missing or stale extractors are fed
+            from the log. Tuples in the results become lists.
+
+            The step index of the log (see `multivac/log_steps.py`) is
+            taken from the store too or stored if it is built.
+        """
+        log_fingerprint = fingerprint(log_filepath)
+        versions = {extractor.name: extractor.version
+                    for extractor in extractors}
+        versions[log_steps.SENSOR] = log_steps.version()
+        res = self.get(job_id, log_fingerprint, versions)
+        step_index = res.pop(log_steps.SENSOR, None)
+        stale = [extractor for extractor in extractors
+                 if extractor.name not in res]
+        if not stale:
+            return res
+
+        scanner = LogScanner(stale)
+        data = json.loads(json.dumps(scanner.scan(log_filepath, step_index)))
+        results = {extractor.name: (extractor.version, data[extractor.name])
+                   for extractor in stale}
+        if step_index is None and scanner.step_index is not None:
+            results[log_steps.SENSOR] = (log_steps.version(),
+                                         scanner.step_index)
+        self.put(job_id, log_fingerprint, results, started_at)
+        res.update(data)
+        return res
+
+    def counts(self):
+        """ {sensor: number of results}. """
+        with self.lock:
+            return dict(self.connect().execute(
+                'SELECT sensor, COUNT(*) FROM results GROUP BY sensor'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Show the number of stored sensor results')
+    parser.add_argument('repo_path', type=str,
+                        help='owner/repository')
+    args = parser.parse_args()
+
+    store = SensorStore(args.repo_path)
+    for sensor, count in sorted(store.counts().items()):
+        print('{}: {}'.format(sensor, count))
+    store.close()
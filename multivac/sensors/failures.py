@@ -1,5 +1,9 @@
+import hashlib
+import json
 import re
 
+from multivac.storage import reverse_windows
+
 failure_categories = [
     {
         'tag': 'git',
@@ -259,3 +263,256 @@ def compile_failure_specs(failure_specs):
         failure_type.update(
             {'re_compiled': [re.compile(expression) for expression in failure_type['re']]}
         )
+
+
+# Characters that have a special meaning in a regular expression
+# outside of a character class.
+RE_SPECIAL_CHARS = '.^$*+?{}[]()|\\'
+
+
+def required_literals(pattern):
+    """ Return fixed fragments, which are present in every string
+        matched by the `pattern` regular expression.
+
+        The analysis is conservative: everything inside groups and
+        character classes is skipped, a character followed by an
+        optional quantifier is dropped and an empty list is returned
+        for patterns with a top level alternation or inline flags.
+    """
+    if pattern.startswith('(?'):
+        return []
+    fragments = []
+    fragment = ''
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            escaped = pattern[i + 1:i + 2]
+            i += 2
+            if depth:
+                continue
+            if escaped.isalnum() or not escaped:
+                # \d, \s, \b and so on: not a literal.
+                fragments.append(fragment)
+                fragment = ''
+            else:
+                fragment += escaped
+            continue
+        if c == '[':
+            # Skip the character class: a closing bracket right
+            # after the opening one (or after '^') is a literal.
+            i += 1
+            if pattern[i:i + 1] == '^':
+                i += 1
+            if pattern[i:i + 1] == ']':
+                i += 1
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+            i += 1
+            if not depth:
+                fragments.append(fragment)
+                fragment = ''
+            continue
+        i += 1
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        if depth or c == ')':
+            fragments.append(fragment)
+            fragment = ''
+            continue
+        if c == '|':
+            return []
+        if c in '*?{':
+            # The previous character is optional.
+            fragment = fragment[:-1]
+            if c == '{':
+                i = pattern.index('}', i) + 1
+        if c in RE_SPECIAL_CHARS and c not in ']}':
+            fragments.append(fragment)
+            fragment = ''
+            continue
+        fragment += c
+    fragments.append(fragment)
+    return [fragment for fragment in fragments if fragment]
+
+
+class FailureMatcher:
+    """ All the failure specs compiled into one prefiltered matcher.
+
+        Every regular expression contributes its longest fixed
+        fragment to a set of literals. A line is checked against
+        the regular expressions only when it contains at least one
+        of the literals (expressions without a fixed fragment are
+        checked on every line). All the expressions are joined into
+        one alternation with a named group per expression, so a
+        candidate line is matched once.
+
+        Specific failure specs go first in the alternation, so they
+        win over generic ones on the same line, just like the specs
+        order wins within a spec list.
+
+        The expressions must not use named groups or backreferences
+        by number.
+    """
+    def __init__(self, specific_specs, generic_specs=()):
+        self.types = []
+        self.is_specific = []
+        literals = {}
+        self.check_every_line = False
+        alternatives = []
+        for specific, failure_specs in ((True, specific_specs),
+                                        (False, generic_specs)):
+            for failure_type in failure_specs:
+                for expression in failure_type['re']:
+                    group = 'f{}'.format(len(self.types))
+                    self.types.append(failure_type['type'])
+                    self.is_specific.append(specific)
+                    alternatives.append('(?P<{}>{})'.format(group, expression))
+                    fragments = required_literals(expression)
+                    if fragments:
+                        literals[max(fragments, key=len)] = True
+                    else:
+                        self.check_every_line = True
+        self.regexp = re.compile('|'.join(alternatives))
+        # Identifies the set of specs and their order.
+        spec_data = json.dumps([[failure_type['type'], failure_type['re']]
+                                for failure_specs in (specific_specs,
+                                                      generic_specs)
+                                for failure_type in failure_specs])
+        self.version = hashlib.sha1(spec_data.encode()).hexdigest()
+        # A literal containing another one gives no new candidate
+        # lines: skip it.
+        self.literals = [literal for literal in literals
+                         if not any(other != literal and other in literal
+                                    for other in literals)]
+        self.byte_literals = [literal.encode() for literal in self.literals]
+        self.has_specific = any(self.is_specific)
+
+    def match(self, line):
+        """ Return (failure type, is specific) for the first spec,
+            which matches the line, or None.
+        """
+        if not self.check_every_line and \
+                not any(literal in line for literal in self.literals):
+            return None
+        m = self.regexp.match(line)
+        if not m:
+            return None
+        index = int(m.lastgroup[1:])
+        return self.types[index], self.is_specific[index]
+
+    def candidates(self, text):
+        """ Yield lines of the `text` block, which contain at least
+            one of the literals, in the order they follow in the
+            block. Lines are yielded without the trailing newline.
+        """
+        if self.check_every_line:
+            lines = text.split('\n')
+            if not lines[-1]:
+                lines.pop()
+            yield from lines
+            return
+        starts = set()
+        for literal in self.literals:
+            pos = text.find(literal)
+            while pos != -1:
+                start = text.rfind('\n', 0, pos) + 1
+                starts.add(start)
+                end = text.find('\n', pos)
+                if end == -1:
+                    break
+                pos = text.find(literal, end)
+        for start in sorted(starts):
+            end = text.find('\n', start)
+            yield text[start:] if end == -1 else text[start:end]
+
+    def last_matches(self, lines):
+        """ Return ((failure type, line), (failure type, line)) for
+            the last lines matching a specific and a generic spec
+            correspondingly. None is used in place of a pair when
+            there is no such line.
+
+            Lines are processed as one block, so the substring
+            search over the literals runs at C speed instead of once
+            per line.
+        """
+        specific = generic = None
+        for line in self.candidates(''.join(lines)):
+            res = self.match(line)
+            if res is None:
+                continue
+            failure_type, is_specific = res
+            if is_specific:
+                specific = (failure_type, line)
+            else:
+                generic = (failure_type, line)
+        return specific, generic
+
+    def byte_candidates(self, data, start=0, end=None):
+        """ Same as `candidates()` for log bytes in [start, end) (see
+            `multivac.storage.map_log()`): only candidate lines are
+            decoded. '\r\n' and '\r' are line separators too, like
+            in the universal newlines mode.
+        """
+        if end is None:
+            end = len(data)
+        if self.check_every_line:
+            spans = []
+            pos = start
+            while pos < end:
+                line_end = data.find(b'\n', pos, end)
+                line_end = end if line_end == -1 else line_end
+                spans.append((pos, line_end))
+                pos = line_end + 1
+        else:
+            starts = set()
+            for literal in self.byte_literals:
+                pos = data.find(literal, start, end)
+                while pos != -1:
+                    starts.add(data.rfind(b'\n', start, pos) + 1 or start)
+                    line_end = data.find(b'\n', pos, end)
+                    if line_end == -1:
+                        break
+                    pos = data.find(literal, line_end, end)
+            spans = []
+            for line_start in sorted(starts):
+                line_end = data.find(b'\n', line_start, end)
+                spans.append((line_start,
+                              end if line_end == -1 else line_end))
+        for line_start, line_end in spans:
+            text = data[line_start:line_end].decode('utf-8', errors='replace')
+            if '\r' in text:
+                lines = text.replace('\r\n', '\n').replace('\r', '\n')
+                yield from lines.rstrip('\n').split('\n')
+            else:
+                yield text
+
+    def last_match(self, data, max_depth=None):
+        """ Return (failure type, line) for the last line matching a
+            specific spec or, if there is no such line, for the last
+            line matching a generic spec, or None.
+
+            The same as `last_matches()` gives, but log bytes (see
+            `multivac.storage.map_log()`) are searched from the end in
+            one backward pass: it stops on a specific match. Only the
+            last `max_depth` bytes are searched if it is set.
+        """
+        generic = None
+        for start, end in reverse_windows(data, max_depth=max_depth):
+            for line in reversed(list(self.byte_candidates(data, start,
+                                                           end))):
+                res = self.match(line)
+                if res is None:
+                    continue
+                failure_type, is_specific = res
+                if is_specific:
+                    return failure_type, line
+                if generic is None:
+                    generic = (failure_type, line)
+                    # Nothing can take priority over it.
+                    if not self.has_specific:
+                        return generic
+        return generic
@@ -1,11 +1,19 @@
 #!/usr/bin/env python
 
+import hashlib
+import mmap
 import os
 import sys
 import re
 import json
 from collections import OrderedDict
 
+if __name__ == '__main__':
+    # Run as a script: the multivac package is not importable then.
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))))
+from multivac.storage import map_log  # noqa: E402
+
 
 SEP_RE = r' +'
 TIMESTAMP_RE = r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}.\d+Z'
@@ -36,62 +44,122 @@ HANG_RESULT_RE = re.compile(
 # match lines with late test result: [ <worker_id> ] [ <result> ]
 LATE_STATUS = re.compile(r'.*(?P<wid>\[\d+\]) \[ (?P<res>[a-z]+) ]')
 
+# A log line may change the `TestStatusParser` state only if it
+# contains one of these byte sequences: a status ('[ pass ]'), a
+# late status ('[001] [ pass ]') or a hang. A test without a status
+# yet is reported by a line ending with spaces (see the empty
+# STATUS_RE). A line after a hang is checked against HANG_RESULT_RE
+# anyway.
+#
+# ' ]' is used instead of '[ ' for statuses: the latter appears in
+# each line of the build progress ('[ 10%] Building C object...').
+CANDIDATE_MARKERS = (b' ]', b'Test hung!', b' \n', b' \r')
+
+
+# Bump on a change of the parser logic or the cache format.
+CACHE_REVISION = 2
+
+CACHE_FORMAT = 'multivac test status cache'
+
 
 def get_cache_filepath(log_filepath):
-    return '{}.test_status.cache.json'.format(log_filepath)
+    return '{}.test_status.cache.jsonl'.format(log_filepath)
 
 
-def test_status_iter(log_fh, cache_filepath=None):
-    """ Iterator generator, which accepts a log file handle
-        (which contains an output of a CI job) and yields
-        (test, conf, status) tuples.
+def version():
+    """ Identifies the parser: a cache of another version is not
+        used.
+    """
+    data = json.dumps([CACHE_REVISION, [regexp.pattern for regexp in (
+        TEST_STATUS_LINE_RE, LATE_STATUS, TEST_HANG_RE, HANG_RESULT_RE)]])
+    return hashlib.sha1(data.encode()).hexdigest()
 
-        Caches result in the 'cache_filepath' file when its name
-        is provided. Reuses the existing cache on next
-        invocations.
+
+def load_cache(cache_filepath):
+    """ Read (test, conf, status) tuples from a cache file.
+
+        The file is JSON Lines: a header with the format, the parser
+        version and the number of tuples, then a tuple per line.
+        Returns None if there is no such file or it is written by
+        another parser version or it is broken.
     """
-    if cache_filepath:
-        if os.path.isfile(cache_filepath):
-            with open(cache_filepath, 'r') as cache_fh:
-                data = json.load(cache_fh)
-            for test_status in data:
-                yield tuple(test_status)
-            return
+    try:
+        with open(cache_filepath, 'r') as f:
+            header = json.loads(f.readline())
+            if header.get('format') != CACHE_FORMAT or \
+                    header.get('version') != version():
+                return None
+            res = [tuple(json.loads(line)) for line in f]
+    except (FileNotFoundError, ValueError, AttributeError):
+        return None
+    if len(res) != header.get('count'):
+        return None
+    return res
 
-        cache = []
 
-    hang_detected = False
+def store_cache(cache_filepath, test_statuses):
+    """ Write (test, conf, status) tuples to a cache file, see
+        `load_cache()`.
 
-    awaiting_tests = {}
-    for line in log_fh:
+        The file is written under a temporary name and renamed, so
+        an interrupted run doesn't leave a broken cache.
+    """
+    header = {
+        'format': CACHE_FORMAT,
+        'version': version(),
+        'count': len(test_statuses),
+    }
+    tmp_path = '{}.{}.tmp'.format(cache_filepath, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps(header) + '\n')
+        for test_status in test_statuses:
+            f.write(json.dumps(test_status, separators=(',', ':')) + '\n')
+    os.replace(tmp_path, cache_filepath)
+
+
+class TestStatusParser:
+    """ Push-style parser of test statuses.
+
+        Accepts log lines one by one with `feed()` and returns
+        (test, conf, status) tuples as soon as they are known.
+        It allows to parse test statuses together with other
+        data in a single pass over a log file (see
+        `multivac/log_scanner.py`).
+    """
+    def __init__(self):
+        self.hang_detected = False
+        self.awaiting_tests = {}
+
+    def feed(self, line):
+        """ Parse a next log line and return a list of
+            (test, conf, status) tuples found in it.
+        """
+        res = []
         m = TEST_STATUS_LINE_RE.match(line)
 
         if m:
             if not m.group('status'):
-                awaiting_tests.update({m['wid']: (m['test'], m['conf'])})
-                continue
+                self.awaiting_tests.update({m['wid']: (m['test'], m['conf'])})
+                return res
             status = m.group('status')
-            res = (m['test'], m['conf'], status)
-            if cache_filepath:
-                cache.append(res)
-            yield res
-            continue
-        elif awaiting_tests:
+            res.append((m['test'], m['conf'], status))
+            return res
+        elif self.awaiting_tests:
             status_match = LATE_STATUS.match(line)
             if status_match:
-                matched_test = awaiting_tests.pop(status_match.group('wid'))
-                res = (matched_test[0],
-                       matched_test[1],
-                       status_match.group('res'))
-                yield res
+                matched_test = self.awaiting_tests.pop(
+                    status_match.group('wid'))
+                res.append((matched_test[0],
+                            matched_test[1],
+                            status_match.group('res')))
 
         m = TEST_HANG_RE.match(line)
         if m:
-            hang_detected = True
-            continue
+            self.hang_detected = True
+            return res
 
-        if hang_detected:
-            hang_detected = False
+        if self.hang_detected:
+            self.hang_detected = False
             m = HANG_RESULT_RE.match(line)
             if m:
                 result = m['result']
@@ -102,23 +170,123 @@ def test_status_iter(log_fh, cache_filepath=None):
                 # .test.sql, .test.py, .test.sql or just .test.
                 test = result.split('.', 1)[0] + '.test.lua'
                 # We don't know a configuration, assume None.
-                res = (test, None, 'hang')
-                if cache_filepath:
-                    cache.append(res)
-                yield res
-                continue
+                res.append((test, None, 'hang'))
+        return res
+
+    def finish(self):
+        """ Return (test, conf, status) tuples for tests, which
+            have no result at the end of the log. They're
+            reported as failed.
+        """
+        res = []
+        for wid in self.awaiting_tests:
+            test = self.awaiting_tests.get(wid)  # (test name, test conf)
+            res.append((test[0], test[1], 'fail'))
+        self.awaiting_tests = {}
+        return res
+
+
+def test_status_line_iter(log_fh):
+    """ Feed all lines of the log file handle to the parser and
+        yield (test, conf, status) tuples.
+    """
+    parser = TestStatusParser()
+    for line in log_fh:
+        yield from parser.feed(line)
 
     # if there are tests with no result, save them as failed.
-    for wid in awaiting_tests:
-        res = awaiting_tests.get(wid)  # get tuple (test name, test conf)
-        yield (res[0], res[1], 'fail')
+    yield from parser.finish()
+
+
+def split_lines(text):
+    """ Split a text into lines like the universal newlines mode
+        does: '\r\n' and '\r' are converted to '\n'.
+    """
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = text.split('\n')
+    res = [line + '\n' for line in lines[:-1]]
+    if lines[-1]:
+        res.append(lines[-1])
+    return res
+
+
+def test_status_buffer_iter(data):
+    """ The same as `test_status_line_iter()`, but accepts bytes of a
+        log (say, a memory map, see `multivac.storage.map_log()`).
+
+        Only lines, which contain one of CANDIDATE_MARKERS, are
+        decoded and fed to the parser: they are found using fast
+        byte searches, while the rest of the log is skipped. The
+        result is the same for a valid UTF-8 log.
+    """
+    size = len(data)
+    find = data.find
+    markers = list(CANDIDATE_MARKERS)
+    # The last line with trailing spaces and without a newline.
+    if size and data[size - 1:size] == b' ':
+        markers.append(None)
+    # Next positions of the markers, `size` if there are no more.
+    next_pos = []
+    for marker in markers:
+        p = find(marker) if marker else size - 1
+        next_pos.append(size if p == -1 else p)
+
+    parser = TestStatusParser()
+    pos = 0
+    while pos < size:
+        if parser.hang_detected:
+            start = pos
+        else:
+            first = min(next_pos)
+            if first == size:
+                break
+            start = data.rfind(b'\n', pos, first) + 1 or pos
+        end = find(b'\n', start)
+        end = size if end == -1 else end + 1
+        # GitHub logs have '\r\n' line endings. A sole '\r' is a
+        # line separator too, so it may be several lines.
+        for line in split_lines(data[start:end].decode('utf-8')):
+            yield from parser.feed(line)
+        pos = end
+        for i, marker in enumerate(markers):
+            if next_pos[i] < pos:
+                p = find(marker, pos) if marker else -1
+                next_pos[i] = size if p == -1 else p
+
+    yield from parser.finish()
+
+
+def test_status_iter(log, cache_filepath=None):
+    """ Iterator generator, which accepts a log file handle
+        or bytes of a log (which contains an output of a CI job)
+        and yields (test, conf, status) tuples.
+
+        Caches result in the 'cache_filepath' file when its name
+        is provided. Reuses the existing cache of the same parser
+        version on next invocations (see `load_cache()`).
+    """
+    if cache_filepath:
+        cache = load_cache(cache_filepath)
+        if cache is not None:
+            yield from cache
+            return
+        cache = []
+
+    if isinstance(log, (bytes, mmap.mmap)):
+        test_statuses = test_status_buffer_iter(log)
+    else:
+        test_statuses = test_status_line_iter(log)
+    for res in test_statuses:
+        if cache_filepath:
+            cache.append(res)
+        yield res
 
     if cache_filepath:
-        with open(cache_filepath, 'w') as cache_fh:
-            json.dump(cache, cache_fh, indent=2)
+        store_cache(cache_filepath, cache)
 
 
-def test_smart_status_iter(log_fh, cache_filepath=None):
+def test_smart_status_iter(log, cache_filepath=None):
     """ Iterator generator that yields (test, conf, status)
         tuples.
 
@@ -126,8 +294,15 @@ def test_smart_status_iter(log_fh, cache_filepath=None):
         iterator squashes duplicates and reports 'transient fail'
         status for a test, which fails, run again and succeeds.
     """
+    return squash_test_statuses(test_status_iter(log, cache_filepath))
+
+
+def squash_test_statuses(test_statuses):
+    """ Squash (test, conf, status) tuples as described in
+        `test_smart_status_iter()`.
+    """
     tmp = OrderedDict()
-    for test, conf, status in test_status_iter(log_fh, cache_filepath):
+    for test, conf, status in test_statuses:
         key = (test, conf)
         if status == 'pass' and tmp.get(key) == 'fail':
             status = 'transient fail'
@@ -137,24 +312,35 @@ def test_smart_status_iter(log_fh, cache_filepath=None):
         yield test, conf, status
 
 
-def execute(log_filepath):
+def execute(log_filepath, cache_filepath=None):
     """ External API for the smart test status iterator.
 
         The result format is designed to provide some level of
         unification between different sensors. The event
         dictionary for the 'test status' event contains `test`,
         `conf` and `status` fields (except common `event` field).
+
+        Caches results in the 'cache_filepath' file when its name
+        is provided (see `get_cache_filepath()`). Reports keep test
+        statuses in the sensor store instead (see
+        `multivac/sensor_store.py`).
     """
-    cache_filepath = get_cache_filepath(log_filepath)
-    with open(log_filepath, 'r') as log_fh:
-        for test, conf, status in test_smart_status_iter(
-                log_fh, cache_filepath):
-            yield {
-                'event': 'test status',
-                'test': test,
-                'conf': conf,
-                'status': status,
-            }
+    # The log is not opened at all on a cache hit.
+    test_statuses = None
+    if cache_filepath:
+        test_statuses = load_cache(cache_filepath)
+    if test_statuses is None:
+        with map_log(log_filepath) as data:
+            test_statuses = list(test_status_iter(data))
+        if cache_filepath:
+            store_cache(cache_filepath, test_statuses)
+    for test, conf, status in squash_test_statuses(test_statuses):
+        yield {
+            'event': 'test status',
+            'test': test,
+            'conf': conf,
+            'status': status,
+        }
 
 
 if __name__ == '__main__':
@@ -164,10 +350,6 @@ if __name__ == '__main__':
         prints test statuses in a simple format that may be
         grepped or parsed from arbitrary language.
     """
-    log_filepath = sys.argv[1]
-    cache_filepath = get_cache_filepath(log_filepath)
-    with open(log_filepath, 'r') as log_fh:
-        for test, conf, status in test_smart_status_iter(
-                log_fh, cache_filepath):
-            print('event: test status; test: {}; conf: {}; status: {}'.format(
-                test, conf or 'null', status))
+    for event in execute(sys.argv[1]):
+        print('event: test status; test: {}; conf: {}; status: {}'.format(
+            event['test'], event['conf'] or 'null', event['status']))
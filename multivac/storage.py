@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+
+""" Storage of workflow run job logs and the layout of workflow run
+    and job files.
+
+    Files of a workflow run or a job `<id>` (the meta, the log and
+    caches) are stored in a shard subdirectory of the workflow runs or
+    the workflow run jobs directory: `<id // SHARD_SIZE>/`. Older
+    versions stored them in the directory itself, which holds
+    hundreds of thousands of files then. `find_object()` and
+    `iter_files()` look in both places, `reshard()` moves files to
+    shards.
+
+    A log of the job `<job_id>` is stored as one of:
+
+    * `<job_id>.log.zst` -- zstd-compressed (if the `zstandard`
+      module is installed);
+    * `<job_id>.log.gz` -- gzip-compressed;
+    * `<job_id>.log` -- uncompressed, as older versions of
+      `fetch.py` stored logs.
+
+    Readers should not care: `find_log()` locates a log of a job,
+    `open_log()` opens it for streaming reading decompressing on the
+    fly, `map_log()` gives its bytes for random access and
+    `reverse_windows()` splits them into windows to read the log from
+    the end. `LogWriter` stores a log as it is downloaded.
+
+    Run this module as a script to compress already stored logs or to
+    move workflow run and job files to shards:
+
+        ./multivac/storage.py [--reshard] tarantool/tarantool
+"""
+
+import argparse
+import contextlib
+import gzip
+import hashlib
+import mmap
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = {
+    'zst': '.log.zst',
+    'gz': '.log.gz',
+    'none': '.log',
+}
+# The order matters: if there are several logs of a job (say, a
+# migration was interrupted), the most compressed one is used.
+LOG_EXTENSIONS = ('.log.zst', '.log.gz', '.log')
+LOG_FILENAME_RE = re.compile(r'^(\d+)(\.log(?:\.zst|\.gz)?)$')
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+
+DEFAULT_COMPRESSION = 'zst' if zstandard else 'gz'
+
+# IDs of workflow runs and jobs grow by tens of millions a day
+# across GitHub, so a shard holds files of a few hours of a project.
+SHARD_SIZE = 10 ** 7
+SHARD_NAME_RE = re.compile(r'^\d+$')
+# A file of a workflow run or a job: `<id>.<extension>`.
+OBJECT_FILENAME_RE = re.compile(r'^(\d+)(\..*)$')
+# Directories of a repository with workflow run and job files (see
+# also `multivac/metas.py`).
+OBJECT_DIRS = ('workflow_runs', 'workflow_run_jobs', 'raw/workflow_runs',
+               'raw/workflow_run_jobs')
+
+# Windows of `reverse_windows()`.
+TAIL_WINDOW = 64 * 1024
+MAX_TAIL_WINDOW = 8 * 1024 * 1024
+# Reads of a compressed log tail in `map_log()`.
+TAIL_CHUNK = 1024 * 1024
+
+
+def shard_name(obj_id):
+    return str(int(obj_id) // SHARD_SIZE)
+
+
+def object_path(base_dir, obj_id, extension):
+    """ Path to store a file of a workflow run or a job. """
+    return os.path.join(base_dir, shard_name(obj_id),
+                        '{}{}'.format(obj_id, extension))
+
+
+def find_object(base_dir, obj_id, extensions):
+    """ Path to a stored file of a workflow run or a job with one of
+        the given extensions: the first one found in the order. Files
+        in a shard are preferred to ones stored before sharding.
+        Raises FileNotFoundError if there is no such file.
+    """
+    for directory in (os.path.join(base_dir, shard_name(obj_id)), base_dir):
+        for extension in extensions:
+            path = os.path.join(directory, '{}{}'.format(obj_id, extension))
+            if os.path.isfile(path):
+                return path
+    raise FileNotFoundError('No {} for {} in {}'.format(
+        ' or '.join(extensions), obj_id, base_dir))
+
+
+def iter_files(base_dir):
+    """ Yield (file name, path relative to the base directory) of all
+        the files in the base directory and its shards.
+    """
+    for entry in os.scandir(base_dir):
+        if not entry.is_dir():
+            yield entry.name, entry.name
+        elif SHARD_NAME_RE.match(entry.name):
+            for filename in os.listdir(entry.path):
+                yield filename, os.path.join(entry.name, filename)
+
+
+def find_log(jobs_dir, job_id):
+    """ Path to a log of the given job. Raises FileNotFoundError if
+        the job has no log.
+    """
+    return find_object(jobs_dir, job_id, LOG_EXTENSIONS)
+
+
+def log_name(jobs_dir, job_id):
+    """ Path to a log of the given job relative to the jobs directory,
+        `<shard>/<job_id>.log` if there is no log.
+    """
+    try:
+        return os.path.relpath(find_log(jobs_dir, job_id), jobs_dir)
+    except FileNotFoundError:
+        return os.path.relpath(object_path(jobs_dir, job_id, '.log'),
+                               jobs_dir)
+
+
+def iter_logs(jobs_dir):
+    """ Yield paths to all the logs in the given directory: one per
+        job, the one `find_log()` returns.
+    """
+    seen = set()
+    logs = []
+    for filename, rel_path in iter_files(jobs_dir):
+        match = LOG_FILENAME_RE.match(filename)
+        if match:
+            job_id, extension = match.groups()
+            logs.append((int(job_id), rel_path == filename,
+                         LOG_EXTENSIONS.index(extension), rel_path))
+    for job_id, _, _, rel_path in sorted(logs):
+        if job_id in seen:
+            continue
+        seen.add(job_id)
+        yield os.path.join(jobs_dir, rel_path)
+
+
+def open_log(path, mode='r'):
+    """ Open a log for reading, decompressing it on the fly.
+
+        `mode` is either 'r' (text, like `open()` does: universal
+        newlines) or 'rb'.
+    """
+    if mode not in ('r', 'rb'):
+        raise ValueError('Unsupported mode: {}'.format(mode))
+    encoding = 'utf-8' if mode == 'r' else None
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('The zstandard module is required to read '
+                               '{}'.format(path))
+        return zstandard.open(path, mode, encoding=encoding)
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't' if mode == 'r' else mode,
+                         encoding=encoding)
+    return open(path, mode, encoding=encoding)
+
+
+@contextlib.contextmanager
+def map_file(f):
+    """ Read-only memory map of an open file. """
+    # An empty file can't be mapped.
+    if os.fstat(f.fileno()).st_size == 0:
+        yield b''
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        yield data
+
+
+@contextlib.contextmanager
+def map_log(path, max_depth=None):
+    """ Bytes of a log for random access: a read-only memory map of
+        the log.
+
+        A compressed log is decompressed into a temporary file (see
+        `tempfile.gettempdir()` regarding its directory), which is
+        mapped then, so the log is not kept in memory at once.
+
+        If `max_depth` is set, only the last `max_depth` bytes are
+        needed (as `reverse_windows()` searches them), and the
+        data may lack the rest of the log. A compressed log is then
+        decompressed on the fly keeping only its tail in memory, no
+        temporary file is written. Note that the log is still read
+        and decompressed whole: a compressed stream can't be read
+        from the end.
+    """
+    if path.endswith('.log'):
+        with open(path, 'rb') as f, map_file(f) as data:
+            yield data
+        return
+    if max_depth is not None:
+        # One byte more: `reverse_windows()` checks whether the line
+        # at the bound is whole.
+        size = max_depth + 1
+        tail = bytearray()
+        with open_log(path, 'rb') as log_fh:
+            for chunk in iter(lambda: log_fh.read(TAIL_CHUNK), b''):
+                tail += chunk
+                if len(tail) > size + TAIL_CHUNK:
+                    del tail[:-size]
+        del tail[:-size]
+        yield tail
+        return
+    with tempfile.TemporaryFile() as tmp_fh:
+        with open_log(path, 'rb') as log_fh:
+            shutil.copyfileobj(log_fh, tmp_fh)
+        tmp_fh.flush()
+        with map_file(tmp_fh) as data:
+            yield data
+
+
+def reverse_windows(data, window=TAIL_WINDOW, max_depth=None):
+    """ Yield (start, end) offsets of windows of log bytes (see
+        `map_log()`) from the end of the log to its beginning.
+
+        Windows consist of whole lines, so a multibyte character is
+        never split. The window size is doubled after each window up
+        to MAX_TAIL_WINDOW (or more for a longer line): a failure is
+        usually near the end of a log, but a long search should not
+        cost a lot of small reads.
+
+        Only the last `max_depth` bytes are read if it is set: a line
+        crossing this bound is not included.
+    """
+    end = len(data)
+    limit = 0 if max_depth is None else max(end - max_depth, 0)
+    while end > limit:
+        start = max(end - window, limit)
+        if start > 0:
+            # Move the start to the beginning of a line. The window
+            # ends with a newline unless it is the last one.
+            pos = data.find(b'\n', start - 1, end - 1)
+            if pos == -1:
+                if start == limit:
+                    break
+                window *= 2
+                continue
+            start = pos + 1
+        yield start, end
+        end = start
+        window = max(window, min(window * 2, MAX_TAIL_WINDOW))
+
+
+class LogWriter:
+    """ Stores a log of a job fed by chunks, so the whole log is never
+        kept in memory.
+
+        Data is compressed on the fly and written under a temporary
+        name. `close()` flushes it to the disk and renames the file,
+        so readers never see a partially written log. `abort()` (or
+        an exception in the `with` block) removes the temporary file.
+
+        The size and the SHA-256 checksum of the log are computed on
+        the way.
+    """
+    def __init__(self, jobs_dir, job_id, compression=DEFAULT_COMPRESSION):
+        if compression == 'zst' and zstandard is None:
+            raise RuntimeError('The zstandard module is required for '
+                               'zstd compression')
+        self.path = object_path(jobs_dir, job_id, COMPRESSIONS[compression])
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.fh = open(self.tmp_path, 'wb')
+        if compression == 'zst':
+            self.stream = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL).stream_writer(self.fh, closefd=False)
+        elif compression == 'gz':
+            # Don't store the temporary file name in the header.
+            self.stream = gzip.GzipFile(filename='', mode='wb',
+                                        compresslevel=GZIP_LEVEL,
+                                        fileobj=self.fh)
+        else:
+            self.stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        self.size += len(data)
+        self.sha256.update(data)
+        (self.stream or self.fh).write(data)
+
+    def close(self):
+        """ Finish the log. Returns a path to the written file. """
+        if self.stream:
+            self.stream.close()
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.fh.close()
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        self.fh.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.tmp_path)
+
+
+def write_log(jobs_dir, job_id, data, compression=DEFAULT_COMPRESSION):
+    """ Store a log of a job. Returns a path to the written file.
+
+        See `LogWriter` to store a log by chunks.
+    """
+    with LogWriter(jobs_dir, job_id, compression) as writer:
+        writer.write(data)
+    return writer.path
+
+
+def migrate(jobs_dir, compression=DEFAULT_COMPRESSION, keep=False):
+    """ Compress uncompressed logs in the given directory.
+
+        The compressed data is verified before the original log is
+        removed. The test status cache of a log follows the log.
+    """
+    # Imported here to don't make all storage users depend on
+    # the sensor.
+    from multivac.sensors.test_status import get_cache_filepath
+
+    saved = 0
+    count = 0
+    for path in iter_logs(jobs_dir):
+        if not path.endswith('.log'):
+            continue
+        job_id = LOG_FILENAME_RE.match(os.path.basename(path)).group(1)
+        with open(path, 'rb') as f:
+            data = f.read()
+        new_path = write_log(jobs_dir, job_id, data, compression)
+        with open_log(new_path, 'rb') as f:
+            if f.read() != data:
+                os.remove(new_path)
+                raise RuntimeError('Verification of {} failed'.format(
+                    new_path))
+
+        cache_path = get_cache_filepath(path)
+        if os.path.isfile(cache_path):
+            os.replace(cache_path, get_cache_filepath(new_path))
+        if not keep:
+            os.remove(path)
+
+        count += 1
+        saved += len(data) - os.path.getsize(new_path)
+        print('Written {}'.format(new_path), file=sys.stderr)
+    print('Compressed {} logs, saved {:.1f} MiB'.format(
+        count, saved / 1024 / 1024), file=sys.stderr)
+
+
+def reshard(base_dir):
+    """ Move files stored directly in the given directory to shards.
+
+        If a file is in a shard already (stored again after the
+        layout change), the one outside is removed: the file in the
+        shard is the fresh one, readers prefer it anyway.
+    """
+    count = 0
+    for entry in os.scandir(base_dir):
+        match = OBJECT_FILENAME_RE.match(entry.name)
+        # Skip temporary files of writers.
+        if not entry.is_file() or not match or entry.name.endswith('.tmp'):
+            continue
+        path = object_path(base_dir, *match.groups())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(entry.path)
+        else:
+            os.rename(entry.path, path)
+        count += 1
+    print('Moved {} files of {} to shards'.format(count, base_dir),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.append(PROJECT_DIR)
+
+    parser = argparse.ArgumentParser(
+        description='Compress stored workflow run job logs')
+    parser.add_argument('--reshard', action='store_true',
+                        help='Move workflow run and job files to shards '
+                             'instead')
+    parser.add_argument('--compression', choices=['zst', 'gz'],
+                        default=DEFAULT_COMPRESSION,
+                        help='compression format (default: {})'.format(
+                            DEFAULT_COMPRESSION))
+    parser.add_argument('--keep', action='store_true',
+                        help="Don't remove uncompressed logs")
+    parser.add_argument('repo_path', type=str,
+                        help='owner/repository')
+    args = parser.parse_args()
+
+    if args.reshard:
+        for directory in OBJECT_DIRS:
+            path = os.path.join(args.repo_path, directory)
+            if os.path.isdir(path):
+                reshard(path)
+    else:
+        migrate(os.path.join(args.repo_path, 'workflow_run_jobs'),
+                args.compression, args.keep)
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+import requests
+from multivac.artifacts import ArtifactIndex, LocalBucket
+
+
+class CountingBucket(LocalBucket):
+    def __init__(self, root_dir, can_list=True):
+        super().__init__(root_dir)
+        self.can_list = can_list
+        self.lists = 0
+        self.heads = 0
+
+    def list(self, prefix):
+        self.lists += 1
+        if not self.can_list:
+            response = requests.Response()
+            response.status_code = 403
+            raise requests.HTTPError(response=response)
+        return super().list(prefix)
+
+    def exists(self, key):
+        self.heads += 1
+        return super().exists(key)
+
+
+class TestArtifactIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bucket_dir = os.path.join(self.tmp_dir, 'bucket')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        run_dir = os.path.join(self.bucket_dir, 'owner/repo/artifacts/1')
+        os.makedirs(run_dir)
+        for job_id in (10, 11):
+            with open(os.path.join(run_dir, '{}.zip'.format(job_id)), 'w'):
+                pass
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def index(self, bucket, **kwargs):
+        index = ArtifactIndex(bucket, 'owner/repo', self.cache_dir, **kwargs)
+        self.addCleanup(index.close)
+        return index
+
+    def check(self, index):
+        self.assertTrue(index.has_artifact(1, 10))
+        self.assertTrue(index.has_artifact(1, 11))
+        self.assertFalse(index.has_artifact(1, 12))
+        self.assertFalse(index.has_artifact(2, 20))
+
+    def test_listing(self):
+        bucket = CountingBucket(self.bucket_dir)
+        index = self.index(bucket)
+        index.prefetch([1, 2])
+        self.check(index)
+        self.assertEqual((bucket.lists, bucket.heads), (2, 0))
+
+        # Served from the on-disk cache.
+        bucket = CountingBucket(self.bucket_dir)
+        self.check(self.index(bucket))
+        self.assertEqual((bucket.lists, bucket.heads), (0, 0))
+
+    def test_ttl(self):
+        self.check(self.index(CountingBucket(self.bucket_dir)))
+        bucket = CountingBucket(self.bucket_dir)
+        self.check(self.index(bucket, ttl=-1))
+        self.assertEqual(bucket.lists, 2)
+
+    def test_no_listing(self):
+        bucket = CountingBucket(self.bucket_dir, can_list=False)
+        index = self.index(bucket)
+        self.check(index)
+        self.assertEqual((bucket.lists, bucket.heads), (1, 4))
+        self.assertTrue(index.has_artifact(1, 10))
+        self.assertEqual(bucket.heads, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from multivac.daemon import Daemon
+
+
+class CountingDaemon(Daemon):
+    """ Doesn't poll GitHub, just counts polls. """
+    def poll(self):
+        with self.lock:
+            self.polls += 1
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmp_dir.name)
+        self.daemon = CountingDaemon('owner/repo', ['master'], 'token',
+                                     interval=3600, socket_path='ctl.sock')
+
+    def command(self, line):
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect('ctl.sock')
+            sock.sendall(line.encode() + b'\n')
+            return json.loads(sock.makefile().readline())
+
+    def test_control_socket(self):
+        self.daemon.serve()
+        thread = threading.Thread(target=self.daemon.run)
+        thread.start()
+        try:
+            status = self.command('status')
+            self.assertTrue(status['ok'])
+            self.assertEqual(status['status']['branches'], ['master'])
+            self.assertEqual(self.command('last-seen'), {
+                'ok': False, 'error': 'LOG_STORAGE_BUCKET_URL not set'})
+            self.assertFalse(self.command('unknown')['ok'])
+
+            # Wake up the polling loop.
+            self.assertEqual(self.command('poll'), {'ok': True})
+            for _ in range(100):
+                if self.daemon.polls == 2:
+                    break
+                thread.join(0.05)
+            self.assertEqual(self.daemon.polls, 2)
+            self.assertEqual(self.command('stop'), {'ok': True})
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        finally:
+            self.daemon.stop()
+            self.daemon.close()
+        self.assertFalse(os.path.exists('ctl.sock'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,508 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import requests
+
+from multivac.fetch import FetchCursors, Fetcher, HTTPCache, RateLimiter
+from multivac.fetch import WorkflowRun, WorkflowRunPipeline, format_time
+from multivac.fetch import parse_time, retry
+
+
+class FakeClock:
+    """ Replaces the `time` module: `sleep()` advances `time()`. """
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, headers=None, text=''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = text
+
+
+def rate_limit_headers(limit, remaining, reset):
+    return {'X-RateLimit-Limit': str(limit),
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(reset)}
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(1000)
+        patcher = mock.patch('multivac.fetch.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.limiter = RateLimiter(pace_below=0.2)
+
+    def test_pacing(self):
+        # No rate limit headers seen yet.
+        self.limiter.wait()
+        self.limiter.update(FakeResponse(
+            headers=rate_limit_headers(100, 50, 1100)))
+        for _ in range(30):
+            self.limiter.wait()
+        self.assertEqual(self.clock.sleeps, [])
+
+        # 10 requests remain for 100 seconds: they are spread evenly.
+        self.limiter.update(FakeResponse(
+            headers=rate_limit_headers(100, 10, 1100)))
+        for _ in range(3):
+            self.limiter.wait()
+        self.assertEqual(self.clock.sleeps, [10, 10])
+        self.assertEqual(self.clock.now, 1020)
+
+    def test_reset(self):
+        self.limiter.update(FakeResponse(
+            headers=rate_limit_headers(100, 0, 1100)))
+        self.limiter.wait()
+        self.assertEqual(self.clock.sleeps, [101])
+        # A response after the reset lifts the limit.
+        self.limiter.update(FakeResponse(
+            headers=rate_limit_headers(100, 99, 2000)))
+        self.limiter.wait()
+        self.assertEqual(self.clock.sleeps, [101])
+
+    def test_retry_delay(self):
+        retry_delay = self.limiter.retry_delay
+        self.assertIsNone(retry_delay(FakeResponse(500)))
+        self.assertIsNone(retry_delay(FakeResponse(404)))
+        self.assertIsNone(retry_delay(FakeResponse(403, text='Forbidden')))
+        # Primary rate limit.
+        self.assertEqual(retry_delay(FakeResponse(
+            403, rate_limit_headers(100, 0, 1100))), 101)
+        # Secondary rate limit.
+        self.assertEqual(retry_delay(FakeResponse(
+            403, {'Retry-After': '30'})), 30)
+        self.assertEqual(retry_delay(FakeResponse(
+            429, {'Retry-After': 'Thu, 01 Jan 1970 00:17:00 GMT'})), 20)
+        self.assertEqual(retry_delay(FakeResponse(
+            403, text='You have exceeded a secondary rate limit.')), 60)
+        for attempt in range(3):
+            delay = retry_delay(FakeResponse(403, {'Retry-After': 'soon'}),
+                                attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, 0.5 * 2 ** attempt)
+
+    def test_retry(self):
+        responses = []
+
+        @retry
+        def http_get():
+            response = responses.pop(0)
+            if response.status_code != 200:
+                raise requests.exceptions.HTTPError(response=response)
+            return response
+
+        # Waits for the rate limit don't count as attempts.
+        ok = FakeResponse()
+        responses.extend([FakeResponse(403, {'Retry-After': '1'})] * 12)
+        responses.append(ok)
+        with mock.patch('multivac.fetch.info'):
+            self.assertIs(http_get(), ok)
+        self.assertEqual(self.clock.sleeps, [1] * 12)
+
+        responses.extend([FakeResponse(500)] * 10)
+        with self.assertRaises(StopIteration):
+            http_get()
+        self.assertEqual(responses, [])
+
+        responses.append(FakeResponse(404))
+        with self.assertRaises(requests.exceptions.HTTPError):
+            http_get()
+
+
+ETAG = 'W/"etag"'
+LINK = '<https://api.github.com/repositories/1/actions/runs?page=2>; ' \
+    'rel="next"'
+
+
+class FakeSession:
+    """ Responds with `body` and an ETag, or with 304 Not Modified
+        to a request with the ETag.
+    """
+    def __init__(self, body):
+        self.body = body
+        self.requests = []
+
+    def get(self, url, params=None, headers=None, stream=False):
+        self.requests.append(headers)
+        response = requests.Response()
+        response.url = url
+        if headers and headers.get('If-None-Match') == ETAG:
+            response.status_code = 304
+            response.headers['ETag'] = ETAG
+        else:
+            response.status_code = 200
+            response.headers.update({
+                'Content-Type': 'application/json; charset=utf-8',
+                'ETag': ETAG,
+                'Link': LINK,
+            })
+            response._content = json.dumps(self.body).encode()
+        return response
+
+    def close(self):
+        pass
+
+
+class FetcherTestCase(unittest.TestCase):
+    """ Runs a test in a temporary directory: a fetcher stores
+        everything in the current one.
+    """
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmp_dir.name)
+
+    def fetcher(self, **kwargs):
+        fetcher = Fetcher('owner/repo', 'token', **kwargs)
+        self.addCleanup(fetcher.close)
+        return fetcher
+
+
+class TestHTTPCache(FetcherTestCase):
+    def test_conditional_request(self):
+        fetcher = self.fetcher()
+        url = 'https://api.github.com/repos/owner/repo/actions/runs?page=1'
+        params = {'per_page': 100, 'branch': None}
+        body = {'total_count': 1, 'workflow_runs': [{'id': 1}]}
+        session = FakeSession(body)
+        fetcher.session = session
+
+        r = fetcher.http_get(url, params, cache=True)
+        self.assertEqual(r.json(), body)
+        self.assertEqual(session.requests, [None])
+
+        r = fetcher.http_get(url, params, cache=True)
+        self.assertEqual(session.requests[1], {'If-None-Match': ETAG})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json(), body)
+        self.assertEqual(r.links['next']['url'],
+                         'https://api.github.com/repositories/1/'
+                         'actions/runs?page=2')
+
+        # Only requests with `cache` set are cached.
+        fetcher.http_get(url, {'per_page': 100}, cache=False)
+        fetcher.http_get(url, {'per_page': 100}, cache=False)
+        self.assertEqual(session.requests[2:], [None, None])
+
+    def test_prune(self):
+        cache = HTTPCache('cache')
+        for url in ('used', 'unused'):
+            with open(cache.path(url, None), 'w') as f:
+                json.dump({'url': url, 'headers': {}, 'body': ''}, f)
+            old = time.time() - cache.max_age.total_seconds() - 60
+            os.utime(cache.path(url, None), (old, old))
+        self.assertEqual(cache.load('used', None)['url'], 'used')
+        cache.prune()
+        self.assertEqual(os.listdir('cache'),
+                         [os.path.basename(cache.path('used', None))])
+
+
+class FakeRun:
+    def __init__(self, run_id, events=None):
+        self.id = run_id
+        self.meta = {'id': run_id}
+        self.events = events
+
+    def store(self):
+        self.events.append(('run', self.id))
+
+
+class FakeJob:
+    def __init__(self, job_id, events, delay=0, error=None):
+        self.id = job_id
+        self.meta = {'id': job_id}
+        self.log_name = f'{job_id}.log'
+        self.status = 'completed'
+        self.is_stored = False
+        self.log_results = None
+        self.events = events
+        self.delay = delay
+        self.error = error
+
+    def download_log(self):
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        self.log = 'log'
+
+    def store(self):
+        self.events.append(('job', self.id))
+
+
+class FakeJobIndex:
+    def __init__(self, events):
+        self.events = events
+
+    def add_run(self, run_meta, jobs):
+        self.events.append(('index', run_meta['id']))
+
+
+class TestProcessWorkflowRun(FetcherTestCase):
+    def process(self, jobs, events):
+        fetcher = self.fetcher()
+        run = FakeRun(1, events)
+        with mock.patch.object(fetcher, 'download_workflow_run_jobs',
+                               return_value=jobs), \
+                mock.patch.object(fetcher, 'job_index',
+                                  FakeJobIndex(events)), \
+                mock.patch('multivac.fetch.info'), \
+                ThreadPoolExecutor(max_workers=4) as log_executor:
+            fetcher.process_workflow_run(run, log_executor)
+
+    def test_run_stored_last(self):
+        events = []
+        jobs = [FakeJob(job_id, events, delay=0.05 * (3 - job_id))
+                for job_id in range(3)]
+        self.process(jobs, events)
+        self.assertEqual(sorted(events[:-2]), [('job', 0), ('job', 1),
+                                               ('job', 2)])
+        self.assertEqual(events[-2:], [('run', 1), ('index', 1)])
+
+    def test_run_not_stored_on_error(self):
+        events = []
+        jobs = [FakeJob(0, events), FakeJob(1, events, error=OSError())]
+        with self.assertRaises(OSError):
+            self.process(jobs, events)
+        self.assertNotIn(('run', 1), events)
+        self.assertNotIn(('index', 1), events)
+
+    def test_incomplete_jobs(self):
+        events = []
+        jobs = [FakeJob(0, events), FakeJob(1, events)]
+        jobs[1].status = 'in_progress'
+        self.process(jobs, events)
+        self.assertEqual(events, [])
+
+
+class SleepingFetcher:
+    """ Processes a workflow run by sleeping, fails on `fail_run`. """
+    def __init__(self, fail_run=None):
+        self.fail_run = fail_run
+        self.lock = threading.Lock()
+        self.running = set()
+        self.max_running = 0
+        self.processed = []
+
+    def process_workflow_run(self, run, log_executor=None):
+        if run.id == self.fail_run:
+            raise RuntimeError('failed')
+        with self.lock:
+            self.running.add(run.id)
+            self.max_running = max(self.max_running, len(self.running))
+        time.sleep(0.02)
+        with self.lock:
+            self.running.remove(run.id)
+            self.processed.append(run.id)
+
+
+class TestWorkflowRunPipeline(FetcherTestCase):
+    def test_concurrency(self):
+        fetcher = SleepingFetcher()
+        pipeline = WorkflowRunPipeline(fetcher, concurrency=2)
+        for run_id in range(8):
+            pipeline.submit(FakeRun(run_id))
+            self.assertLessEqual(len(pipeline.pending), 2)
+        pipeline.close()
+        self.assertEqual(fetcher.max_running, 2)
+        self.assertEqual(sorted(fetcher.processed), list(range(8)))
+
+    def test_error(self):
+        pipeline = WorkflowRunPipeline(SleepingFetcher(fail_run=0),
+                                       concurrency=2)
+        with self.assertRaisesRegex(RuntimeError, 'failed'):
+            try:
+                for run_id in range(8):
+                    pipeline.submit(FakeRun(run_id))
+            finally:
+                pipeline.close()
+
+    def test_fetch_error(self):
+        """ An error of a workflow run processed in the pipeline is
+            raised from `Fetcher.fetch()`.
+        """
+        fetcher = self.fetcher(concurrency=2)
+        runs = [WorkflowRun(fetcher, data={
+                    'id': run_id, 'status': 'completed',
+                    'created_at': '2099-01-01T00:00:00Z',
+                    'updated_at': '2099-01-01T00:00:00Z'})
+                for run_id in range(8)]
+        sleeping_fetcher = SleepingFetcher(fail_run='3')
+        with mock.patch.object(fetcher, 'download_workflow_runs',
+                               return_value=runs), \
+                mock.patch.object(fetcher, 'process_workflow_run',
+                                  sleeping_fetcher.process_workflow_run), \
+                self.assertRaisesRegex(RuntimeError, 'failed'):
+            fetcher.fetch()
+        self.assertNotIn('3', sleeping_fetcher.processed)
+
+
+class TestFetchCursors(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cursors = FetchCursors(os.path.join(self.tmp_dir, 'cursors'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_time(self):
+        time = parse_time('2021-06-10T12:28:18Z')
+        self.assertEqual(time, datetime.datetime(
+            2021, 6, 10, 12, 28, 18, tzinfo=datetime.timezone.utc))
+        self.assertEqual(format_time(time), '2021-06-10T12:28:18Z')
+
+    def test_cursors(self):
+        self.assertIsNone(self.cursors.load('master'))
+        time = parse_time('2021-06-10T12:28:18Z')
+        self.cursors.store('release/3.4', time)
+        self.cursors.store(None, time + datetime.timedelta(days=1))
+        self.assertEqual(self.cursors.load('release/3.4'), time)
+        self.assertEqual(self.cursors.load(None),
+                         time + datetime.timedelta(days=1))
+        self.assertIsNone(self.cursors.load('master'))
+        self.assertEqual(sorted(os.listdir(self.cursors.cursor_dir)),
+                         ['%2A.json', 'release%2F3.4.json'])
+
+
+def run_data(run_id, branch, created_at):
+    return {'id': run_id, 'head_branch': branch, 'status': 'completed',
+            'created_at': created_at, 'updated_at': created_at}
+
+
+class ListingFetcher(Fetcher):
+    """ Lists workflow runs from `runs` instead of GitHub (at most
+        `cap` ones per a filtered query) and just stores processed
+        runs.
+    """
+    cap = 1000
+
+    def __init__(self, runs, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.runs = runs
+        self.queries = []
+        self.listed = 0
+        self.processed = []
+
+    def download_workflow_runs_pages(self, params, since=1):
+        self.queries.append(params)
+        runs = self.runs
+        if params['branch']:
+            runs = [run for run in runs
+                    if run['head_branch'] == params['branch']]
+        if 'created' in params:
+            since, _, till = params['created'].lstrip('>=').partition('..')
+            runs = [run for run in runs if since <= run['created_at'] and
+                    (not till or run['created_at'] <= till)]
+        total = len(runs)
+        if params['branch'] or 'created' in params:
+            runs = runs[:self.cap]
+        for data in runs:
+            self.listed += 1
+            yield WorkflowRun(self, data=data), total
+
+    def process_workflow_run(self, run, log_executor=None):
+        self.processed.append(int(run.id))
+        run.store()
+
+
+class TestFetcher(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmp_dir.name)
+        self.runs = [run_data(100 - i, ('master', 'release/3.4', 'pr')[i % 3],
+                              '2099-01-{:02}T00:00:00Z'.format(30 - i))
+                     for i in range(12)]
+
+    def fetcher(self, **kwargs):
+        fetcher = ListingFetcher(self.runs, 'owner/repo', 'token',
+                                 concurrency=1, incremental=True, **kwargs)
+        self.addCleanup(fetcher.close)
+        return fetcher
+
+    def test_branches(self):
+        branches = ['master', 'release/3.4']
+        fetcher = self.fetcher(branches=branches)
+        fetcher.fetch()
+        # The branches are listed once, without cursors too.
+        self.assertEqual(fetcher.queries, [{'per_page': 100,
+                                            'branch': None}])
+        self.assertEqual(sorted(fetcher.processed), [
+            run['id'] for run in reversed(self.runs)
+            if run['head_branch'] != 'pr'])
+
+        # Then runs of the branches are listed once.
+        for branch in branches:
+            fetcher.cursors.store(branch, parse_time('2099-01-25T00:00:00Z'))
+        self.runs[0]['updated_at'] = '2099-01-30T01:00:00Z'
+        self.runs[1]['updated_at'] = '2099-01-29T01:00:00Z'
+        self.runs[2]['updated_at'] = '2099-01-28T01:00:00Z'
+        fetcher = self.fetcher(branches=branches)
+        started = datetime.datetime.now(datetime.timezone.utc)
+        fetcher.fetch()
+        self.assertEqual(fetcher.queries, [{
+            'per_page': 100, 'branch': None,
+            'created': '>=2099-01-22T00:00:00Z'}])
+        self.assertEqual(fetcher.processed, [100, 99])
+        # All the runs are fetched: the cursors move to the start.
+        for branch in branches:
+            self.assertGreaterEqual(fetcher.cursors.load(branch),
+                                    started.replace(microsecond=0))
+
+    def test_branch_without_cursor(self):
+        branches = ['master', 'release/3.4']
+        fetcher = self.fetcher(branches=branches)
+        fetcher.cursors.store('master', parse_time('2099-01-28T00:00:00Z'))
+        fetcher.fetch()
+        self.assertEqual(fetcher.queries, [{'per_page': 100,
+                                            'branch': None}])
+        # Runs of master are listed till its cursor minus the re-run
+        # window, all the runs of release/3.4 are listed.
+        self.assertEqual(fetcher.processed, [100, 99, 97, 96, 93, 90])
+
+    def test_branch_limit(self):
+        fetcher = self.fetcher(branches=['master', 'release/3.4'])
+        with mock.patch('multivac.fetch.FILTERED_LIST_LIMIT', 2):
+            fetcher.fetch()
+        # The listing stops when both branches have 2 runs listed.
+        self.assertEqual(fetcher.processed, [100, 99, 97, 96])
+        self.assertEqual(fetcher.listed, 8)
+
+    def test_capped_listing(self):
+        fetcher = self.fetcher()
+        fetcher.cursors.store(None, parse_time('2099-01-23T00:00:00Z'))
+        fetcher.cap = 3
+        fetcher.fetch()
+        # Runs created since 2099-01-20 are listed by 3 queries, the
+        # boundary runs are processed once.
+        self.assertEqual([query['created'] for query in fetcher.queries], [
+            '>=2099-01-20T00:00:00Z',
+            '2099-01-20T00:00:00Z..2099-01-28T00:00:00Z',
+            '2099-01-20T00:00:00Z..2099-01-26T00:00:00Z',
+            '2099-01-20T00:00:00Z..2099-01-24T00:00:00Z',
+            '2099-01-20T00:00:00Z..2099-01-22T00:00:00Z'])
+        self.assertEqual(fetcher.processed, list(range(100, 89, -1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
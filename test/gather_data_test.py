@@ -0,0 +1,155 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from multivac.gather_data import GatherData
+
+
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+SENSORS_DIR = os.path.join(CUR_DIR, 'sensors')
+
+# Logs of failed jobs from test/sensors and their failure types
+FAILED_JOBS = {
+    9224701468: 'unknown_failure',
+    3828337083: 'testrun_test_hung',
+    925099517: 'testrun_test_failed',
+    900598368: 'luajit_error',
+}
+# A failed job without a log
+NO_LOG_JOB = 950000000
+SUCCESS_JOB = 960000000
+SKIPPED_JOB = 970000000
+# The job with the lowest ID, older than `--since`
+OLD_JOB = 100
+# A failed job fetched after the first gathering
+NEW_JOB = 980000000
+
+
+def github_time(time):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def job_meta(job_id, conclusion, started_at):
+    return {
+        'id': job_id,
+        'run_id': job_id // 10,
+        'name': 'release_asan_clang11 (ubuntu_20_04)',
+        'head_branch': 'master',
+        'head_sha': 'abc',
+        'conclusion': conclusion,
+        'created_at': github_time(started_at - timedelta(minutes=1)),
+        'started_at': github_time(started_at),
+        'completed_at': github_time(started_at + timedelta(minutes=10)),
+        'labels': ['ubuntu-20.04-self-hosted'],
+        'html_url': f'https://github.com/tarantool/tarantool/runs/{job_id}',
+        'runner_name': 'runner',
+    }
+
+
+class TestGatherData(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.repo_path = os.path.join(tmpdir, 'tarantool')
+        self.jobs_dir = os.path.join(self.repo_path, 'workflow_run_jobs')
+        os.makedirs(self.jobs_dir)
+
+        self.now = datetime.now(timezone.utc)
+        recently = self.now - timedelta(hours=1)
+        for job_id in FAILED_JOBS:
+            self.add_job(job_meta(job_id, 'failure', recently),
+                         f'{job_id}.log')
+        self.add_job(job_meta(NO_LOG_JOB, 'failure', recently))
+        self.add_job(job_meta(SUCCESS_JOB, 'success', self.now))
+        self.add_job(job_meta(SKIPPED_JOB, 'skipped', self.now))
+        self.add_job(job_meta(OLD_JOB, 'failure',
+                              self.now - timedelta(days=3)))
+
+    def add_job(self, meta, log=None):
+        with open(os.path.join(self.jobs_dir, f'{meta["id"]}.json'),
+                  'w') as f:
+            json.dump(meta, f)
+        if log:
+            shutil.copy(os.path.join(SENSORS_DIR, log),
+                        os.path.join(self.jobs_dir, f'{meta["id"]}.log'))
+
+    def gather(self, jobs=1, incremental=False):
+        gather_data = GatherData(
+            self.repo_path, tests=True, jobs=jobs, no_cache=True,
+            since='2d', incremental=incremental)
+        with contextlib.redirect_stdout(io.StringIO()):
+            gather_data.gather_data()
+        return gather_data
+
+    def test_jobs(self):
+        serial = self.gather(jobs=1)
+        parallel = self.gather(jobs=2)
+        self.assertEqual(parallel.gathered_data, serial.gathered_data)
+        self.assertEqual(list(parallel.gathered_data),
+                         list(serial.gathered_data))
+        self.assertEqual(parallel.results, serial.results)
+
+        self.assertEqual(set(serial.gathered_data),
+                         {SUCCESS_JOB, NO_LOG_JOB, *FAILED_JOBS})
+        for job_id, failure_type in FAILED_JOBS.items():
+            self.assertEqual(serial.gathered_data[job_id]['failure_type'],
+                             failure_type)
+            self.assertEqual(serial.results[failure_type], 1)
+        self.assertEqual(serial.gathered_data[NO_LOG_JOB]['failure_type'],
+                         'unknown')
+        self.assertEqual(serial.results['total'], len(FAILED_JOBS))
+        self.assertEqual(
+            len(serial.gathered_data[925099517]['failed_tests']), 5)
+
+    def test_incremental(self):
+        gather_data = self.gather(incremental=True)
+        self.assertEqual(set(gather_data.gathered_data),
+                         {SUCCESS_JOB, NO_LOG_JOB, *FAILED_JOBS})
+        gather_data.store_checkpoint()
+
+        # Only the job fetched after the checkpoint is processed.
+        self.add_job(job_meta(NEW_JOB, 'failure', self.now),
+                     '925099517.log')
+        gather_data = self.gather(jobs=2, incremental=True)
+        self.assertEqual(list(gather_data.gathered_data), [NEW_JOB])
+        self.assertEqual(gather_data.results['total'], 1)
+        gather_data.store_checkpoint()
+
+        gather_data = self.gather(incremental=True)
+        self.assertEqual(gather_data.gathered_data, {})
+
+    def test_checkpoint_write_failure(self):
+        gather_data = self.gather(incremental=True)
+        gather_data.store_checkpoint()
+        path = gather_data.checkpoint_path()
+        with open(path, 'r') as f:
+            checkpoint = f.read()
+
+        def dump(obj, f):
+            f.write('{"epoch": ')
+            raise OSError('No space left on device')
+
+        self.add_job(job_meta(NEW_JOB, 'failure', self.now),
+                     '925099517.log')
+        gather_data = self.gather(incremental=True)
+        with mock.patch('multivac.gather_data.json.dump', dump), \
+                self.assertRaises(OSError):
+            gather_data.store_checkpoint()
+        with open(path, 'r') as f:
+            self.assertEqual(f.read(), checkpoint)
+        self.assertEqual([name for name in os.listdir(os.path.dirname(path))
+                          if name.endswith('.tmp')], [])
+
+        # The next run processes the job again.
+        gather_data = self.gather(incremental=True)
+        self.assertEqual(list(gather_data.gathered_data), [NEW_JOB])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(CUR_DIR)
+
+CODE = """
+import sys
+import multivac.fetch
+import multivac.gather_data
+import multivac.last_seen
+import multivac.minutes
+import multivac.daemon
+print(sorted({'requests', 'influxdb_client'} & set(sys.modules)))
+"""
+
+
+class TestImport(unittest.TestCase):
+    def test_import(self):
+        """ The scripts can be imported as modules: arguments and
+            environment variables are not read, files are not
+            written and heavy dependencies are not imported.
+        """
+        env = {key: value for key, value in os.environ.items()
+               if key not in ('LOG_STORAGE_BUCKET_URL',
+                              'MULTIVAC_GITHUB_TOKEN')}
+        env['PYTHONPATH'] = PROJECT_DIR
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = subprocess.check_output(
+                [sys.executable, '-c', CODE, '--unknown-option'],
+                cwd=tmp_dir, env=env, text=True)
+            self.assertEqual(os.listdir(tmp_dir), [])
+        self.assertEqual(output, '[]\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
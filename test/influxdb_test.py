@@ -0,0 +1,60 @@
+import unittest
+from unittest import mock
+from influxdb_client.rest import ApiException
+from multivac.influxdb import InfluxWriter
+
+
+class FakeWriteApi:
+    """ Stores written batches, fails while `error` is set. """
+    def __init__(self):
+        self.batches = []
+        self.error = None
+
+    def write(self, bucket, org, batch):
+        if self.error:
+            raise self.error
+        self.batches.append((bucket, list(batch)))
+
+
+class TestInfluxWriter(unittest.TestCase):
+    def setUp(self):
+        self.write_api = FakeWriteApi()
+        self.writer = InfluxWriter(org='org', batch_size=2,
+                                   max_retries=0, write_api=self.write_api)
+        self.addCleanup(self.writer.close)
+
+    def test_write(self):
+        self.writer.write('bucket', [1, 2, 3])
+        self.writer.flush()
+        self.assertEqual(self.write_api.batches,
+                         [('bucket', [1, 2]), ('bucket', [3])])
+
+    def test_error(self):
+        self.write_api.error = ApiException(status=500)
+        self.writer.write('bucket', [1])
+        with self.assertRaises(RuntimeError):
+            self.writer.flush()
+
+        # The error is raised once, the writer works after the outage.
+        self.write_api.error = None
+        self.writer.write('bucket', [2])
+        self.writer.flush()
+        self.assertEqual(self.write_api.batches, [('bucket', [2])])
+
+    def test_closed(self):
+        self.writer.close()
+        with self.assertRaises(RuntimeError):
+            self.writer.flush()
+        with self.assertRaises(RuntimeError):
+            self.writer.write('bucket', [1])
+
+    def test_atexit(self):
+        with mock.patch('multivac.influxdb.atexit') as atexit:
+            writer = InfluxWriter(org='org', write_api=self.write_api)
+            atexit.register.assert_called_once_with(writer.close)
+            writer.close()
+            atexit.unregister.assert_called_once_with(writer.close)
+
+
+if __name__ == '__main__':
+    unittest.main()
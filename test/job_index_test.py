@@ -0,0 +1,139 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from multivac import storage
+from multivac.job_index import JobIndex
+
+
+def run_meta(run_id, branch):
+    return {'id': run_id, 'head_branch': branch, 'event': 'push',
+            'status': 'completed', 'conclusion': 'success',
+            'created_at': '2023-01-01T00:00:00Z',
+            'updated_at': '2023-01-01T01:00:00Z'}
+
+
+def job_meta(job_id, run_id):
+    return {'id': job_id, 'run_id': run_id, 'name': 'release',
+            'head_branch': 'master', 'head_sha': 'abc',
+            'status': 'completed', 'conclusion': 'success',
+            'labels': ['ubuntu-20.04', 'self-hosted'], 'runner_name': 'r',
+            'html_url': 'https://github.com/x/y/runs/{}'.format(job_id),
+            'created_at': '2023-01-01T00:00:00Z',
+            'started_at': '2023-01-01T00:00:01Z',
+            'completed_at': '2023-01-01T00:10:00Z'}
+
+
+class TestJobIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.repo_path = os.path.join(self.tmp_dir, 'owner', 'repo')
+        self.runs_dir = os.path.join(self.repo_path, 'workflow_runs')
+        self.jobs_dir = os.path.join(self.repo_path, 'workflow_run_jobs')
+        os.makedirs(self.runs_dir)
+        os.makedirs(self.jobs_dir)
+        self.index = JobIndex(self.repo_path,
+                              os.path.join(self.tmp_dir, 'index.sqlite3'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def store(self, directory, meta):
+        path = os.path.join(directory, '{}.json'.format(meta['id']))
+        with open(path, 'w') as f:
+            json.dump(meta, f)
+
+    def test_update(self):
+        self.store(self.runs_dir, run_meta(1, 'master'))
+        self.store(self.runs_dir, run_meta(2, 'release/3.0'))
+        self.store(self.jobs_dir, job_meta(10, 1))
+        self.store(self.jobs_dir, job_meta(20, 2))
+        self.store(self.jobs_dir, job_meta(21, 2))
+        storage.write_log(self.jobs_dir, 10, b'log\n', 'none')
+        self.assertEqual(self.index.update(), (2, 3, 0))
+        self.assertEqual(self.index.update(), (0, 0, 0))
+
+        jobs = self.index.jobs()
+        self.assertEqual([job['id'] for job in jobs], [21, 20, 10])
+        exp = dict(job_meta(10, 1), log='0/10.log', run_head_branch='master',
+                   generation=1)
+        self.assertEqual(jobs[-1], exp)
+
+        jobs = self.index.jobs(branches=['release/3.0'], order='ASC')
+        self.assertEqual([job['id'] for job in jobs], [20, 21])
+        jobs = self.index.jobs(with_log=True)
+        self.assertEqual([job['id'] for job in jobs], [10])
+        jobs = self.index.jobs(limit=1)
+        self.assertEqual([job['id'] for job in jobs], [21])
+
+    def test_update_logs(self):
+        self.store(self.jobs_dir, job_meta(10, 1))
+        self.store(self.jobs_dir, job_meta(11, 1))
+        path = storage.write_log(self.jobs_dir, 10, b'log\n', 'none')
+        self.index.update()
+
+        storage.write_log(self.jobs_dir, 10, b'log\n', 'gz')
+        os.remove(path)
+        storage.write_log(self.jobs_dir, 11, b'log\n', 'none')
+        self.assertEqual(self.index.update(), (0, 0, 2))
+        jobs = self.index.jobs()
+        self.assertEqual([job['log'] for job in jobs],
+                         ['0/11.log', '0/10.log.gz'])
+        # The workflow run is not stored.
+        self.assertIsNone(jobs[0]['run_head_branch'])
+
+    def test_update_flat(self):
+        # Files stored before sharding.
+        self.store(self.runs_dir, run_meta(1, 'master'))
+        self.store(self.jobs_dir, job_meta(10, 1))
+        with open(os.path.join(self.jobs_dir, '10.log'), 'wb') as f:
+            f.write(b'log\n')
+        self.assertEqual(self.index.update(), (1, 1, 0))
+        self.assertEqual(self.index.jobs()[0]['log'], '10.log')
+
+        storage.reshard(self.runs_dir)
+        storage.reshard(self.jobs_dir)
+        self.assertEqual(self.index.update(), (0, 0, 1))
+        self.assertEqual(self.index.jobs()[0]['log'], '0/10.log')
+        self.assertEqual(self.index.jobs(branches=['master'])[0]['id'], 10)
+
+    def test_add_run(self):
+        self.index.add_run(run_meta(1, 'master'), [(job_meta(10, 1), None)])
+        self.assertEqual(self.index.update(), (0, 0, 0))
+        jobs = self.index.jobs(branches=['master'])
+        self.assertEqual([job['id'] for job in jobs], [10])
+        self.assertIsNone(jobs[0]['log'])
+
+    def test_run_updated_at(self):
+        self.assertIsNone(self.index.run_updated_at(1))
+        self.index.add_run(run_meta(1, 'master'), [])
+        self.assertEqual(self.index.run_updated_at(1),
+                         '2023-01-01T01:00:00Z')
+
+    def test_generations(self):
+        epoch = self.index.epoch
+        self.assertEqual(self.index.generation, 0)
+        self.index.add_run(run_meta(1, 'master'), [(job_meta(10, 1), None)])
+        self.index.add_run(run_meta(2, 'master'), [(job_meta(20, 2), None)])
+        self.assertEqual(self.index.generation, 2)
+        # A job fetched late, the log of the first job.
+        self.store(self.jobs_dir, job_meta(5, 3))
+        storage.write_log(self.jobs_dir, 10, b'log\n', 'none')
+        self.index.update()
+        self.assertEqual(self.index.generation, 4)
+
+        jobs = self.index.jobs(generations=(2, self.index.generation))
+        self.assertEqual([job['id'] for job in jobs], [10, 5])
+        jobs = self.index.jobs(generations=(1, 2))
+        self.assertEqual([job['id'] for job in jobs], [20])
+        self.assertEqual(self.index.update(), (0, 0, 0))
+        self.assertEqual(self.index.generation, 4)
+
+        self.index.create_schema()
+        self.assertNotEqual(self.index.epoch, epoch)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+from multivac import last_seen_reducer
+from multivac.sensor_store import SensorStore
+
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+SENSORS_DIR = os.path.join(CUR_DIR, 'sensors')
+
+
+def job(job_id, started_at, log, branch='master', generation=1):
+    return {'id': job_id, 'run_id': job_id // 10, 'started_at': started_at,
+            'labels': ['ubuntu-20.04-self-hosted'], 'log': log,
+            'run_head_branch': branch, 'generation': generation}
+
+
+class TestLastSeenReducer(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_merge(self):
+        key = ('app/a.test.lua', None, 'fail', 'ubuntu-20.04')
+        a = {key: ['2023-01-02T00:00:00Z', 'master', 2, 20, 2, '20.log']}
+        b = {key: ['2023-01-01T00:00:00Z', '2.10', 1, 10, 1, '10.log']}
+        c = {key: ['2023-01-02T00:00:00Z', '2.11', 1, 30, 3, '30.log']}
+        exp = {key: ['2023-01-02T00:00:00Z', '2.11', 4, 30, 3, '30.log']}
+        for partials in ((a, b, c), (c, b, a), (b, a, c)):
+            res = {}
+            for partial in partials:
+                last_seen_reducer.merge(res, partial)
+            self.assertEqual(res, exp)
+
+    def test_shorten(self):
+        partial = {
+            ('a.test.lua', None, 'fail', 'ubuntu-18.04'):
+                ['2023-01-01T00:00:00Z', 'master', 1, 10, 1, '10.log'],
+            ('a.test.lua', None, 'fail', 'ubuntu-20.04'):
+                ['2023-01-02T00:00:00Z', 'master', 1, 20, 2, '20.log'],
+        }
+        self.assertEqual(last_seen_reducer.shorten(partial), {
+            ('a.test.lua', None, 'fail', 'ubuntu'):
+                ['2023-01-02T00:00:00Z', 'master', 2, 20, 2, '20.log'],
+        })
+
+    def test_collect(self):
+        jobs = [
+            job(900598368, '2021-06-10T12:00:00Z', '900598368.log'),
+            job(925099517, '2021-06-11T12:00:00Z', '925099517.log'),
+            job(3828337083, '2021-10-08T12:00:00Z', '3828337083.log',
+                branch='2.10'),
+        ]
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        exp, intervals = last_seen_reducer.collect(jobs, SENSORS_DIR)
+        self.assertEqual(intervals, {
+            'master': ('2021-06-10T12:00:00Z', '2021-06-11T12:00:00Z'),
+            '2.10': ('2021-10-08T12:00:00Z', '2021-10-08T12:00:00Z'),
+        })
+        key = ('replication/gh-6018-election-boot-voter.test.lua', None,
+               'hang', 'ubuntu-20.04-self-hosted')
+        self.assertEqual(exp[key], ['2021-10-08T12:00:00Z', '2.10', 1,
+                                    3828337083, 382833708, '3828337083.log'])
+
+        res, _ = last_seen_reducer.collect(jobs, SENSORS_DIR, cache_dir,
+                                           workers=2)
+        self.assertEqual(res, exp)
+        self.assertEqual(sorted(os.listdir(os.path.join(cache_dir,
+                                                        'master'))),
+                         ['2021-06-10.json', '2021-06-11.json'])
+
+        # Cached partials are used: the logs are not read.
+        res, _ = last_seen_reducer.collect(jobs, self.tmp_dir, cache_dir)
+        self.assertEqual(res, exp)
+
+        # A day with a changed job is recomputed.
+        jobs[0]['generation'] = 2
+        with self.assertRaises(FileNotFoundError):
+            last_seen_reducer.collect(jobs, self.tmp_dir, cache_dir)
+
+        # Test statuses are read from the sensor store.
+        sensor_store = SensorStore('owner/repo', os.path.join(
+            self.tmp_dir, 'sensors.sqlite3'))
+        self.addCleanup(sensor_store.close)
+        res, _ = last_seen_reducer.collect(jobs, SENSORS_DIR, workers=2,
+                                           sensor_store=sensor_store)
+        self.assertEqual(res, exp)
+        self.assertEqual(sensor_store.counts(), {'test_status': 3})
+        res, _ = last_seen_reducer.collect(jobs, self.tmp_dir,
+                                           sensor_store=sensor_store)
+        self.assertEqual(res, exp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from multivac import storage
+from multivac.log_scanner import LogScanner, QueuedTimeExtractor, \
+    TestStatusExtractor, DebugTargetExtractor, RunnerVersionExtractor, \
+    CompilerVersionExtractor, FailureExtractor, decolor, iter_lines
+from multivac.sensors.failures import FailureMatcher, specific_failures, \
+    generic_failures
+from multivac.sensors.test_status import test_status_iter
+
+
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+SENSORS_DIR = os.path.join(CUR_DIR, 'sensors')
+
+
+class TestLogScanner(unittest.TestCase):
+    def scan(self, log_basename):
+        log_filepath = os.path.join(SENSORS_DIR, log_basename)
+        extractors = [
+            QueuedTimeExtractor(),
+            DebugTargetExtractor(),
+            RunnerVersionExtractor(),
+            CompilerVersionExtractor(),
+            TestStatusExtractor(),
+            FailureExtractor(specific_failures, generic_failures),
+        ]
+        return LogScanner(extractors).scan(log_filepath)
+
+    def check_test_statuses(self, log_basename):
+        log_filepath = os.path.join(SENSORS_DIR, log_basename)
+        with open(log_filepath, 'r') as f:
+            exp = list(test_status_iter(map(decolor, f)))
+        self.assertEqual(self.scan(log_basename)['test_statuses'], exp)
+
+    def test_job_data(self):
+        res = self.scan('925099517.log')
+        self.assertEqual(res['queued_at'], '2021-06-10T12:27:18Z')
+        self.assertEqual(res['debug'], 'False')
+        self.assertEqual(res['runner_version'], '2.278.0')
+        self.assertEqual(res['compiler_version'], 'GNU 9.3.0')
+        self.assertEqual(res['failure'][0], 'testrun_test_failed')
+
+    def test_no_job_data(self):
+        res = self.scan('9224701468.log')
+        self.assertEqual(res['runner_version'], 'unknown_runner_version')
+        self.assertEqual(res['compiler_version'], 'undefined_compiler')
+        self.assertEqual(res['failure'], ('unknown_failure', None))
+
+    def test_failure_tail(self):
+        # A log is searched from the end, the result is the same as
+        # of matching all the lines.
+        matcher = FailureMatcher(specific_failures, generic_failures)
+        for log_basename in ('925099517.log', '900598368.log',
+                             '3828337083.log', '9224701468.log'):
+            log_filepath = os.path.join(SENSORS_DIR, log_basename)
+            with open(log_filepath, 'r') as f:
+                specific, generic = matcher.last_matches(f)
+            extractor = FailureExtractor(specific_failures, generic_failures)
+            self.assertEqual(LogScanner([extractor]).scan(log_filepath), {
+                'failure': specific or generic or ('unknown_failure', None),
+            })
+
+    def test_failure_last_line(self):
+        # Both lines match 'luajit_error', the last one wins.
+        data = b'PANIC: unprotected error 1\n' \
+               b'something else\n' \
+               b'PANIC: unprotected error 2\n' \
+               b'all done\n'
+        extractor = FailureExtractor(specific_failures, generic_failures)
+        self.assertEqual(extractor.scan_tail(data),
+                         ('luajit_error', 'PANIC: unprotected error 2'))
+
+    def test_failure_specific_first(self):
+        # A specific failure wins even if a generic one is closer
+        # to the end of the log.
+        data = b'bind: Address already in use\n' \
+               b'Test hung! Result content mismatch:\n'
+        extractor = FailureExtractor(specific_failures, generic_failures)
+        self.assertEqual(extractor.scan_tail(data)[0],
+                         'testrun_address_already_in_use')
+
+    def test_failure_max_depth(self):
+        data = b'PANIC: unprotected error\n' + b'nothing\n' * 10
+        extractor = FailureExtractor(specific_failures, generic_failures,
+                                     max_depth=40)
+        self.assertEqual(extractor.scan_tail(data),
+                         ('unknown_failure', None))
+        extractor = FailureExtractor(specific_failures, generic_failures)
+        self.assertEqual(extractor.scan_tail(data)[0], 'luajit_error')
+
+    def test_test_statuses(self):
+        for log_basename in ('925099517.log', '900598368.log',
+                             '3828337083.log', '9224701468.log'):
+            self.check_test_statuses(log_basename)
+
+    def test_compressed(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        for log_basename in ('925099517.log', '900598368.log'):
+            log_filepath = os.path.join(SENSORS_DIR, log_basename)
+            with open(log_filepath, 'rb') as f:
+                gz_filepath = storage.write_log(tmp_dir, log_basename[:-4],
+                                                f.read(), 'gz')
+            # A compressed log is decompressed once for all extractors.
+            with mock.patch('multivac.storage.open_log',
+                            wraps=storage.open_log) as open_log:
+                res = self.scan(gz_filepath)
+            self.assertEqual(open_log.call_count, 1)
+            self.assertEqual(res, self.scan(log_basename))
+            # Only the tail is kept for the depth-bounded search.
+            for max_depth in (100, 10000, 2 ** 20):
+                results = [LogScanner([FailureExtractor(
+                    specific_failures, generic_failures,
+                    max_depth=max_depth)]).scan(path)
+                    for path in (log_filepath, gz_filepath)]
+                self.assertEqual(results[0], results[1])
+
+    def test_iter_lines(self):
+        # Lines are the same as of the text mode.
+        data = b'x\na\r\nb\rc\r\rd\n\ne\xc3\xa9\r'
+        for start, end in ((0, len(data)), (2, 9), (4, 5), (3, 3)):
+            exp = list(io.TextIOWrapper(io.BytesIO(data[start:end]),
+                                        encoding='utf-8'))
+            self.assertEqual(list(iter_lines(data, start, end)), exp)
+
+
+if __name__ == '__main__':
+    unittest.main()
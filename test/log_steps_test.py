@@ -0,0 +1,85 @@
+import os
+import unittest
+from multivac import log_steps
+from multivac.log_scanner import LogScanner, QueuedTimeExtractor, \
+    TestStatusExtractor, DebugTargetExtractor, RunnerVersionExtractor, \
+    CompilerVersionExtractor
+from multivac.storage import map_log
+
+
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+SENSORS_DIR = os.path.join(CUR_DIR, 'sensors')
+
+
+def extractors():
+    return [
+        QueuedTimeExtractor(),
+        DebugTargetExtractor(),
+        RunnerVersionExtractor(),
+        CompilerVersionExtractor(),
+        TestStatusExtractor(),
+    ]
+
+
+class TestLogSteps(unittest.TestCase):
+    def test_build_index(self):
+        with map_log(os.path.join(SENSORS_DIR, '925099517.log')) as data:
+            index = log_steps.build_index(data)
+            size = len(data)
+            self.assertTrue(data[index[1][1]:].startswith(
+                b'2021-06-10T12:48:10.6008866Z ##[group]Run sudo chown'))
+        self.assertEqual([(title, log_steps.step_kind(title))
+                          for title, _, _ in index], [
+            ('Set up job', 'setup'),
+            ('Run sudo chown -R $(id -u):$(id -g) .', 'run'),
+            ('Run actions/checkout@v2.3.4', 'action'),
+            ('Run ./.github/actions/environment', 'run'),
+            ('Run ${CI_MAKE} test_static_build', 'run'),
+            ('Run ./.github/actions/send-telegram-notify', 'run'),
+            ('Run actions/upload-artifact@v2', 'action'),
+            ('Post job cleanup.', 'cleanup'),
+        ])
+        # The steps cover the whole log.
+        self.assertEqual(index[0][1], 0)
+        self.assertEqual(index[-1][2], size)
+        for prev, step in zip(index, index[1:]):
+            self.assertEqual(prev[2], step[1])
+
+    def test_markers(self):
+        data = b'##[group]Run a\r\n' \
+               b'2021-06-10T12:48:10.6Z echo ##[group]Run b\n' \
+               b'2021-06-10T12:48:10.6Z Post job cleanup.'
+        self.assertEqual(log_steps.build_index(data), [
+            ['Set up job', 0, 0],
+            ['Run a', 0, 59],
+            ['Post job cleanup.', 59, len(data)],
+        ])
+        self.assertEqual(log_steps.build_index(b''), [['Set up job', 0, 0]])
+
+    def test_index_builder(self):
+        for log_basename in ('925099517.log', '3828337083.log'):
+            with open(os.path.join(SENSORS_DIR, log_basename), 'rb') as f:
+                data = f.read()
+            exp = log_steps.build_index(data)
+            for chunk_size in (5, 4096, len(data)):
+                builder = log_steps.IndexBuilder()
+                for i in range(0, len(data), chunk_size):
+                    builder.feed(data[i:i + chunk_size])
+                self.assertEqual(builder.finish(), exp)
+
+    def test_scan_steps(self):
+        # Skipped steps don't change the result.
+        for log_basename in ('925099517.log', '900598368.log',
+                             '3828337083.log', '9224701468.log'):
+            log_filepath = os.path.join(SENSORS_DIR, log_basename)
+            with open(log_filepath, 'r') as f:
+                exp = LogScanner(extractors()).scan_lines(f)
+            scanner = LogScanner(extractors())
+            self.assertEqual(scanner.scan(log_filepath), exp)
+            with map_log(log_filepath) as data:
+                self.assertEqual(scanner.step_index,
+                                 log_steps.build_index(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
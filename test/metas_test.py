@@ -0,0 +1,91 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from multivac import job_index, metas
+
+
+def api_job(job_id):
+    """ A job object as the GitHub API returns it. """
+    url = 'https://api.github.com/repos/owner/repo/actions'
+    return {
+        'id': job_id, 'run_id': 1, 'run_attempt': 1,
+        'run_url': '{}/runs/1'.format(url),
+        'node_id': 'CR_kwDOAFDNvs8AAAAC', 'head_sha': 'abc',
+        'head_branch': 'master', 'url': '{}/jobs/{}'.format(url, job_id),
+        'html_url': 'https://github.com/owner/repo/runs/{}'.format(job_id),
+        'status': 'completed', 'conclusion': 'success',
+        'created_at': '2023-01-01T00:00:00Z',
+        'started_at': '2023-01-01T00:00:01Z',
+        'completed_at': '2023-01-01T00:10:00Z',
+        'name': 'release', 'workflow_name': 'release',
+        'steps': [{'name': 'Set up job', 'status': 'completed',
+                   'conclusion': 'success', 'number': 1,
+                   'started_at': '2023-01-01T00:00:01Z',
+                   'completed_at': '2023-01-01T00:00:02Z'}],
+        'check_run_url': 'https://api.github.com/repos/owner/repo/'
+                         'check-runs/{}'.format(job_id),
+        'labels': ['ubuntu-20.04'], 'runner_id': 2, 'runner_name': 'r',
+        'runner_group_id': 1, 'runner_group_name': 'Default',
+    }
+
+
+class TestMetas(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.jobs_dir = os.path.join(self.tmp_dir, 'workflow_run_jobs')
+        os.makedirs(self.jobs_dir)
+        self.path = os.path.join(self.jobs_dir, '0', '10.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_fields(self):
+        # The index needs only stored fields.
+        self.assertLessEqual(set(job_index.RUN_FIELDS),
+                             set(metas.RUN_FIELDS))
+        self.assertLessEqual(set(job_index.JOB_FIELDS),
+                             set(metas.JOB_FIELDS))
+
+    def test_write_meta(self):
+        data = api_job(10)
+        path = metas.write_meta(self.jobs_dir, 10, data, metas.JOB_FIELDS)
+        self.assertEqual(path, self.path)
+        self.assertEqual(metas.find_meta(self.jobs_dir, 10), path)
+        self.assertEqual(metas.meta_name(self.jobs_dir, 10), '0/10.json')
+        meta = metas.load_meta(self.path)
+        self.assertEqual(meta, {field: data[field]
+                                for field in metas.JOB_FIELDS})
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'raw')))
+
+        metas.write_meta(self.jobs_dir, 10, data, metas.JOB_FIELDS, raw=True)
+        self.assertEqual(metas.load_meta(self.path), meta)
+        raw_path = os.path.join(self.tmp_dir, 'raw', 'workflow_run_jobs',
+                                '0', '10.json.gz')
+        self.assertEqual(metas.raw_path(self.jobs_dir, 10), raw_path)
+        with gzip.open(raw_path, 'rb') as f:
+            self.assertEqual(json.loads(f.read()), data)
+
+    def test_migrate(self):
+        # A meta stored before sharding.
+        data = api_job(10)
+        path = os.path.join(self.jobs_dir, '10.json')
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+        self.assertEqual(metas.meta_name(self.jobs_dir, 10), '10.json')
+        metas.migrate(self.tmp_dir, raw=True)
+        self.assertEqual(metas.load_meta(path),
+                         metas.project(data, metas.JOB_FIELDS))
+        with gzip.open(metas.raw_path(self.jobs_dir, 10), 'rb') as f:
+            self.assertEqual(json.loads(f.read()), data)
+
+        # Projected metas are kept as is.
+        mtime = os.stat(path).st_mtime_ns
+        metas.migrate(self.tmp_dir, raw=True)
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from multivac.log_scanner import CompilerVersionExtractor, \
+    RunnerVersionExtractor
+from multivac.sensor_store import SensorStore, fingerprint
+
+
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+SENSORS_DIR = os.path.join(CUR_DIR, 'sensors')
+
+
+class CountingExtractor(RunnerVersionExtractor):
+    fed = 0
+
+    def feed(self, line):
+        CountingExtractor.fed += 1
+        super().feed(line)
+
+
+class TestSensorStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_filepath = os.path.join(self.tmp_dir, '925099517.log')
+        shutil.copy(os.path.join(SENSORS_DIR, '925099517.log'),
+                    self.log_filepath)
+        self.store = SensorStore('owner/repo', os.path.join(
+            self.tmp_dir, 'store', 'sensors.sqlite3'))
+        CountingExtractor.fed = 0
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def scan(self):
+        extractors = [CountingExtractor(), CompilerVersionExtractor()]
+        return self.store.scan(925099517, self.log_filepath, extractors,
+                               '2021-06-11T12:00:00Z')
+
+    def test_cache_hit(self):
+        res = self.scan()
+        self.assertEqual(CountingExtractor.fed, 1)
+        self.assertEqual(self.scan(), res)
+        self.assertEqual(CountingExtractor.fed, 1)
+        self.assertEqual(self.store.counts(), {'runner_version': 1,
+                                               'compiler_version': 1,
+                                               'steps': 1})
+
+    def test_stale_extractor(self):
+        self.scan()
+        CountingExtractor.revision += 1
+        try:
+            res = self.scan()
+        finally:
+            CountingExtractor.revision -= 1
+        self.assertEqual(CountingExtractor.fed, 2)
+        self.assertEqual(res['runner_version'], '2.278.0')
+        self.assertEqual(res['compiler_version'], 'GNU 9.3.0')
+
+    def test_changed_log(self):
+        self.scan()
+        with open(self.log_filepath, 'a') as f:
+            f.write('one more line\n')
+        self.scan()
+        self.assertEqual(CountingExtractor.fed, 2)
+
+    def test_results(self):
+        log_fingerprint = fingerprint(self.log_filepath)
+        self.store.put_many([
+            (1, log_fingerprint, {'a': ('v1', [1]), 'b': ('v1', 'x')},
+             '2021-06-10T12:00:00Z'),
+            (2, log_fingerprint, {'a': ('v1', [2])}, '2021-06-11T12:00:00Z'),
+            (3, log_fingerprint, {'a': ('v2', [3])}, '2021-06-11T13:00:00Z'),
+        ])
+        log = os.path.basename(self.log_filepath)
+        self.assertEqual(self.store.results('a', 'v1'), {
+            1: (log, [1]), 2: (log, [2])})
+        self.assertEqual(self.store.results('a', 'v1',
+                                            since='2021-06-11T00:00:00Z'),
+                         {2: (log, [2])})
+        self.assertEqual(self.store.results('a', 'v1',
+                                            till='2021-06-10T12:00:00Z'),
+                         {1: (log, [1])})
+        self.assertEqual(self.store.get(1, log_fingerprint, {'b': 'v1'}),
+                         {'b': 'x'})
+
+    def test_threads(self):
+        log_fingerprint = fingerprint(self.log_filepath)
+        self.store.put(1, log_fingerprint, {'a': ('v1', 1)})
+        threads = [threading.Thread(target=self.store.put, args=(
+            job_id, log_fingerprint, {'a': ('v1', job_id)}))
+            for job_id in range(2, 6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.store.results('a', 'v1'), {
+            job_id: ('925099517.log', job_id) for job_id in range(1, 6)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+""" Benchmark of the failure detection on test/sensors/*.log.
+
+    Compares the one-by-one matching of all the failure regular
+    expressions against every line with `FailureMatcher` over lines
+    and over log bytes from the end.
+
+    Usage: python -m test.sensors.failures_bench [repeat]
+"""
+
+import glob
+import os
+import re
+import sys
+import time
+from multivac.sensors.failures import specific_failures, generic_failures
+from multivac.sensors.failures import FailureMatcher
+
+
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def naive_detect(lines):
+    """ Per line matching, as detect_error() used to do. """
+    compiled = []
+    for failure_specs in (specific_failures, generic_failures):
+        compiled.append([(failure_type['type'], re.compile(expression))
+                         for failure_type in failure_specs
+                         for expression in failure_type['re']])
+    for regexps in compiled:
+        for line in reversed(lines):
+            for failure_type, regexp in regexps:
+                if regexp.match(line):
+                    return failure_type
+    return 'unknown_failure'
+
+
+def matcher_detect(lines, matcher):
+    specific, generic = matcher.last_matches(lines)
+    return (specific or generic or ('unknown_failure', None))[0]
+
+
+def tail_detect(data, matcher):
+    return (matcher.last_match(data) or ('unknown_failure', None))[0]
+
+
+def bench(name, func, logs, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        res = [func(log) for log in logs.values()]
+    elapsed = time.perf_counter() - started
+    size = sum(len(log) if isinstance(log, bytes) else len(''.join(log))
+               for log in logs.values()) * repeat
+    print('{:8} {:8.3f} s {:8.1f} MiB/s  {}'.format(
+        name, elapsed, size / elapsed / 2 ** 20, res))
+    return res
+
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    logs = {}
+    datas = {}
+    for log in sorted(glob.glob(os.path.join(CUR_DIR, '*.log'))):
+        with open(log, 'r') as f:
+            logs[log] = f.readlines()
+        with open(log, 'rb') as f:
+            datas[log] = f.read()
+    matcher = FailureMatcher(specific_failures, generic_failures)
+    exp = bench('naive', naive_detect, logs, repeat)
+    res = bench('matcher', lambda lines: matcher_detect(lines, matcher),
+                logs, repeat)
+    assert res == exp
+    res = bench('tail', lambda data: tail_detect(data, matcher), datas,
+                repeat)
+    assert res == exp
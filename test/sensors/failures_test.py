@@ -0,0 +1,90 @@
+import glob
+import os
+import re
+import unittest
+from multivac.sensors.failures import specific_failures, generic_failures
+from multivac.sensors.failures import required_literals, FailureMatcher
+from multivac.storage import map_log
+
+
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(os.path.dirname(CUR_DIR))
+LOG_EXAMPLES_DIR = os.path.join(PROJECT_DIR, 'docs/gather_job_data/_includes')
+
+
+def naive_match(line):
+    """ Reference implementation: try every regular expression
+        one by one, specific failures first.
+    """
+    for specific, failure_specs in ((True, specific_failures),
+                                    (False, generic_failures)):
+        for failure_type in failure_specs:
+            for expression in failure_type['re']:
+                if re.match(expression, line):
+                    return failure_type['type'], specific
+    return None
+
+
+class TestFailures(unittest.TestCase):
+    def test_required_literals(self):
+        self.assertEqual(required_literals(r'.*Test hung!.*'), ['Test hung!'])
+        self.assertEqual(required_literals(r'.*\* fail: \d+.*'), ['* fail: '])
+        self.assertEqual(required_literals(r'.*- Status code: (404|503) for.*'),
+                         ['- Status code: ', ' for'])
+        self.assertEqual(required_literals(r'.*\[Internal test-run error].*'),
+                         ['[Internal test-run error]'])
+        self.assertEqual(required_literals(r'.*total: [1-9][\d+]* errors.*'),
+                         ['total: ', ' errors'])
+        self.assertEqual(required_literals(r'.*abc?d{2}e.*'), ['ab', 'e'])
+        self.assertEqual(required_literals(r'foo|bar'), [])
+        self.assertEqual(required_literals(r'(?i)foo'), [])
+
+    def test_matcher_same_as_naive(self):
+        matcher = FailureMatcher(specific_failures, generic_failures)
+        logs = glob.glob(os.path.join(CUR_DIR, '*.log')) + \
+            glob.glob(os.path.join(LOG_EXAMPLES_DIR, '*.log'))
+        for log in logs:
+            with open(log, 'r') as f:
+                lines = f.read().split('\n')
+            for line in lines:
+                self.assertEqual(matcher.match(line), naive_match(line), line)
+
+    def test_last_matches(self):
+        matcher = FailureMatcher(specific_failures, generic_failures)
+        lines = [
+            'Test hung! 1\n',
+            'bind: Address already in use\n',
+            'PANIC: unprotected error\n',
+            'nothing\n',
+        ]
+        specific, generic = matcher.last_matches(lines)
+        self.assertEqual(specific, ('testrun_address_already_in_use',
+                                    'bind: Address already in use'))
+        self.assertEqual(generic, ('luajit_error', 'PANIC: unprotected error'))
+        self.assertEqual(matcher.last_matches(['nothing']), (None, None))
+
+    def test_last_match(self):
+        matcher = FailureMatcher(specific_failures, generic_failures)
+        logs = glob.glob(os.path.join(CUR_DIR, '*.log')) + \
+            glob.glob(os.path.join(LOG_EXAMPLES_DIR, '*.log'))
+        for log in logs:
+            with open(log, 'r') as f:
+                specific, generic = matcher.last_matches(f.readlines())
+            with map_log(log) as data:
+                self.assertEqual(matcher.last_match(data),
+                                 specific or generic, log)
+
+        data = b'PANIC: unprotected error 1\r\n' \
+               b'bind: Address already in use\r\n' \
+               b'\xff PANIC: unprotected error 2\r\nnothing'
+        self.assertEqual(matcher.last_match(data),
+                         ('testrun_address_already_in_use',
+                          'bind: Address already in use'))
+        self.assertEqual(matcher.last_match(data, max_depth=40),
+                         ('luajit_error', '\ufffd PANIC: unprotected error 2'))
+        self.assertIsNone(matcher.last_match(data, max_depth=10))
+        self.assertIsNone(matcher.last_match(b''))
+
+
+if __name__ == '__main__':
+    unittest.main()
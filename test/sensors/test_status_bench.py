@@ -0,0 +1,47 @@
+""" Benchmark of the test status parsing on test/sensors/*.log.
+
+    Compares feeding every decoded line to the parser with the
+    bytes-mode parser over a memory-mapped log.
+
+    Usage: python -m test.sensors.test_status_bench [repeat]
+"""
+
+import glob
+import os
+import sys
+import time
+from multivac.sensors.test_status import test_status_line_iter
+from multivac.sensors.test_status import test_status_buffer_iter
+from multivac.storage import map_log
+
+
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def line_parse(log):
+    with open(log, 'r', encoding='utf-8') as f:
+        return list(test_status_line_iter(f))
+
+
+def buffer_parse(log):
+    with map_log(log) as data:
+        return list(test_status_buffer_iter(data))
+
+
+def bench(name, func, logs, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        res = [func(log) for log in logs]
+    elapsed = time.perf_counter() - started
+    size = sum(os.path.getsize(log) for log in logs) * repeat
+    print('{:8} {:8.3f} s {:8.1f} MiB/s  {} statuses'.format(
+        name, elapsed, size / elapsed / 2 ** 20, sum(map(len, res))))
+    return res
+
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    logs = sorted(glob.glob(os.path.join(CUR_DIR, '*.log')))
+    exp = bench('lines', line_parse, logs, repeat)
+    res = bench('mmap', buffer_parse, logs, repeat)
+    assert res == exp
@@ -1,8 +1,17 @@
+import io
+import json
 import os
+import tempfile
 import unittest
 import yaml
 from multivac.sensors.test_status import test_status_iter
 from multivac.sensors.test_status import test_smart_status_iter
+from multivac.sensors.test_status import test_status_buffer_iter
+from multivac.sensors.test_status import test_status_line_iter
+from multivac.sensors.test_status import execute
+from multivac.sensors.test_status import get_cache_filepath
+from multivac.sensors.test_status import load_cache
+from multivac.storage import map_log
 
 
 CUR_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -79,5 +88,114 @@ class TestStatus(unittest.TestCase):
         self.check_test_smart_status_iter('9224701468.log')
 
 
+class TestStatusBuffer(unittest.TestCase):
+    """ The bytes-mode parser gives the same result as the line
+        parser.
+    """
+    def check(self, data):
+        exp = list(test_status_line_iter(
+            io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')))
+        self.assertEqual(list(test_status_buffer_iter(data)), exp)
+        return exp
+
+    def test_fixtures(self):
+        for log_basename in ('925099517.log', '900598368.log',
+                             '3828337083.log', '9224701468.log'):
+            log_filepath = os.path.join(CUR_DIR, log_basename)
+            with open(log_filepath, 'r') as f:
+                exp = list(test_status_line_iter(f))
+            with map_log(log_filepath) as data:
+                self.assertEqual(list(test_status_buffer_iter(data)), exp)
+                self.assertEqual(list(test_status_iter(data)), exp)
+
+    def test_edge_cases(self):
+        ts = b'2021-10-07T15:20:22.8390465Z '
+        status = ts + b'[001] app/a.test.lua    memtx    [ pass ]\n'
+        awaiting = ts + b'[002] app/b.test.lua    vinyl    \n'
+        late = ts + b'[002] [ fail ]\n'
+        hang = ts + b'Test hung! Result content mismatch:\n'
+        result = ts + b'--- app/c.result\tThu Oct  7 13:53:41 2021\n'
+        other = ts + b'Some output\n'
+
+        self.assertEqual(self.check(b''), [])
+        self.assertEqual(self.check(other + status + awaiting + other + late),
+                         [('app/a.test.lua', 'memtx', 'pass'),
+                          ('app/b.test.lua', 'vinyl', 'fail')])
+        # No newline at the end: the test has no result.
+        self.assertEqual(self.check(awaiting.rstrip(b'\n')),
+                         [('app/b.test.lua', 'vinyl', 'fail')])
+        # A status between a hang and its result.
+        self.assertEqual(self.check(hang + status + result + other),
+                         [('app/a.test.lua', 'memtx', 'pass'),
+                          ('app/c.test.lua', None, 'hang')])
+        self.assertEqual(self.check(hang + other + result), [])
+        # Universal newlines.
+        self.assertEqual(self.check(other + status.replace(b'\n', b'\r\n') +
+                                    awaiting.replace(b'\n', b'\r')),
+                         [('app/a.test.lua', 'memtx', 'pass'),
+                          ('app/b.test.lua', 'vinyl', 'fail')])
+
+
+class TestStatusCache(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        ts = '2021-10-07T15:20:22.8390465Z '
+        self.log_filepath = os.path.join(tmp_dir.name, '1.log')
+        with open(self.log_filepath, 'w') as f:
+            f.write(ts + '[001] app/a.test.lua    memtx    [ fail ]\n')
+            f.write(ts + '[002] app/b.test.lua    vinyl    \n')
+            f.write(ts + '[002] [ pass ]\n')
+            f.write(ts + '[001] app/a.test.lua    memtx    [ pass ]\n')
+        self.cache_filepath = get_cache_filepath(self.log_filepath)
+        self.exp = [
+            {'event': 'test status', 'test': 'app/a.test.lua',
+             'conf': 'memtx', 'status': 'transient fail'},
+            {'event': 'test status', 'test': 'app/b.test.lua',
+             'conf': 'vinyl', 'status': 'pass'},
+        ]
+
+    def execute(self):
+        return list(execute(self.log_filepath, self.cache_filepath))
+
+    def test_cache(self):
+        self.assertEqual(self.execute(), self.exp)
+        # All statuses are cached, including the late one.
+        self.assertEqual(load_cache(self.cache_filepath), [
+            ('app/a.test.lua', 'memtx', 'fail'),
+            ('app/b.test.lua', 'vinyl', 'pass'),
+            ('app/a.test.lua', 'memtx', 'pass'),
+        ])
+        self.assertEqual(os.listdir(os.path.dirname(self.cache_filepath)),
+                         ['1.log', '1.log.test_status.cache.jsonl'])
+
+        # The log is not read on a cache hit.
+        os.remove(self.log_filepath)
+        self.assertEqual(self.execute(), self.exp)
+
+    def check_rebuilt(self, cache_content):
+        with open(self.cache_filepath, 'w') as f:
+            f.write(cache_content)
+        self.assertIsNone(load_cache(self.cache_filepath))
+        self.assertEqual(self.execute(), self.exp)
+        self.assertIsNotNone(load_cache(self.cache_filepath))
+
+    def test_stale_cache(self):
+        self.execute()
+        with open(self.cache_filepath, 'r') as f:
+            lines = f.readlines()
+        header = json.loads(lines[0])
+
+        # Truncated.
+        self.check_rebuilt(''.join(lines[:-1]))
+        self.check_rebuilt(''.join(lines)[:-5])
+        # Another parser version.
+        header['version'] = 'x'
+        self.check_rebuilt(json.dumps(header) + '\n' + ''.join(lines[1:]))
+        # The format of older versions.
+        self.check_rebuilt('[]')
+        self.check_rebuilt('')
+
+
 if __name__ == '__main__':
     unittest.main()
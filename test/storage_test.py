@@ -0,0 +1,176 @@
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from multivac import storage
+from multivac.log_scanner import LogScanner, TestStatusExtractor
+from multivac.sensors.test_status import get_cache_filepath
+
+
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+SENSORS_DIR = os.path.join(CUR_DIR, 'sensors')
+
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        log_filepath = os.path.join(SENSORS_DIR, '925099517.log')
+        with open(log_filepath, 'rb') as f:
+            self.data = f.read()
+        # Universal newlines.
+        with open(log_filepath, 'r', encoding='utf-8') as f:
+            self.text = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def compressions(self):
+        res = ['gz', 'none']
+        if storage.zstandard:
+            res.append('zst')
+        return res
+
+    def test_round_trip(self):
+        for job_id, compression in enumerate(self.compressions()):
+            path = storage.write_log(self.tmp_dir, job_id, self.data,
+                                     compression)
+            self.assertEqual(storage.find_log(self.tmp_dir, job_id), path)
+            with storage.open_log(path, 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+            with storage.open_log(path) as f:
+                self.assertEqual(f.read(), self.text)
+            # Compressed logs are mapped too, not read into memory.
+            with storage.map_log(path) as data:
+                self.assertIsInstance(data, mmap.mmap)
+                self.assertEqual(data[10:], self.data[10:])
+
+    def test_map_log_tail(self):
+        def tail_windows(data, max_depth):
+            return [data[start:end] for start, end
+                    in storage.reverse_windows(data, 100, max_depth)]
+
+        for job_id, compression in enumerate(self.compressions()):
+            path = storage.write_log(self.tmp_dir, job_id, self.data,
+                                     compression)
+            for max_depth in (0, 1, 999, 1000, len(self.data) - 1,
+                              len(self.data), len(self.data) + 1):
+                # Small reads to keep the tail across them.
+                with mock.patch.object(storage, 'TAIL_CHUNK', 64), \
+                        storage.map_log(path, max_depth) as data:
+                    # The same lines are searched as in the whole log.
+                    self.assertEqual(tail_windows(data, max_depth),
+                                     tail_windows(self.data, max_depth))
+                    if compression != 'none':
+                        self.assertLessEqual(len(data), max_depth + 1)
+
+    def test_log_writer(self):
+        for job_id, compression in enumerate(self.compressions()):
+            with storage.LogWriter(self.tmp_dir, job_id,
+                                   compression) as writer:
+                for i in range(0, len(self.data), 1000):
+                    writer.write(self.data[i:i + 1000])
+                # Not visible till the end.
+                with self.assertRaises(FileNotFoundError):
+                    storage.find_log(self.tmp_dir, job_id)
+            self.assertEqual(writer.size, len(self.data))
+            self.assertEqual(writer.sha256.hexdigest(),
+                             hashlib.sha256(self.data).hexdigest())
+            with storage.open_log(writer.path, 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+
+        # An error leaves nothing.
+        with self.assertRaises(ValueError):
+            with storage.LogWriter(self.tmp_dir, 'x', 'gz') as writer:
+                writer.write(self.data)
+                raise ValueError
+        self.assertFalse(any(name.startswith('x.')
+                             for name in os.listdir(self.tmp_dir)))
+
+    def test_reverse_windows(self):
+        data = b'a\nbb\r\n' + b'c' * 10 + b'\nd'
+        windows = list(storage.reverse_windows(data, window=4))
+        self.assertEqual([data[start:end] for start, end in windows],
+                         [b'd', b'bb\r\n' + b'c' * 10 + b'\n', b'a\n'])
+        for window in (1, 10, 1000):
+            windows = list(storage.reverse_windows(self.data, window))
+            self.assertEqual(b''.join(self.data[start:end] for start, end
+                                      in reversed(windows)), self.data)
+            for start, end in windows[1:]:
+                self.assertEqual(self.data[end - 1:end], b'\n')
+        # Lines crossing the bound are not read.
+        windows = list(storage.reverse_windows(data, max_depth=7))
+        self.assertEqual([data[start:end] for start, end in windows], [b'd'])
+        windows = list(storage.reverse_windows(data, max_depth=16))
+        self.assertEqual([data[start:end] for start, end in windows],
+                         [b'bb\r\n' + b'c' * 10 + b'\nd'])
+        self.assertEqual(list(storage.reverse_windows(b'')), [])
+
+    def test_find_log(self):
+        with self.assertRaises(FileNotFoundError):
+            storage.find_log(self.tmp_dir, '1')
+        self.assertEqual(storage.log_name(self.tmp_dir, '1'), '0/1.log')
+        storage.write_log(self.tmp_dir, '1', self.data, 'none')
+        storage.write_log(self.tmp_dir, '1', self.data, 'gz')
+        storage.write_log(self.tmp_dir, '2', self.data, 'none')
+        self.assertEqual(storage.log_name(self.tmp_dir, '1'), '0/1.log.gz')
+        self.assertEqual(sorted(storage.iter_logs(self.tmp_dir)), [
+            os.path.join(self.tmp_dir, '0', '1.log.gz'),
+            os.path.join(self.tmp_dir, '0', '2.log'),
+        ])
+
+    def test_reshard(self):
+        # Files stored before sharding are found too.
+        job_id = 9224701468
+        shard_dir = os.path.join(self.tmp_dir, '922')
+        for filename in ('{}.log', '{}.json', '{}.log.123.tmp'):
+            with open(os.path.join(self.tmp_dir,
+                                   filename.format(job_id)), 'wb') as f:
+                f.write(self.data)
+        os.makedirs(os.path.join(self.tmp_dir, 'unrelated'))
+        flat_path = os.path.join(self.tmp_dir, '{}.log'.format(job_id))
+        self.assertEqual(storage.find_log(self.tmp_dir, job_id), flat_path)
+        self.assertEqual(list(storage.iter_logs(self.tmp_dir)), [flat_path])
+        # A file in the shard is preferred.
+        path = storage.write_log(self.tmp_dir, job_id, b'new', 'none')
+        self.assertEqual(path, os.path.join(shard_dir, '9224701468.log'))
+        self.assertEqual(storage.find_log(self.tmp_dir, job_id), path)
+        self.assertEqual(list(storage.iter_logs(self.tmp_dir)), [path])
+
+        storage.reshard(self.tmp_dir)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), [
+            '922', '9224701468.log.123.tmp', 'unrelated'])
+        self.assertEqual(sorted(os.listdir(shard_dir)), [
+            '9224701468.json', '9224701468.log'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'new')
+        self.assertEqual(sorted(storage.iter_files(self.tmp_dir)), [
+            ('9224701468.json', os.path.join('922', '9224701468.json')),
+            ('9224701468.log', os.path.join('922', '9224701468.log')),
+            ('9224701468.log.123.tmp', '9224701468.log.123.tmp'),
+        ])
+
+    def test_migrate(self):
+        path = storage.write_log(self.tmp_dir, '1', self.data, 'none')
+        with open(get_cache_filepath(path), 'w') as f:
+            f.write('[]')
+        storage.migrate(self.tmp_dir, 'gz')
+        shard_dir = os.path.join(self.tmp_dir, '0')
+        self.assertEqual(sorted(os.listdir(shard_dir)), [
+            '1.log.gz', '1.log.gz.test_status.cache.jsonl'])
+        new_path = os.path.join(shard_dir, '1.log.gz')
+        with storage.open_log(new_path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_scan_compressed(self):
+        plain = storage.write_log(self.tmp_dir, '1', self.data, 'none')
+        compressed = storage.write_log(self.tmp_dir, '2', self.data, 'gz')
+        exp = LogScanner([TestStatusExtractor()]).scan(plain)
+        res = LogScanner([TestStatusExtractor()]).scan(compressed)
+        self.assertEqual(res, exp)
+
+
+if __name__ == '__main__':
+    unittest.main()